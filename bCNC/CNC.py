@@ -3,10 +3,21 @@
 # Author: vvlachoudis@gmail.com
 # Date: 24-Aug-2014
 
+import copy
+import itertools
 import math
+import mmap
+import operator
 import os
 import re
+import threading
 import types
+from array import array
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+import numpy
 
 import undo
 import Unicode
@@ -30,6 +41,9 @@ PARENPAT = re.compile(r"(\(.*?\))")
 SEMIPAT = re.compile(r"(;.*)")
 OPPAT = re.compile(r"(.*)\[(.*)\]")
 CMDPAT = re.compile(r"([A-Za-z]+)")
+WORDPAT = re.compile(r"([A-Za-z])\s*([-+]?(?:\d+\.?\d*|\.\d+))?")
+TOKENPAT = re.compile(
+    r"([A-Za-z])\s*([-+]?(?:\d+\.?\d*|\.\d+))?|([(\[;])")
 BLOCKPAT = re.compile(r"^\(Block-([A-Za-z]+):\s*(.*)\)")
 AUXPAT = re.compile(r"^(%[A-Za-z0-9]+)\b *(.*)$")
 
@@ -100,6 +114,26 @@ MODAL_MODES = {
 ERROR_HANDLING = {}
 TOLERANCE = 1e-7
 MAXINT = 1000000000  # python3 doesn't have maxint
+LINECACHE_SIZE = 100000  # maximum number of parsed lines to remember
+LAZYBLOCK_SIZE = 1 << 20  # bytes of lines of an unnamed block in lazy mode
+LAZYREAD_SIZE = 1 << 24  # bytes decoded at once from a lazy block
+ARCPOINTS_NUMPY = 64  # segments above which a single arc uses numpy
+ARCFIT_MIN = 3  # minimum segments replaced by an arc while streaming
+ARCFIT_MAX = 64  # maximum segments replaced by an arc while streaming
+ARCFIT_RADIUS = 10000.0  # maximum radius of the fitted arcs
+CHECKPOINT_LINES = 1000  # lines between the modal state checkpoints
+
+# CNC attributes defining the modal state of the motion
+MODAL_STATE = (
+    "x", "y", "z", "a", "b", "c",
+    "xval", "yval", "zval", "aval", "bval", "cval",
+    "dx", "dy", "dz", "ival", "jval", "kval",
+    "rval", "pval", "qval", "uval", "vval", "wval",
+    "unit", "mval", "lval", "tool",
+    "absolute", "arcabsolute", "retractz",
+    "gcode", "plane", "feed",
+)
+_modalGetter = operator.attrgetter(*MODAL_STATE)
 
 
 # -----------------------------------------------------------------------------
@@ -655,6 +689,172 @@ class Orient:
         self.saved = True
 
 
+# =============================================================================
+# Bounded LRU cache of parsed g-code lines.
+# Shared by every consumer of CNC.compileLine/tokenizeLine/breakLine (drawing,
+# compiling, autolevel, toPath, modify) so that a line is only tokenized once
+# as long as its text and the modal flags affecting the parsing stay the same.
+# There is one entry per line text holding all its parsed forms, so the size
+# is a number of lines. A program with more lines than the cache is not
+# cached at all: every pass over it would evict each line before coming
+# round to it again
+# =============================================================================
+class LineCache:
+    # parsed forms of a line in its entry
+    PARSE = 0
+    BREAK = 1
+    WORDS = 2
+    COMPILE = 3  # (space, stdexpr, cmds, comment)
+    FORMS = 4
+
+    def __init__(self, size=LINECACHE_SIZE):
+        self.size = size
+        self.active = True  # False while the program is bigger than size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # ----------------------------------------------------------------------
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    # ----------------------------------------------------------------------
+    def resize(self, size):
+        self.size = size
+        while len(self._cache) > max(size, 0):
+            self._cache.popitem(last=False)
+
+    # ----------------------------------------------------------------------
+    # Turn the cache off for a program of more lines than it can hold and
+    # back on for a smaller one. An eighth is left for the other lines
+    # parsed meanwhile (startup, header and footer, edited lines)
+    # ----------------------------------------------------------------------
+    def fit(self, lines):
+        self.active = lines + (self.size >> 3) <= self.size
+        if not self.active:
+            self._cache.clear()
+
+    # ----------------------------------------------------------------------
+    def __len__(self):
+        return len(self._cache)
+
+    # ----------------------------------------------------------------------
+    # @return cached form of a line or None if not found
+    # ----------------------------------------------------------------------
+    def get(self, line, form):
+        if not self.active:
+            return None
+        try:
+            value = self._cache[line][form]
+            self._cache.move_to_end(line)
+        except KeyError:  # missing or evicted by another thread
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    # ----------------------------------------------------------------------
+    def put(self, line, form, value):
+        if self.size <= 0 or not self.active:
+            return
+        entry = self._cache.get(line)
+        if entry is None:
+            entry = self._cache[line] = [None] * LineCache.FORMS
+            if len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        entry[form] = value
+
+    # ----------------------------------------------------------------------
+    def hitRate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / float(total)
+
+    # ----------------------------------------------------------------------
+    def stats(self):
+        return (
+            f"{len(self._cache)}/{self.size} lines"
+            f"{'' if self.active else ' (off, program too big)'}, "
+            f"hits={self.hits} misses={self.misses} "
+            f"({self.hitRate() * 100.0:.1f}%)"
+        )
+
+
+# =============================================================================
+# Variables of the machine (CNC.vars) as seen by the calling thread.
+# A thread bound to the variables of a machine, e.g. the serial and compile
+# threads of a Sender, reads and writes those, any other thread the default
+# ones. With a single machine everything is bound to the default variables,
+# several machines in one process keep their state apart.
+# =============================================================================
+class MachineVars(MutableMapping):
+    def __init__(self, values):
+        self._default = values
+        self._local = threading.local()
+
+    # ----------------------------------------------------------------------
+    # @return the dictionary of the variables of the calling thread
+    # ----------------------------------------------------------------------
+    def dict(self):
+        return getattr(self._local, "values", self._default)
+
+    # ----------------------------------------------------------------------
+    # @return new variables of a machine, a copy of the default ones
+    # ----------------------------------------------------------------------
+    def new(self):
+        return {
+            name: copy.deepcopy(value)
+            for name, value in self._default.items()
+            if not name.startswith("__")  # __builtins__ added by eval
+        }
+
+    # ----------------------------------------------------------------------
+    # Bind the calling thread to the variables, None for the default ones
+    # ----------------------------------------------------------------------
+    def bind(self, values):
+        if values is None or values is self._default:
+            self._local.__dict__.pop("values", None)
+        else:
+            self._local.values = values
+
+    # ----------------------------------------------------------------------
+    @contextmanager
+    def bound(self, values):
+        old = self._local.__dict__.get("values")
+        self.bind(values)
+        try:
+            yield values
+        finally:
+            self.bind(old)
+
+    # ----------------------------------------------------------------------
+    def __getitem__(self, name):
+        return getattr(self._local, "values", self._default)[name]
+
+    def __setitem__(self, name, value):
+        getattr(self._local, "values", self._default)[name] = value
+
+    def __delitem__(self, name):
+        del self.dict()[name]
+
+    def __contains__(self, name):
+        return name in self.dict()
+
+    def __iter__(self):
+        return iter(self.dict())
+
+    def __len__(self):
+        return len(self.dict())
+
+    def get(self, name, default=None):
+        return self.dict().get(name, default)
+
+
 # =============================================================================
 # Command operations on a CNC
 # =============================================================================
@@ -668,6 +868,8 @@ class CNC:
     feedmax_x = 3000
     feedmax_y = 3000
     feedmax_z = 2000
+    junction_deviation = 0.01  # mm, as grbl $11
+    arc_tolerance = 0.002  # mm, as grbl $12
     travel_x = 300
     travel_y = 300
     travel_z = 60
@@ -676,9 +878,15 @@ class CNC:
     startup = "G90"
     stdexpr = False  # standard way of defining expressions with []
     comment = ""  # last parsed comment
+    lineCache = LineCache()  # parsed lines shared by all consumers
+    lazyload = 50  # file size in MB above which the files are loaded lazily
+    compactblocks = True  # store the loaded blocks in a single text buffer
+    reducestream = False  # remove the redundant words from the stream
+    arcfit = 0.0  # tolerance to fit arcs while streaming, 0 to disable
+    linenumbers = False  # number the streamed lines to follow the execution
     developer = False
     drozeropad = 0
-    vars = {
+    vars = MachineVars({
         "prbx": 0.0,
         "prby": 0.0,
         "prbz": 0.0,
@@ -726,6 +934,7 @@ class CNC:
         "rpm": 0.0,
         "planner": 0,
         "rxbytes": 0,
+        "Ln": 0,  # line number of the block in motion, 0 if not reported
         "OvFeed": 100,  # Override status
         "OvRapid": 100,
         "OvSpindle": 100,
@@ -750,7 +959,7 @@ class CNC:
         "controller": "",
         "running": False,
         # "enable6axisopt" : 0,
-    }
+    })
 
     drillPolicy = 1  # Expand Canned cycles
     toolPolicy = 1  # Should be in sync with ProbePage
@@ -845,6 +1054,15 @@ class CNC:
             CNC.feedmax_z = float(config.get(section, "feedmax_z"))
         except Exception:
             pass
+        try:
+            CNC.junction_deviation = float(
+                config.get(section, "junction_deviation"))
+        except Exception:
+            pass
+        try:
+            CNC.arc_tolerance = float(config.get(section, "arc_tolerance"))
+        except Exception:
+            pass
         try:
             CNC.travel_x = float(config.get(section, "travel_x"))
         except Exception:
@@ -905,6 +1123,30 @@ class CNC:
             CNC.drozeropad = int(config.get(section, "drozeropad"))
         except Exception:
             pass
+        try:
+            CNC.lineCache.resize(int(config.get(section, "linecache")))
+        except Exception:
+            pass
+        try:
+            CNC.lazyload = float(config.get(section, "lazyload"))
+        except Exception:
+            pass
+        try:
+            CNC.compactblocks = bool(int(config.get(section, "compactblocks")))
+        except Exception:
+            pass
+        try:
+            CNC.reducestream = bool(int(config.get(section, "reducestream")))
+        except Exception:
+            pass
+        try:
+            CNC.arcfit = float(config.get(section, "arcfit"))
+        except Exception:
+            pass
+        try:
+            CNC.linenumbers = bool(int(config.get(section, "linenumbers")))
+        except Exception:
+            pass
 
         try:
             CNC.startup = config.get(section, "startup")
@@ -926,6 +1168,9 @@ class CNC:
             CNC.feedmax_x /= 25.4
             CNC.feedmax_y /= 25.4
             CNC.feedmax_z /= 25.4
+            CNC.junction_deviation /= 25.4
+            CNC.arc_tolerance /= 25.4
+            CNC.arcfit /= 25.4
             CNC.travel_x /= 25.4
             CNC.travel_y /= 25.4
             CNC.travel_z /= 25.4
@@ -947,6 +1192,41 @@ class CNC:
     def saveConfig(config):
         pass
 
+    # ----------------------------------------------------------------------
+    # Kinematic limits of the machine for the time estimation.
+    # The $11,$12,$110-$122 settings reported by the controller take
+    # precedence over the configuration
+    # @return max rate xyz [units/min], acceleration xyz [units/s^2],
+    #         junction deviation, arc tolerance
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def machineLimits():
+        # grbl settings are always in mm
+        scale = 25.4 if CNC.inch else 1.0
+
+        def setting(n, default):
+            try:
+                return float(CNC.vars[f"grbl_{n}"]) / scale
+            except (KeyError, TypeError, ValueError):
+                return default
+
+        rate = (
+            setting(110, CNC.feedmax_x),
+            setting(111, CNC.feedmax_y),
+            setting(112, CNC.feedmax_z),
+        )
+        acceleration = (
+            setting(120, CNC.acceleration_x),
+            setting(121, CNC.acceleration_y),
+            setting(122, CNC.acceleration_z),
+        )
+        return (
+            rate,
+            acceleration,
+            setting(11, CNC.junction_deviation),
+            setting(12, CNC.arc_tolerance),
+        )
+
     # ----------------------------------------------------------------------
     def initPath(self, x=None, y=None, z=None, a=None, b=None, c=None):
         if x is None:
@@ -996,6 +1276,17 @@ class CNC:
         self.totalLength = 0.0
         self.totalTime = 0.0
 
+    # ----------------------------------------------------------------------
+    # Modal state of the motion, to resume the parsing from a known state
+    # ----------------------------------------------------------------------
+    def modalState(self):
+        return _modalGetter(self)
+
+    # ----------------------------------------------------------------------
+    def setModalState(self, state):
+        for name, value in zip(MODAL_STATE, state):
+            setattr(self, name, value)
+
     # ----------------------------------------------------------------------
     def resetEnableMargins(self):
         # Selected blocks margin
@@ -1175,6 +1466,20 @@ class CNC:
     # ----------------------------------------------------------------------
     @staticmethod
     def parseLine(line):
+        cmds = CNC.lineCache.get(line, LineCache.PARSE)
+        if cmds is None:
+            cmds = CNC._parseLine(line)
+            # remember empty lines as False
+            CNC.lineCache.put(
+                line, LineCache.PARSE, cmds is not None and tuple(cmds))
+            return cmds
+        if cmds is False:
+            return None
+        return list(cmds)
+
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def _parseLine(line):
         # skip empty lines
         if len(line) == 0 or line[0] in ("%", "(", "#", ";"):
             return None
@@ -1191,6 +1496,95 @@ class CNC:
         line = CMDPAT.sub(r" \1", line).lstrip()
         return line.split()
 
+    # ----------------------------------------------------------------------
+    # Tokenize a line in a single pass
+    # @return list of (LETTER, value) word tuples,
+    #       None for empty, comment or special lines
+    # Comments (...) and ;... are skipped and [expr] expressions are not
+    # evaluated, like in compileLine. Words with a missing value or an
+    # expression value are returned as 0.0
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def tokenizeLine(line):
+        if line is None:
+            return None
+        words = CNC.lineCache.get(line, LineCache.WORDS)
+        if words is None:
+            words = CNC._tokenizeLine(line)
+            # remember empty lines as False, lines without words as ()
+            CNC.lineCache.put(
+                line, LineCache.WORDS, words is not None and tuple(words))
+            return words
+        if words is False:
+            return None
+        return list(words)
+
+    # ----------------------------------------------------------------------
+    # @return words of cmds, the text compileLine returned for line.
+    # A plain line gives the same words as its compiled text, tokenize it
+    # instead so that both share the cache entry of the line
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def compiledWords(line, cmds):
+        if (line[:1] in "%(#;" or "[" in line or "#" in line
+                or "=" in line):
+            return CNC.tokenizeLine(cmds)
+        return CNC.tokenizeLine(line)
+
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def _tokenizeLine(line):
+        # skip empty lines
+        if len(line) == 0 or line[0] in ("%", "(", "#", ";"):
+            return None
+
+        # fast path without comments or expressions
+        if "(" not in line and "[" not in line and ";" not in line:
+            return [
+                (c.upper(), float(v) if v else 0.0)
+                for c, v in WORDPAT.findall(line)
+            ]
+
+        words = []
+        pos = 0
+        n = len(line)
+        while pos < n:
+            pat = TOKENPAT.search(line, pos)
+            if pat is None:
+                break
+            c, v, ch = pat.groups()
+            pos = pat.end()
+            if c is not None:
+                words.append((c.upper(), float(v) if v else 0.0))
+            elif ch == ";":
+                break
+            else:
+                # skip nested (comment) or [expression]
+                if ch == "(":
+                    opening, closing = "(", ")"
+                else:
+                    opening, closing = "[", "]"
+                depth = 1
+                while depth and pos < n:
+                    ch = line[pos]
+                    if ch == opening:
+                        depth += 1
+                    elif ch == closing:
+                        depth -= 1
+                    pos += 1
+        return words
+
+    # ----------------------------------------------------------------------
+    # @return text of a word tuple
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def word(c, value):
+        if c in "FXYZIJKRP":
+            return CNC.fmt(c, value)
+        if value == int(value):
+            return f"{c}{int(value)}"
+        return f"{c}{value!r}"
+
     # ----------------------------------------------------------------------
     # @return line,comment
     #   line broken in a list of commands,
@@ -1199,6 +1593,29 @@ class CNC:
     # ----------------------------------------------------------------------
     @staticmethod
     def compileLine(line, space=False):
+        cached = CNC.lineCache.get(line, LineCache.COMPILE)
+        if cached is None or cached[:2] != (space, CNC.stdexpr):
+            cmds = CNC._compileLine(line, space)
+            # "%if running" lines depend on the running state
+            if not line.startswith("%if"):
+                if isinstance(cmds, list):
+                    cached = tuple(cmds)
+                else:
+                    cached = cmds
+                CNC.lineCache.put(
+                    line, LineCache.COMPILE,
+                    (space, CNC.stdexpr, cached, CNC.comment))
+            return cmds
+
+        # return a copy since the callers modify the lists in place
+        cmds, CNC.comment = cached[2:]
+        if isinstance(cmds, tuple) and cmds and not isinstance(cmds[0], int):
+            return list(cmds)
+        return cmds
+
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def _compileLine(line, space=False):
         line = line.strip()
         if not line:
             return None
@@ -1353,22 +1770,24 @@ class CNC:
     def breakLine(line):
         if line is None:
             return None
-        # Insert space before each command
-        line = CMDPAT.sub(r" \1", line).lstrip()
-        return line.split()
+        cmds = CNC.lineCache.get(line, LineCache.BREAK)
+        if cmds is None:
+            # Insert space before each command
+            cmds = CMDPAT.sub(r" \1", line).lstrip().split()
+            CNC.lineCache.put(line, LineCache.BREAK, tuple(cmds))
+            return cmds
+        return list(cmds)
 
     # ----------------------------------------------------------------------
     # Create path for one g command
+    # @param cmds list of (LETTER, value) words from tokenizeLine.
+    #       A list of strings (as from breakLine) is accepted as well
     # ----------------------------------------------------------------------
     def motionStart(self, cmds):
         self.mval = 0  # reset m command
-        for cmd in cmds:
-            c = cmd[0].upper()
-            try:
-                value = float(cmd[1:])
-            except Exception:
-                value = 0
-
+        if cmds and isinstance(cmds[0], str):
+            cmds = CNC.tokenizeLine("".join(cmds))
+        for c, value in cmds or ():
             if c == "X":
                 self.xval = value * self.unit
                 if not self.absolute:
@@ -1547,10 +1966,117 @@ class CNC:
             else:
                 return yc, zc
 
+    # ----------------------------------------------------------------------
+    # @return the parameters of the current G2/G3 arc, on its plane
+    #       (uc, vc, radius, phi0, sweep, w0, w1, plane)
+    #       sweep is negative for clockwise arcs
+    # ----------------------------------------------------------------------
+    def motionArc(self):
+        uc, vc = self.motionCenter()
+        gcode = self.gcode
+        if self.plane == XY:
+            u0, v0, w0 = self.x, self.y, self.z
+            u1, v1, w1 = self.xval, self.yval, self.zval
+        elif self.plane == XZ:
+            u0, v0, w0 = self.x, self.z, self.y
+            u1, v1, w1 = self.xval, self.zval, self.yval
+            gcode = 5 - gcode  # flip 2-3 when XZ plane is used
+        else:
+            u0, v0, w0 = self.y, self.z, self.x
+            u1, v1, w1 = self.yval, self.zval, self.xval
+        phi0 = math.atan2(v0 - vc, u0 - uc)
+        phi1 = math.atan2(v1 - vc, u1 - uc)
+        if gcode == 2:
+            if phi1 >= phi0 - 1e-10:
+                phi1 -= 2.0 * math.pi
+        elif phi1 <= phi0 + 1e-10:
+            phi1 += 2.0 * math.pi
+        return uc, vc, self.rval, phi0, phi1 - phi0, w0, w1, self.plane
+
+    # ----------------------------------------------------------------------
+    # Linearize many arcs at once
+    # @param arcs list of arc parameters as returned by motionArc()
+    # @param tolerance maximum chord error (default CNC.accuracy), with
+    #       at most pi/4 per segment
+    # @return list with the intermediate xyz points of every arc, without
+    #       the start and end points
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def arcPoints(arcs, tolerance=None):
+        if not arcs:
+            return []
+        if tolerance is None:
+            tolerance = CNC.accuracy
+        if len(arcs) == 1:
+            # numpy doesn't pay off for a single short arc
+            uc, vc, r, phi0, sweep, w0, w1, plane = arcs[0]
+            try:
+                sagitta = 1.0 - tolerance / r
+            except ZeroDivisionError:
+                sagitta = 0.0
+            if sagitta > 0.0:
+                df = min(2.0 * math.acos(sagitta), math.pi / 4.0)
+            else:
+                df = math.pi / 4.0
+            segments = max(int(math.ceil(abs(sweep) / df - 1e-9)), 1)
+            if segments <= ARCPOINTS_NUMPY:
+                points = []
+                for k in range(1, segments):
+                    t = k / segments
+                    phi = phi0 + sweep * t
+                    u = uc + r * math.cos(phi)
+                    v = vc + r * math.sin(phi)
+                    w = w0 + (w1 - w0) * t
+                    if plane == XY:
+                        points.append((u, v, w))
+                    elif plane == XZ:
+                        points.append((u, w, v))
+                    else:
+                        points.append((w, u, v))
+                return [points]
+
+        uc, vc, r, phi0, sweep, w0, w1, plane = \
+            numpy.array(arcs, numpy.float64).reshape(-1, 8).T
+
+        # angular step giving the requested chord error
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            sagitta = 1.0 - tolerance / r
+            df = numpy.where(
+                sagitta > 0.0,
+                numpy.minimum(2.0 * numpy.arccos(sagitta), math.pi / 4.0),
+                math.pi / 4.0,
+            )
+        segments = numpy.maximum(
+            numpy.ceil(numpy.abs(sweep) / df - 1e-9), 1.0).astype(numpy.int64)
+        count = segments - 1  # intermediate points per arc
+
+        # one row per point with the arc it belongs to
+        arc = numpy.repeat(numpy.arange(len(count)), count)
+        ends = numpy.cumsum(count)
+        t = (numpy.arange(len(arc)) - numpy.repeat(ends - count, count)
+             + 1.0) / segments[arc]
+        phi = phi0[arc] + sweep[arc] * t
+        u = uc[arc] + r[arc] * numpy.cos(phi)
+        v = vc[arc] + r[arc] * numpy.sin(phi)
+        w = w0[arc] + (w1 - w0)[arc] * t
+
+        plane = plane[arc]
+        x = numpy.where(plane == YZ, w, u)
+        y = numpy.where(plane == XY, v, numpy.where(plane == XZ, w, u))
+        z = numpy.where(plane == XY, w, v)
+        points = list(zip(x.tolist(), y.tolist(), z.tolist()))
+        result = []
+        start = 0
+        for end in ends.tolist():
+            result.append(points[start:end])
+            start = end
+        return result
+
     # ----------------------------------------------------------------------
     # Create path for one g command
+    # @param tolerance chord error of the arc linearization
     # ----------------------------------------------------------------------
-    def motionPath(self):
+    def motionPath(self, tolerance=None):
         xyz = []
 
         # Execute g-code
@@ -1565,76 +2091,7 @@ class CNC:
 
         elif self.gcode in (2, 3):  # CW=2,CCW=3 circle
             xyz.append((self.x, self.y, self.z))
-            uc, vc = self.motionCenter()
-
-            gcode = self.gcode
-            if self.plane == XY:
-                u0 = self.x
-                v0 = self.y
-                w0 = self.z
-                u1 = self.xval
-                v1 = self.yval
-                w1 = self.zval
-            elif self.plane == XZ:
-                u0 = self.x
-                v0 = self.z
-                w0 = self.y
-                u1 = self.xval
-                v1 = self.zval
-                w1 = self.yval
-                gcode = 5 - gcode  # flip 2-3 when XZ plane is used
-            else:
-                u0 = self.y
-                v0 = self.z
-                w0 = self.x
-                u1 = self.yval
-                v1 = self.zval
-                w1 = self.xval
-            phi0 = math.atan2(v0 - vc, u0 - uc)
-            phi1 = math.atan2(v1 - vc, u1 - uc)
-            try:
-                sagitta = 1.0 - CNC.accuracy / self.rval
-            except ZeroDivisionError:
-                sagitta = 0.0
-            if sagitta > 0.0:
-                df = 2.0 * math.acos(sagitta)
-                df = min(df, math.pi / 4.0)
-            else:
-                df = math.pi / 4.0
-
-            if gcode == 2:
-                if phi1 >= phi0 - 1e-10:
-                    phi1 -= 2.0 * math.pi
-                ws = (w1 - w0) / (phi1 - phi0)
-                phi = phi0 - df
-                while phi > phi1:
-                    u = uc + self.rval * math.cos(phi)
-                    v = vc + self.rval * math.sin(phi)
-                    w = w0 + (phi - phi0) * ws
-                    phi -= df
-                    if self.plane == XY:
-                        xyz.append((u, v, w))
-                    elif self.plane == XZ:
-                        xyz.append((u, w, v))
-                    else:
-                        xyz.append((w, u, v))
-            else:
-                if phi1 <= phi0 + 1e-10:
-                    phi1 += 2.0 * math.pi
-                ws = (w1 - w0) / (phi1 - phi0)
-                phi = phi0 + df
-                while phi < phi1:
-                    u = uc + self.rval * math.cos(phi)
-                    v = vc + self.rval * math.sin(phi)
-                    w = w0 + (phi - phi0) * ws
-                    phi += df
-                    if self.plane == XY:
-                        xyz.append((u, v, w))
-                    elif self.plane == XZ:
-                        xyz.append((u, w, v))
-                    else:
-                        xyz.append((w, u, v))
-
+            xyz.extend(CNC.arcPoints([self.motionArc()], tolerance)[0])
             xyz.append((self.xval, self.yval, self.zval))
 
         elif self.gcode == 4:  # Dwell
@@ -1725,45 +2182,6 @@ class CNC:
             self.dy = 0
             self.dz = drill - retract
 
-    # ----------------------------------------------------------------------
-    # Doesn't work correctly for G83 (peck drilling)
-    # ----------------------------------------------------------------------
-    def pathLength(self, block, xyz):
-        # For XY plane
-        p = xyz[0]
-        length = 0.0
-        for i in xyz:
-            length += math.sqrt(
-                (i[0] - p[0]) ** 2 + (i[1] - p[1]) ** 2 + (i[2] - p[2]) ** 2
-            )
-            p = i
-
-        if self.gcode == 0:
-            # FIXME calculate the correct time with the feed direction
-            # and acceleration
-            block.time += length / self.feedmax_x
-            self.totalTime += length / self.feedmax_x
-            block.rapid += length
-        elif ((self.gcode == 1 or self.gcode == 2 or self.gcode == 3)
-              and self.feed > 0):
-            block.time += length / self.feed
-            self.totalTime += length / self.feed
-        else:
-            try:
-                if CNC.vars["feedmode"] == 94:
-                    # Normal mode
-                    t = length / self.feed
-                elif CNC.vars["feedmode"] == 93:
-                    # Inverse mode
-                    t = length * self.feed
-                block.time += t
-                self.totalTime += t
-            except Exception:
-                pass
-            block.length += length
-
-        self.totalLength += length
-
     # ----------------------------------------------------------------------
     def pathMargins(self, block):
         if block.enable:
@@ -1794,27 +2212,15 @@ class CNC:
             cmds = CNC.compileLine(line)
             if cmds is None:
                 continue
-            if isinstance(cmds, str):
-                cmds = CNC.breakLine(cmds)
-            else:
-                # either CodeType or tuple, list[] append it as is
+            if not isinstance(cmds, str) or cmds[0] == "$":
+                # either CodeType or tuple, list[] or $ system command,
+                # append it as is
                 lines.append(cmds)
                 continue
 
-            for cmd in cmds:
-                c = cmd[0]
-                try:
-                    value = float(cmd[1:])
-                except Exception:
-                    value = 0.0
-                if c.upper() in ("F", "X", "Y", "Z", "I", "J", "K", "R", "P"):
-                    cmd = CNC.fmt(c, value)
-                else:
-                    opt = ERROR_HANDLING.get(cmd.upper(), 0)
-                    if opt == SKIP:
-                        cmd = None
-
-                if cmd is not None:
+            for c, value in CNC.compiledWords(line, cmds) or ():
+                cmd = CNC.word(c, value)
+                if ERROR_HANDLING.get(cmd, 0) != SKIP:
                     newcmd.append(cmd)
             lines.append("".join(newcmd))
         return lines
@@ -2004,6 +2410,8 @@ class CNC:
 #   - (imported shape)
 # =============================================================================
 class Block(list):
+    _version = 0  # incremented on every modification of the lines
+
     def __init__(self, name=None):
         # Copy constructor
         if isinstance(name, Block):
@@ -2025,7 +2433,7 @@ class Block(list):
         self.enable = src.enable
         self.expand = src.expand
         self.color = src.color
-        self[:] = src[:]
+        self[:] = list(src)
         self._path = []
         self.sx = src.sx
         self.sy = src.sy
@@ -2034,6 +2442,13 @@ class Block(list):
         self.ey = src.ey
         self.ez = src.ez
 
+    # ----------------------------------------------------------------------
+    # @return the lines as they are now, to read them while the block may
+    #         be modified
+    # ----------------------------------------------------------------------
+    def snapshot(self):
+        return list(self)
+
     # ----------------------------------------------------------------------
     def name(self):
         return self._name is None and "block" or self._name
@@ -2181,100 +2596,1349 @@ class Block(list):
                     f"(Block-X: {line.replace('(', '[').replace(')', ']')})\n")
 
     # ----------------------------------------------------------------------
-    # Return a dump object for pickler
+    # Return a dump object for pickler
+    # ----------------------------------------------------------------------
+    def dump(self):
+        return self.name(), self.enable, self.expand, self.color, self
+
+    # ----------------------------------------------------------------------
+    # Create a block from a dump object from unpickler
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def load(obj):
+        name, enable, expand, color, code = obj
+        block = Block(name)
+        block.enable = enable
+        block.expand = expand
+        block.color = color
+        block.extend(code)
+        return block
+
+    # ----------------------------------------------------------------------
+    # Modifications of the lines
+    # ----------------------------------------------------------------------
+    def __setitem__(self, item, value):
+        self._version += 1
+        list.__setitem__(self, item, value)
+
+    def __delitem__(self, item):
+        self._version += 1
+        list.__delitem__(self, item)
+
+    def __iadd__(self, lines):
+        self._version += 1
+        return list.__iadd__(self, lines)
+
+    def insert(self, pos, line):
+        self._version += 1
+        list.insert(self, pos, line)
+
+    def extend(self, lines):
+        self._version += 1
+        list.extend(self, lines)
+
+    def pop(self, *args):
+        self._version += 1
+        return list.pop(self, *args)
+
+    def remove(self, line):
+        self._version += 1
+        list.remove(self, line)
+
+    def clear(self):
+        self._version += 1
+        list.clear(self)
+
+    def reverse(self):
+        self._version += 1
+        list.reverse(self)
+
+    def sort(self, *args, **kwargs):
+        self._version += 1
+        list.sort(self, *args, **kwargs)
+
+    # ----------------------------------------------------------------------
+    def append(self, line):
+        self._version += 1
+        if line.startswith("(Block-"):
+            pat = BLOCKPAT.match(line)
+            if pat:
+                name, value = pat.groups()
+                value = value.strip()
+                if name == "name":
+                    self._name = value
+                    return
+                elif name == "expand":
+                    self.expand = bool(int(value))
+                    return
+                elif name == "enable":
+                    self.enable = bool(int(value))
+                    return
+                elif name == "tab":
+                    # Handled elsewhere
+                    return
+                elif name == "color":
+                    self.color = value
+                    return
+                elif name == "X":  # uncomment
+                    list.append(
+                        self, value.replace("[", "(").replace("]", ")"))
+                    return
+        if self._name is None and ("id:" in line) and ("End" not in line):
+            pat = IDPAT.match(line)
+            if pat:
+                self._name = pat.group(1)
+        list.append(self, line)
+
+    # ----------------------------------------------------------------------
+    def resetPath(self):
+        del self._path[:]
+        self.xmin = self.ymin = self.zmin = 1000000.0
+        self.xmax = self.ymax = self.zmax = -1000000.0
+        self.length = 0.0  # cut length
+        self.rapid = 0.0  # rapid length
+        self.time = 0.0
+
+    # ----------------------------------------------------------------------
+    def hasPath(self):
+        return bool(self._path)
+
+    # ----------------------------------------------------------------------
+    def addPath(self, p):
+        self._path.append(p)
+
+    # ----------------------------------------------------------------------
+    def path(self, item):
+        try:
+            return self._path[item]
+        except Exception:
+            return None
+
+    # ----------------------------------------------------------------------
+    def startPath(self, x, y, z):
+        self.sx = x
+        self.sy = y
+        self.sz = z
+
+    # ----------------------------------------------------------------------
+    def endPath(self, x, y, z):
+        self.ex = x
+        self.ey = y
+        self.ez = z
+
+    # ----------------------------------------------------------------------
+    def pathMargins(self, xyz):
+        self.xmin = min(self.xmin, min(i[0] for i in xyz))
+        self.ymin = min(self.ymin, min(i[1] for i in xyz))
+        self.zmin = min(self.zmin, min(i[2] for i in xyz))
+        self.xmax = max(self.xmax, max(i[0] for i in xyz))
+        self.ymax = max(self.ymax, max(i[1] for i in xyz))
+        self.zmax = max(self.zmax, max(i[2] for i in xyz))
+
+
+# =============================================================================
+# Block whose lines are stored outside of the list.
+# Reading is served by the subclass, while any modification materializes
+# the lines into the list and turns the object into a normal Block
+# (copy on write)
+# =============================================================================
+class FrozenBlock(Block):
+    # ----------------------------------------------------------------------
+    # @return iterator over the lines, implemented by the subclasses
+    # ----------------------------------------------------------------------
+    def lines(self):
+        raise NotImplementedError
+
+    # ----------------------------------------------------------------------
+    # Convert to a normal block holding its lines
+    # ----------------------------------------------------------------------
+    def materialize(self):
+        lines = list(self.lines())
+        self.release()
+        self.__class__ = Block
+        list.extend(self, lines)
+
+    # ----------------------------------------------------------------------
+    # Drop the external storage, once materialized
+    # ----------------------------------------------------------------------
+    def release(self):
+        pass
+
+    # ----------------------------------------------------------------------
+    # @return a block sharing the storage, which is never modified: a
+    #         modification materializes this block and releases it
+    # ----------------------------------------------------------------------
+    def snapshot(self):
+        block = self.__class__.__new__(self.__class__)
+        block.__dict__.update(self.__dict__)
+        return block
+
+    # ----------------------------------------------------------------------
+    def __iter__(self):
+        return self.lines()
+
+    def __eq__(self, other):
+        if not isinstance(other, list):
+            return NotImplemented
+        return list(self) == list(other)
+
+    __hash__ = None
+
+    def dump(self):
+        return self.name(), self.enable, self.expand, self.color, list(self)
+
+    # ----------------------------------------------------------------------
+    # Any other access materializes the block
+    # ----------------------------------------------------------------------
+    def __getitem__(self, item):
+        self.materialize()
+        return self[item]
+
+    def __contains__(self, line):
+        self.materialize()
+        return line in self
+
+    def __reversed__(self):
+        self.materialize()
+        return reversed(self)
+
+    def index(self, *args):
+        self.materialize()
+        return self.index(*args)
+
+    def count(self, line):
+        self.materialize()
+        return self.count(line)
+
+    def __setitem__(self, item, value):
+        self.materialize()
+        self[item] = value
+
+    def __delitem__(self, item):
+        if item == slice(None):
+            # nothing to materialize when deleting all the lines
+            self.release()
+            self.__class__ = Block
+        else:
+            self.materialize()
+        del self[item]
+
+    def __iadd__(self, lines):
+        self.materialize()
+        return Block.__iadd__(self, lines)
+
+    def insert(self, pos, line):
+        self.materialize()
+        self.insert(pos, line)
+
+    def extend(self, lines):
+        self.materialize()
+        self.extend(lines)
+
+    def append(self, line):
+        self.materialize()
+        self.append(line)
+
+    def pop(self, *args):
+        self.materialize()
+        return self.pop(*args)
+
+    def remove(self, line):
+        self.materialize()
+        self.remove(line)
+
+    def clear(self):
+        del self[:]
+
+    def reverse(self):
+        self.materialize()
+        self.reverse()
+
+    def sort(self, *args, **kwargs):
+        self.materialize()
+        self.sort(*args, **kwargs)
+
+
+# =============================================================================
+# Block with all its lines in one text buffer, separated by newlines, and
+# an array with the offset of every line. It needs a fraction of the
+# memory of a list of strings. Reading by index or slice doesn't
+# materialize the block
+# =============================================================================
+class CompactBlock(FrozenBlock):
+    def __init__(self, name=None, lines=()):
+        Block.__init__(self, name)
+        self._text = "\n".join(lines)
+        self._offsets = array("I", [0])
+        self._offsets.extend(
+            itertools.accumulate(len(line) + 1 for line in lines))
+
+    # ----------------------------------------------------------------------
+    # @return a compact copy of block, with the same attributes
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def fromBlock(block):
+        compact = CompactBlock(block._name, list(block))
+        compact.enable = block.enable
+        compact.expand = block.expand
+        compact.color = block.color
+        compact.sx, compact.sy, compact.sz = block.sx, block.sy, block.sz
+        compact.ex, compact.ey, compact.ez = block.ex, block.ey, block.ez
+        return compact
+
+    # ----------------------------------------------------------------------
+    def lines(self):
+        if len(self._offsets) == 1:
+            return iter(())
+        return iter(self._text.split("\n"))
+
+    # ----------------------------------------------------------------------
+    def release(self):
+        self._text = ""
+        self._offsets = None
+
+    # ----------------------------------------------------------------------
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    # ----------------------------------------------------------------------
+    def __getitem__(self, item):
+        offsets = self._offsets
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(offsets) - 1)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            if start >= stop:
+                return []
+            return self._text[offsets[start]:offsets[stop] - 1].split("\n")
+        if item < 0:
+            item += len(offsets) - 1
+        if not 0 <= item < len(offsets) - 1:
+            raise IndexError("block index out of range")
+        return self._text[offsets[item]:offsets[item + 1] - 1]
+
+    # ----------------------------------------------------------------------
+    # Pickle the attributes only, with the text buffer and offsets, and not
+    # the lines one by one
+    # ----------------------------------------------------------------------
+    def __reduce__(self):
+        return _newCompactBlock, (), self.__dict__.copy()
+
+
+# -----------------------------------------------------------------------------
+def _newCompactBlock():
+    return CompactBlock.__new__(CompactBlock)
+
+
+# =============================================================================
+# Block of a memory mapped file loaded in lazy mode
+# Only the position of the lines in the file is kept and iterating decodes
+# the lines on the fly
+# =============================================================================
+class LazyBlock(FrozenBlock):
+    def __init__(self, name, buffer, start, end, count):
+        Block.__init__(self, name)
+        self._lazy = (buffer, start, end, count)
+
+    # ----------------------------------------------------------------------
+    # Decode the lines from the file, in pieces of LAZYREAD_SIZE bytes
+    # ----------------------------------------------------------------------
+    def lines(self):
+        buffer, start, end, count = self._lazy
+        pos = start
+        while pos < end:
+            stop = min(pos + LAZYREAD_SIZE, end)
+            if stop < end:
+                eol = buffer.rfind(b"\n", pos, stop)
+                if eol < 0:
+                    eol = buffer.find(b"\n", stop, end)
+                stop = end if eol < 0 else eol + 1
+            text = buffer[pos:stop].decode(errors="replace")
+            pos = stop
+            if text.endswith("\n"):
+                text = text[:-1]
+            for line in text.split("\n"):
+                line = line.replace("\x0d", "")
+                if line.startswith("(Block-X:"):
+                    pat = BLOCKPAT.match(line)
+                    if pat:
+                        line = pat.group(2).strip()
+                        line = line.replace("[", "(").replace("]", ")")
+                yield line
+
+    # ----------------------------------------------------------------------
+    def release(self):
+        self._lazy = None
+
+    # ----------------------------------------------------------------------
+    def __len__(self):
+        return self._lazy[3]
+
+    def __eq__(self, other):
+        if isinstance(other, LazyBlock):
+            return self._lazy == other._lazy
+        return FrozenBlock.__eq__(self, other)
+
+    __hash__ = None
+
+
+# =============================================================================
+# Columnar motion table of a gcode program
+# One row per motion segment with columns:
+#   bid, lid, gcode, start xyz, end xyz, center xyz, feed, plane
+# The rows are kept in chunks, one per block, which are rebuilt only when
+# the block lines or the modal state entering the block have changed.
+# Statistics and margins are calculated as vectorized reductions on the
+# whole table
+# =============================================================================
+class MotionChunk:
+    def __init__(self, block, version, entry):
+        self.block = block
+        self.version = version
+        self.entry = entry  # modal state entering the block
+        self.exit = None  # modal state exiting the block
+        self.lid = None
+        self.gcode = None
+        self.plane = None
+        self.data = None  # start xyz, end xyz, center xyz, feed
+
+
+# =============================================================================
+class MotionTable:
+    def __init__(self):
+        self.cnc = CNC()
+        self.clear()
+
+    # ----------------------------------------------------------------------
+    def clear(self):
+        self._chunks = []
+        self.rebuilt = 0  # blocks rebuilt on last update
+        self._columns(numpy.empty((0, 10)), [])
+        self.offsets = numpy.zeros(1, numpy.int64)
+
+    # ----------------------------------------------------------------------
+    def __len__(self):
+        return len(self.gcode)
+
+    # ----------------------------------------------------------------------
+    def _columns(self, data, chunks):
+        self.bid = numpy.repeat(
+            numpy.arange(len(chunks), dtype=numpy.int32),
+            [len(c.lid) for c in chunks],
+        )
+        if chunks:
+            self.lid = numpy.concatenate([c.lid for c in chunks])
+            self.gcode = numpy.concatenate([c.gcode for c in chunks])
+            self.plane = numpy.concatenate([c.plane for c in chunks])
+        else:
+            self.lid = numpy.empty(0, numpy.int32)
+            self.gcode = numpy.empty(0, numpy.int16)
+            self.plane = numpy.empty(0, numpy.int8)
+        self.data = data
+        self.start = data[:, 0:3]
+        self.end = data[:, 3:6]
+        self.center = data[:, 6:9]
+        self.feed = data[:, 9]
+
+    # ----------------------------------------------------------------------
+    # Bring the table up to date with the blocks.
+    # Only the blocks modified or entered with a different modal state are
+    # parsed again
+    # @return number of blocks rebuilt
+    # ----------------------------------------------------------------------
+    def update(self, gcode):
+        cnc = self.cnc
+        cnc.initPath(0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        state = cnc.modalState()
+
+        old = {id(c.block): c for c in self._chunks}
+        chunks = []
+        rebuilt = 0
+        for block in gcode.blocks:
+            chunk = old.get(id(block))
+            if (chunk is None or chunk.block is not block
+                    or chunk.version != block._version
+                    or chunk.entry != state):
+                chunk = self._build(gcode, block, state)
+                rebuilt += 1
+            state = chunk.exit
+            chunks.append(chunk)
+
+        if rebuilt or len(chunks) != len(self._chunks):
+            self._chunks = chunks
+            counts = [len(c.lid) for c in chunks]
+            self.offsets = numpy.zeros(len(chunks) + 1, numpy.int64)
+            numpy.cumsum(counts, out=self.offsets[1:])
+            if chunks:
+                data = numpy.concatenate([c.data for c in chunks])
+            else:
+                data = numpy.empty((0, 10))
+            self._columns(data, chunks)
+        self.rebuilt = rebuilt
+        return rebuilt
+
+    # ----------------------------------------------------------------------
+    # @return the words of a line, evaluating any expression, or None
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def lineWords(gcode, line):
+        # plain lines don't need the expression evaluation
+        if (line and line[0] not in "%#_$" and "[" not in line
+                and "=" not in line):
+            return CNC.tokenizeLine(line)
+        try:
+            cmds = gcode.evaluate(CNC.compileLine(line))
+        except Exception:
+            return None
+        if isinstance(cmds, str):
+            return CNC.tokenizeLine(cmds)
+        return None
+
+    # ----------------------------------------------------------------------
+    # Parse one block starting from modal state
+    # ----------------------------------------------------------------------
+    def _build(self, gcode, block, state):
+        cnc = self.cnc
+        cnc.setModalState(state)
+        chunk = MotionChunk(block, block._version, state)
+        rows = []
+        for j, line in enumerate(block):
+            cmds = MotionTable.lineWords(gcode, line)
+            if not cmds:
+                continue
+
+            cnc.motionStart(cmds)
+            g = cnc.gcode
+            if g in (0, 1):
+                if (cnc.xval != cnc.x or cnc.yval != cnc.y
+                        or cnc.zval != cnc.z):
+                    rows.append((j, g, cnc.plane,
+                                 cnc.x, cnc.y, cnc.z,
+                                 cnc.xval, cnc.yval, cnc.zval,
+                                 0.0, 0.0, 0.0, cnc.feed))
+            elif g in (2, 3):
+                uc, vc = cnc.motionCenter()
+                if cnc.rval <= 0.0:
+                    # degenerate arc, drawn as a straight line
+                    if (cnc.xval != cnc.x or cnc.yval != cnc.y
+                            or cnc.zval != cnc.z):
+                        rows.append((j, 1, cnc.plane,
+                                     cnc.x, cnc.y, cnc.z,
+                                     cnc.xval, cnc.yval, cnc.zval,
+                                     0.0, 0.0, 0.0, cnc.feed))
+                    cnc.motionEnd()
+                    continue
+                if cnc.plane == XY:
+                    xc, yc, zc = uc, vc, cnc.z
+                elif cnc.plane == XZ:
+                    xc, yc, zc = uc, cnc.y, vc
+                else:
+                    xc, yc, zc = cnc.x, uc, vc
+                rows.append((j, g, cnc.plane,
+                             cnc.x, cnc.y, cnc.z,
+                             cnc.xval, cnc.yval, cnc.zval,
+                             xc, yc, zc, cnc.feed))
+            elif g in (81, 82, 83, 85, 86, 89):
+                # canned cycles as a sequence of linear segments
+                xyz = cnc.motionPath()
+                for p, q in zip(xyz, xyz[1:]):
+                    if p != q:
+                        rows.append((j, g, cnc.plane) + p + q
+                                    + (0.0, 0.0, 0.0, cnc.feed))
+            cnc.motionEnd()
+        chunk.exit = cnc.modalState()
+
+        if rows:
+            array = numpy.array(rows, numpy.float64)
+            chunk.lid = array[:, 0].astype(numpy.int32)
+            chunk.gcode = array[:, 1].astype(numpy.int16)
+            chunk.plane = array[:, 2].astype(numpy.int8)
+            chunk.data = numpy.ascontiguousarray(array[:, 3:])
+        else:
+            chunk.lid = numpy.empty(0, numpy.int32)
+            chunk.gcode = numpy.empty(0, numpy.int16)
+            chunk.plane = numpy.empty(0, numpy.int8)
+            chunk.data = numpy.empty((0, 10))
+        return chunk
+
+    # ----------------------------------------------------------------------
+    # Arc geometry in the plane of each arc row
+    # @return mask of arcs, (u, v, w) axis indices, center u,v, radius,
+    #         start angle, sweep angle (negative for CW)
+    # ----------------------------------------------------------------------
+    def _arcs(self):
+        arc = (self.gcode == 2) | (self.gcode == 3)
+        plane = self.plane[arc]
+        # axis indices of u,v,w for each plane XY, XZ, YZ
+        axes = numpy.array([[0, 1, 2], [0, 2, 1], [1, 2, 0]])[plane]
+        rows = numpy.arange(len(plane))
+        start = self.start[arc]
+        end = self.end[arc]
+        center = self.center[arc]
+        u0 = start[rows, axes[:, 0]]
+        v0 = start[rows, axes[:, 1]]
+        u1 = end[rows, axes[:, 0]]
+        v1 = end[rows, axes[:, 1]]
+        uc = center[rows, axes[:, 0]]
+        vc = center[rows, axes[:, 1]]
+        radius = numpy.hypot(u0 - uc, v0 - vc)
+        phi0 = numpy.arctan2(v0 - vc, u0 - uc)
+        phi1 = numpy.arctan2(v1 - vc, u1 - uc)
+
+        # CW arcs, with the direction flipped on the XZ plane
+        cw = (self.gcode[arc] == 2) != (plane == XZ)
+        sweep = phi1 - phi0
+        sweep[cw & (phi1 >= phi0 - 1e-10)] -= 2.0 * math.pi
+        sweep[~cw & (phi1 <= phi0 + 1e-10)] += 2.0 * math.pi
+        return arc, axes, uc, vc, radius, phi0, sweep
+
+    # ----------------------------------------------------------------------
+    # @return length of every row
+    # ----------------------------------------------------------------------
+    def lengths(self):
+        length = numpy.sqrt(((self.end - self.start) ** 2).sum(axis=1))
+        arc, axes, uc, vc, radius, phi0, sweep = self._arcs()
+        if len(radius):
+            rows = numpy.arange(len(radius))
+            dw = (self.end[arc][rows, axes[:, 2]]
+                  - self.start[arc][rows, axes[:, 2]])
+            length[arc] = numpy.hypot(radius * sweep, dw)
+        return length
+
+    # ----------------------------------------------------------------------
+    # Direction of every row
+    # @return unit vectors (N,3) of the direction entering and exiting the
+    #       row, and the usage (N,3) of each axis along the row, used to
+    #       limit the rate and the acceleration
+    # ----------------------------------------------------------------------
+    def directions(self, length):
+        delta = self.end - self.start
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            entry = delta / length[:, None]
+        entry[~numpy.isfinite(entry)] = 0.0
+        exit = entry.copy()
+        usage = numpy.abs(entry)
+
+        arc, axes, uc, vc, radius, phi0, sweep = self._arcs()
+        if len(radius):
+            rows = numpy.arange(len(radius))
+            dw = delta[arc][rows, axes[:, 2]]
+            alen = length[arc]
+            alen[alen <= 0.0] = 1.0
+            # tangents at both ends of the helix
+            for vectors, phi in (
+                (entry, phi0),
+                (exit, phi0 + sweep),
+            ):
+                tangent = numpy.zeros((len(radius), 3))
+                tangent[rows, axes[:, 0]] = -radius * sweep * numpy.sin(phi)
+                tangent[rows, axes[:, 1]] = radius * sweep * numpy.cos(phi)
+                tangent[rows, axes[:, 2]] = dw
+                vectors[arc] = tangent / alen[:, None]
+            # along an arc the plane axes move at every rate
+            ausage = numpy.zeros((len(radius), 3))
+            ausage[rows, axes[:, 0]] = 1.0
+            ausage[rows, axes[:, 1]] = 1.0
+            ausage[rows, axes[:, 2]] = numpy.abs(dw) / alen
+            usage[arc] = ausage
+        return entry, exit, usage
+
+    # ----------------------------------------------------------------------
+    # Estimate the time of every row like the grbl planner does.
+    # Each row is limited by the max rate and acceleration of the axes
+    # it moves, the arcs by their segmentation and the speed at the
+    # junctions by the junction deviation.
+    # The backward and forward passes of the planner
+    #       v[k]^2 <= v[k+1]^2 + 2 a L
+    #       v[k+1]^2 <= v[k]^2 + 2 a L
+    # are solved at once as running minimums over the cumulative 2aL,
+    # then each row is timed with a trapezoidal speed profile.
+    # @return time of every row in minutes
+    # ----------------------------------------------------------------------
+    def times(self, length=None):
+        if length is None:
+            length = self.lengths()
+        time = numpy.zeros(len(length))
+        # rows with no feed (e.g. inverse time) are not timed, as before
+        timed = (self.gcode == 0) | (self.feed > 0.0)
+        timed &= length > 0.0
+        if not timed.any():
+            return time
+
+        rate, acceleration, junction, tolerance = CNC.machineLimits()
+        rate = numpy.array(rate) / 60.0  # units/s
+        acceleration = numpy.array(acceleration)
+
+        entry, exit, usage = self.directions(length)
+        entry = entry[timed]
+        exit = exit[timed]
+        usage = usage[timed]
+        length = length[timed]
+
+        def limit(values, vectors):
+            with numpy.errstate(divide="ignore"):
+                return (values / vectors).min(axis=1)
+
+        nominal = limit(rate, usage)
+        accel = limit(acceleration, usage)
+        rapid = self.gcode[timed] == 0
+        nominal[~rapid] = numpy.minimum(
+            nominal[~rapid], self.feed[timed][~rapid] / 60.0)
+
+        # arcs are followed as chords of the arc tolerance, where the
+        # junction deviation limits the speed to sqrt(a r jd / tol)
+        arc, axes, uc, vc, radius, phi0, sweep = self._arcs()
+        if len(radius) and tolerance > 0.0:
+            arcspeed = numpy.full(len(arc), numpy.inf)
+            arcspeed[arc] = numpy.sqrt(radius * junction / tolerance)
+            arcspeed = arcspeed[timed] * numpy.sqrt(accel)
+            nominal = numpy.minimum(nominal, arcspeed)
+
+        # max entry speed^2 of every junction, at rest on the ends
+        n = len(length)
+        limit2 = numpy.zeros(n + 1)
+        if n > 1:
+            prev = exit[:-1]
+            curr = entry[1:]
+            cos = -(prev * curr).sum(axis=1)
+            direction = curr - prev
+            norm = numpy.sqrt((direction ** 2).sum(axis=1))
+            norm[norm <= 0.0] = 1.0
+            jaccel = limit(acceleration, numpy.abs(direction) / norm[:, None])
+            sin2 = numpy.sqrt(numpy.clip(0.5 * (1.0 - cos), 0.0, 1.0))
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                vj2 = jaccel * junction * sin2 / (1.0 - sin2)
+            vj2[cos > 0.999999] = 0.0  # reversal
+            vj2[cos < -0.999999] = numpy.inf  # straight
+            vj2 = numpy.minimum(vj2, numpy.minimum(nominal[:-1],
+                                                   nominal[1:]) ** 2)
+            # positions jumping between rows (G28, G92...) stop the machine
+            jump = numpy.abs(self.end[timed][:-1]
+                             - self.start[timed][1:]).max(axis=1) > 1e-6
+            vj2[jump] = 0.0
+            limit2[1:-1] = vj2
+
+        # backward and forward passes
+        distance = numpy.zeros(n + 1)
+        numpy.cumsum(2.0 * accel * length, out=distance[1:])
+        backward = (numpy.minimum.accumulate((limit2 + distance)[::-1])[::-1]
+                    - distance)
+        speed2 = distance + numpy.minimum.accumulate(backward - distance)
+        speed2 = numpy.clip(speed2, 0.0, None)
+        v0 = numpy.sqrt(numpy.minimum(speed2[:-1], nominal ** 2))
+        v1 = numpy.sqrt(numpy.minimum(speed2[1:], nominal ** 2))
+
+        # trapezoid, or triangle when the nominal speed is not reached
+        accelerate = (nominal ** 2 - v0 ** 2) / (2.0 * accel)
+        decelerate = (nominal ** 2 - v1 ** 2) / (2.0 * accel)
+        cruise = length - accelerate - decelerate
+        peak = numpy.sqrt(numpy.maximum(
+            (2.0 * accel * length + v0 ** 2 + v1 ** 2) / 2.0,
+            numpy.maximum(v0, v1) ** 2))
+        peak = numpy.where(cruise >= 0.0, nominal, peak)
+        seconds = (2.0 * peak - v0 - v1) / accel
+        seconds += numpy.maximum(cruise, 0.0) / nominal
+        time[timed] = seconds / 60.0
+        return time
+
+    # ----------------------------------------------------------------------
+    # @return min and max arrays (N,3) of the extents of every row
+    # ----------------------------------------------------------------------
+    def extents(self):
+        low = numpy.minimum(self.start, self.end)
+        high = numpy.maximum(self.start, self.end)
+        arc, axes, uc, vc, radius, phi0, sweep = self._arcs()
+        if len(radius):
+            rows = numpy.arange(len(radius))
+            alow = low[arc]
+            ahigh = high[arc]
+            # extend to the quadrant points within the sweep
+            for angle, axis, center, sign in (
+                (0.0, 0, uc, 1.0),
+                (0.5 * math.pi, 1, vc, 1.0),
+                (math.pi, 0, uc, -1.0),
+                (1.5 * math.pi, 1, vc, -1.0),
+            ):
+                inside = numpy.where(
+                    sweep > 0.0,
+                    numpy.mod(angle - phi0, 2.0 * math.pi) <= sweep,
+                    numpy.mod(phi0 - angle, 2.0 * math.pi) <= -sweep,
+                )
+                r = rows[inside]
+                col = axes[inside, axis]
+                value = center[inside] + sign * radius[inside]
+                if sign > 0.0:
+                    ahigh[r, col] = numpy.maximum(ahigh[r, col], value)
+                else:
+                    alow[r, col] = numpy.minimum(alow[r, col], value)
+            low[arc] = alow
+            high[arc] = ahigh
+        return low, high
+
+    # ----------------------------------------------------------------------
+    # Per block statistics
+    # @return dictionary of arrays with one entry per block:
+    #       xmin,ymin,zmin,xmax,ymax,zmax of the cutting moves,
+    #       length (cutting), rapid, time
+    # ----------------------------------------------------------------------
+    def blockStatistics(self):
+        nblocks = len(self._chunks)
+        length = self.lengths()
+        time = self.times(length)
+        rapid = self.gcode == 0
+        stats = {
+            "length": numpy.bincount(
+                self.bid, numpy.where(rapid, 0.0, length), nblocks),
+            "rapid": numpy.bincount(
+                self.bid, numpy.where(rapid, length, 0.0), nblocks),
+            "time": numpy.bincount(self.bid, time, nblocks),
+        }
+
+        # margins only of the cutting moves
+        low, high = self.extents()
+        cut = (self.gcode == 1) | (self.gcode == 2) | (self.gcode == 3)
+        low[~cut] = numpy.inf
+        high[~cut] = -numpy.inf
+        bmin = numpy.full((nblocks, 3), numpy.inf)
+        bmax = numpy.full((nblocks, 3), -numpy.inf)
+        starts = self.offsets[:-1]
+        full = self.offsets[1:] > starts
+        if full.any():
+            bmin[full] = numpy.minimum.reduceat(low, starts[full], axis=0)
+            bmax[full] = numpy.maximum.reduceat(high, starts[full], axis=0)
+        bmin[numpy.isinf(bmin)] = 1000000.0
+        bmax[numpy.isinf(bmax)] = -1000000.0
+        for i, c in enumerate("xyz"):
+            stats[c + "min"] = bmin[:, i]
+            stats[c + "max"] = bmax[:, i]
+        stats["totalLength"] = float(length.sum())
+        stats["totalTime"] = float(time.sum())
+        return stats
+
+
+# =============================================================================
+# Modal state of the machine not followed by the CNC class while parsing:
+# motion mode, work coordinate system, feed mode, spindle, coolant and tool
+# length offset. Together with CNC.modalState() it is what the controller
+# needs to know to continue a program from any line
+# =============================================================================
+class MachineModal:
+    __slots__ = ("motion", "wcs", "feedmode", "spindle", "speed",
+                 "mist", "flood", "tlo")
+
+    def __init__(self, state=None):
+        if state is None:
+            self.motion = None
+            self.wcs = 54.0
+            self.feedmode = 94
+            self.spindle = 5
+            self.speed = 0.0
+            self.mist = False
+            self.flood = False
+            self.tlo = None  # G43.1 offset, None for G49
+        else:
+            self.motion, self.wcs, self.feedmode, self.spindle, \
+                self.speed, self.mist, self.flood, self.tlo = state
+
+    # ----------------------------------------------------------------------
+    def state(self):
+        return (self.motion, self.wcs, self.feedmode, self.spindle,
+                self.speed, self.mist, self.flood, self.tlo)
+
+    # ----------------------------------------------------------------------
+    # Follow the words of a line, unit is the one of the CNC parsing it
+    # ----------------------------------------------------------------------
+    def update(self, cmds, unit):
+        tlo = False
+        for c, value in cmds:
+            if c == "G":
+                if value in (0, 1, 2, 3) or 80 <= value <= 89:
+                    self.motion = int(value)
+                elif 54 <= value < 60:
+                    self.wcs = value
+                elif value in (93, 94, 95):
+                    self.feedmode = int(value)
+                elif value == 49:
+                    self.tlo = None
+                elif abs(value - 43.1) < 0.01:
+                    tlo = True
+            elif c == "M":
+                m = int(value)
+                if m in (3, 4, 5):
+                    self.spindle = m
+                elif m == 7:
+                    self.mist = True
+                elif m == 8:
+                    self.flood = True
+                elif m == 9:
+                    self.mist = self.flood = False
+                elif m in (2, 30):  # program end
+                    self.wcs = 54.0
+                    self.feedmode = 94
+                    self.spindle = 5
+                    self.mist = self.flood = False
+            elif c == "S":
+                self.speed = value
+        if tlo:
+            for c, value in cmds:
+                if c == "Z":
+                    self.tlo = value * unit
+
+
+# =============================================================================
+# Modal state checkpoints, to resume a program from any line without
+# parsing it from the beginning. One chunk per block with the state entering
+# the block and every CHECKPOINT_LINES lines inside it, rebuilt like the
+# MotionTable only when the block or the state entering it has changed.
+# The state is the tuple (CNC.modalState(), MachineModal.state())
+# =============================================================================
+class CheckpointChunk:
+    def __init__(self, block, version, entry):
+        self.block = block
+        self.version = version
+        self.entry = entry
+        self.exit = None
+        self.lids = []  # lines of the checkpoints
+        self.states = []  # state entering each of the lines
+
+
+# =============================================================================
+class Checkpoints:
+    def __init__(self):
+        self.cnc = CNC()
+        self.clear()
+
+    # ----------------------------------------------------------------------
+    def clear(self):
+        self._chunks = []
+
+    # ----------------------------------------------------------------------
+    # Bring the checkpoints up to date with the enabled blocks, following
+    # them in the order they are compiled
+    # ----------------------------------------------------------------------
+    def update(self, gcode):
+        cnc = self.cnc
+        cnc.initPath(0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        state = (cnc.modalState(), MachineModal().state())
+
+        old = {id(c.block): c for c in self._chunks if c is not None}
+        chunks = []
+        for block in gcode.blocks:
+            if not block.enable:
+                chunks.append(None)
+                continue
+            chunk = old.get(id(block))
+            if (chunk is None or chunk.block is not block
+                    or chunk.version != block._version
+                    or chunk.entry != state):
+                chunk = self._build(gcode, block, state)
+            state = chunk.exit
+            chunks.append(chunk)
+        self._chunks = chunks
+
+    # ----------------------------------------------------------------------
+    # Parse lines first to last-1 of a block from state
+    # @return state entering line last
+    # ----------------------------------------------------------------------
+    def _replay(self, gcode, block, first, last, state, chunk=None):
+        cnc = self.cnc
+        cnc.setModalState(state[0])
+        modal = MachineModal(state[1])
+        for j in range(first, last):
+            if chunk is not None and j % CHECKPOINT_LINES == 0:
+                chunk.lids.append(j)
+                chunk.states.append((cnc.modalState(), modal.state()))
+            cmds = MotionTable.lineWords(gcode, block[j])
+            if not cmds:
+                continue
+            cnc.motionStart(cmds)
+            modal.update(cmds, cnc.unit)
+            cnc.motionEnd()
+        return cnc.modalState(), modal.state()
+
+    # ----------------------------------------------------------------------
+    def _build(self, gcode, block, state):
+        chunk = CheckpointChunk(block, block._version, state)
+        chunk.exit = self._replay(gcode, block, 0, len(block), state, chunk)
+        return chunk
+
+    # ----------------------------------------------------------------------
+    # @return state entering line lid of block bid, parsing at most
+    #         CHECKPOINT_LINES lines from the nearest checkpoint
+    # ----------------------------------------------------------------------
+    def state(self, gcode, bid, lid):
+        self.update(gcode)
+        chunk = self._chunks[bid]
+        if chunk is None:
+            raise ValueError(f"Block {bid + 1} is disabled")
+        if not chunk.lids:
+            return chunk.entry
+        k = max(0, min(lid // CHECKPOINT_LINES, len(chunk.lids) - 1))
+        return self._replay(gcode, chunk.block, chunk.lids[k], lid,
+                            chunk.states[k])
+
+
+# =============================================================================
+# Reduce the size of the g-code streamed to the controller.
+# Drops the words repeating the modal state (motion mode, feed, spindle and
+# the unchanged coordinates of linear moves) and rounds the coordinates of
+# the linear moves to the machine resolution from the $100-$102 steps/mm.
+# Any line with a word changing the coordinates or the modes in a way not
+# tracked here (G28, G53, G92, G10, G38.x, canned cycles, units...) or a
+# macro is passed unchanged and resets the tracked state
+# =============================================================================
+class StreamReducer:
+    TRACKED = set("GXYZFSMNIJKRT")
+
+    def __init__(self):
+        self.digits = [self._digits(100 + i) for i in range(3)]
+        self.absolute = None  # G90/G91, unknown at start
+        self.inverse = False  # G93 inverse time requires F on every line
+        self.sent = 0  # bytes sent
+        self.saved = 0  # bytes removed
+        self.reset()
+
+    # ----------------------------------------------------------------------
+    # Decimal digits required by the resolution of an axis
     # ----------------------------------------------------------------------
-    def dump(self):
-        return self.name(), self.enable, self.expand, self.color, self
+    @staticmethod
+    def _digits(n):
+        try:
+            resolution = 1.0 / float(CNC.vars[f"grbl_{n}"])
+        except (KeyError, TypeError, ValueError, ZeroDivisionError):
+            return CNC.digits
+        if CNC.inch:
+            resolution /= 25.4
+        digits = math.ceil(-math.log10(resolution) - 1e-9)
+        return max(0, min(CNC.digits, digits))
 
     # ----------------------------------------------------------------------
-    # Create a block from a dump object from unpickler
+    # Forget the motion mode, feed, spindle and position
     # ----------------------------------------------------------------------
-    @staticmethod
-    def load(obj):
-        name, enable, expand, color, code = obj
-        block = Block(name)
-        block.enable = enable
-        block.expand = expand
-        block.color = color
-        block.extend(code)
-        return block
+    def reset(self):
+        self.motion = None
+        self.feed = None
+        self.spindle = None
+        self.position = [None, None, None]
 
     # ----------------------------------------------------------------------
-    def append(self, line):
-        if line.startswith("(Block-"):
-            pat = BLOCKPAT.match(line)
-            if pat:
-                name, value = pat.groups()
-                value = value.strip()
-                if name == "name":
-                    self._name = value
-                    return
-                elif name == "expand":
-                    self.expand = bool(int(value))
-                    return
-                elif name == "enable":
-                    self.enable = bool(int(value))
-                    return
-                elif name == "tab":
-                    # Handled elsewhere
-                    return
-                elif name == "color":
-                    self.color = value
-                    return
-                elif name == "X":  # uncomment
-                    list.append(
-                        self, value.replace("[", "(").replace("]", ")"))
-                    return
-        if self._name is None and ("id:" in line) and ("End" not in line):
-            pat = IDPAT.match(line)
-            if pat:
-                self._name = pat.group(1)
-        list.append(self, line)
+    # @return the reduced list of words of a line, None if the whole line
+    #         is redundant
+    # ----------------------------------------------------------------------
+    def reduceWords(self, words):
+        motion = self.motion
+        for c, value in words:
+            if c == "G":
+                if value in (0.0, 1.0, 2.0, 3.0):
+                    motion = value
+                    continue
+                elif value == 90.0:
+                    self.absolute = True
+                    continue
+                elif value == 91.0:
+                    self.absolute = False
+                    continue
+                elif value == 93.0:
+                    self.inverse = True
+                    continue
+                elif value == 94.0:
+                    self.inverse = False
+                    continue
+                elif value in (17.0, 18.0, 19.0, 40.0, 49.0):
+                    continue
+            elif c == "M":
+                # program end resets the modes of the controller
+                if value not in (2.0, 30.0):
+                    continue
+            elif c in self.TRACKED:
+                continue
+            self.reset()
+            return words
+
+        linear = motion in (0.0, 1.0)
+        reduced = []
+        saved = 0
+        for c, value in words:
+            if c == "G":
+                if value in (0.0, 1.0, 2.0, 3.0):
+                    if value == self.motion:
+                        saved += len(CNC.word(c, value))
+                        continue
+                    self.motion = value
+            elif c == "F":
+                if value == self.feed and not self.inverse:
+                    saved += len(CNC.word(c, value))
+                    continue
+                self.feed = value
+            elif c == "S":
+                if value == self.spindle:
+                    saved += len(CNC.word(c, value))
+                    continue
+                self.spindle = value
+            elif c in "XYZ":
+                axis = "XYZ".index(c)
+                if self.absolute and linear:
+                    trimmed = round(value, self.digits[axis])
+                    if trimmed == self.position[axis]:
+                        saved += len(CNC.word(c, value))
+                        continue
+                    saved += len(CNC.word(c, value))
+                    saved -= len(CNC.word(c, trimmed))
+                    self.position[axis] = value = trimmed
+                elif self.absolute:
+                    # arcs keep their exact end points
+                    self.position[axis] = round(value, CNC.digits)
+                else:
+                    self.position[axis] = None
+                    if linear and self.absolute is False and value == 0.0:
+                        saved += len(CNC.word(c, value))
+                        continue
+            reduced.append((c, value))
+        if not reduced:
+            saved += 1  # newline
+        self.saved += saved
+        return reduced or None
 
     # ----------------------------------------------------------------------
-    def resetPath(self):
-        del self._path[:]
-        self.xmin = self.ymin = self.zmin = 1000000.0
-        self.xmax = self.ymax = self.zmax = -1000000.0
-        self.length = 0.0  # cut length
-        self.rapid = 0.0  # rapid length
-        self.time = 0.0
+    # @return the reduced text of a line, "" if the whole line is redundant
+    # ----------------------------------------------------------------------
+    def reduceLine(self, line):
+        if not line or line[0] == "$":
+            self.reset()
+            return line
+        words = CNC._tokenizeLine(line)
+        if not words:
+            return line
+        saved = self.saved
+        words = self.reduceWords(words)
+        if words is None:
+            self.saved = saved + len(line) + 1
+            return ""
+        text = "".join([CNC.word(c, value) for c, value in words])
+        self.saved = saved + len(line) - len(text)
+        return text
+
+    # ----------------------------------------------------------------------
+    def report(self):
+        total = self.sent + self.saved
+        percent = 100.0 * self.saved / total if total else 0.0
+        return (
+            f"Stream: {self.sent} bytes sent, "
+            f"{self.saved} bytes saved ({percent:.1f}%)"
+        )
+
+
+# =============================================================================
+# Fit on the fly runs of G1 segments lying on a circle, in the XY plane,
+# with G2/G3 arcs within a tolerance, while compiling for streaming.
+# The program itself is left untouched
+# =============================================================================
+class ArcFitter:
+    WORDS = set("GXYZF")
+
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.run = []  # (words, path, x, y) of the segments of the run
+        self.start = None  # x,y where the run starts
+        self.state = None  # z, feed, unit, arcabsolute of the run
+        self.fit = None  # xc, yc, ccw of the run if fitting an arc
+        self.modal = False  # arc emitted, the modal motion must be restored
+        self.feedmode = 94  # G93/G94/G95 of the lines compiled
+        self.lines = 0  # lines fitted in arcs
+        self.arcs = 0  # arcs generated
 
     # ----------------------------------------------------------------------
-    def hasPath(self):
-        return bool(self._path)
+    # Follow the feed mode, which is not kept by the CNC class
+    # ----------------------------------------------------------------------
+    def track(self, words):
+        for c, value in words or ():
+            if c == "G" and value in (93.0, 94.0, 95.0):
+                self.feedmode = int(value)
 
     # ----------------------------------------------------------------------
-    def addPath(self, p):
-        self._path.append(p)
+    # @return True if the motion just started on cnc can be fitted
+    # ----------------------------------------------------------------------
+    def accepts(self, cnc, words):
+        self.track(words)
+        if (cnc.gcode != 1 or cnc.plane != XY or not cnc.absolute
+                or cnc.zval != cnc.z or self.feedmode != 94
+                or (cnc.xval == cnc.x and cnc.yval == cnc.y)):
+            return False
+        for c, value in words:
+            if c not in self.WORDS or (c == "G" and value != 1.0):
+                return False
+        return True
 
     # ----------------------------------------------------------------------
-    def path(self, item):
-        try:
-            return self._path[item]
-        except Exception:
-            return None
+    # Add the segment started on cnc to the run
+    # @return list of (words, path) to send
+    # ----------------------------------------------------------------------
+    def push(self, cnc, words, path):
+        state = (cnc.z, cnc.feed, cnc.unit, cnc.arcabsolute)
+        out = []
+        if self.run and (state != self.state
+                         or (cnc.x, cnc.y) != self.run[-1][2:]):
+            out = self.flush()
+        if not self.run:
+            self.start = (cnc.x, cnc.y)
+            self.state = state
+        out.extend(self._add((words, path, cnc.xval, cnc.yval)))
+        return out
 
     # ----------------------------------------------------------------------
-    def startPath(self, x, y, z):
-        self.sx = x
-        self.sy = y
-        self.sz = z
+    def _add(self, segment):
+        self.run.append(segment)
+        if len(self.run) < 2:
+            self.fit = None
+            return []
+        fit = self._fit()
+        if fit is not None:
+            self.fit = fit
+            if len(self.run) >= ARCFIT_MAX:
+                return self.flush()
+            return []
+
+        # the new segment breaks the run
+        self.run.pop()
+        if self.fit is not None and len(self.run) >= ARCFIT_MIN:
+            out = [self._arc()]
+            self.start = self.run[-1][2:]
+            self.run = [segment]
+            self.fit = None
+            return out
+
+        # too short for an arc, send the first segment and try again
+        first = self.run.pop(0)
+        out = [self._line(first)]
+        self.start = first[2:]
+        pending = self.run + [segment]
+        self.run = []
+        self.fit = None
+        for s in pending:
+            out.extend(self._add(s))
+        return out
 
     # ----------------------------------------------------------------------
-    def endPath(self, x, y, z):
-        self.ex = x
-        self.ey = y
-        self.ez = z
+    # Send the pending run
+    # @return list of (words, path) to send
+    # ----------------------------------------------------------------------
+    def flush(self):
+        if not self.run:
+            return []
+        if self.fit is not None and len(self.run) >= ARCFIT_MIN:
+            out = [self._arc()]
+        else:
+            out = [self._line(s) for s in self.run]
+        self.start = self.run[-1][2:]
+        self.run = []
+        self.fit = None
+        return out
+
+    # ----------------------------------------------------------------------
+    # Restore the modal motion of a line sent after an arc
+    # ----------------------------------------------------------------------
+    def restore(self, cnc, words):
+        if not self.modal:
+            return words
+        axes = False
+        for c, value in words:
+            if c == "G" and (value in (0.0, 1.0, 2.0, 3.0, 80.0)
+                             or 38.0 <= value < 39.0
+                             or 81.0 <= value <= 89.0):
+                self.modal = False
+                return words
+            if c in "XYZABC":
+                axes = True
+        if axes and cnc.gcode is not None:
+            self.modal = False
+            return [("G", float(cnc.gcode))] + list(words)
+        return words
+
+    # ----------------------------------------------------------------------
+    def _line(self, segment):
+        words, path = segment[:2]
+        if self.modal:
+            self.modal = False
+            if ("G", 1.0) not in words:
+                words = [("G", 1.0)] + list(words)
+        return words, path
+
+    # ----------------------------------------------------------------------
+    def _arc(self):
+        xc, yc, ccw = self.fit
+        x0, y0 = self.start
+        x1, y1 = self.run[-1][2:]
+        z, feed, unit, arcabsolute = self.state
+        if arcabsolute:
+            i, j = xc, yc
+        else:
+            i, j = xc - x0, yc - y0
+        words = [
+            ("G", 3.0 if ccw else 2.0),
+            ("X", x1 / unit),
+            ("Y", y1 / unit),
+            ("I", i / unit),
+            ("J", j / unit),
+        ]
+        for segment in self.run:
+            for c, value in segment[0]:
+                if c == "F":
+                    words.append((c, value))
+                    break
+            else:
+                continue
+            break
+        self.lines += len(self.run)
+        self.arcs += 1
+        self.modal = True
+        return words, self.run[-1][1]
+
+    # ----------------------------------------------------------------------
+    # Circle through the start, middle and end points of the run
+    # @return xc, yc, ccw if all the segments lie on it within tolerance
+    # ----------------------------------------------------------------------
+    def _fit(self):
+        points = [self.start] + [s[2:] for s in self.run]
+        ax, ay = points[0]
+        bx, by = points[len(points) // 2]
+        cx, cy = points[-1]
+        d = 2.0 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+        if abs(d) < 1e-12:
+            return None
+        a2 = ax * ax + ay * ay
+        b2 = bx * bx + by * by
+        c2 = cx * cx + cy * cy
+        xc = (a2 * (by - cy) + b2 * (cy - ay) + c2 * (ay - by)) / d
+        yc = (a2 * (cx - bx) + b2 * (ax - cx) + c2 * (bx - ax)) / d
+        r = math.hypot(ax - xc, ay - yc)
+        if r > ARCFIT_RADIUS:
+            return None
+
+        tolerance = self.tolerance
+        ccw = d > 0.0
+        sweep = 0.0
+        px, py = ax - xc, ay - yc
+        for x, y in points[1:]:
+            qx, qy = x - xc, y - yc
+            if abs(math.hypot(qx, qy) - r) > tolerance:
+                return None
+            cross = px * qy - py * qx
+            if (cross > 0.0) != ccw or cross == 0.0:
+                return None
+            # distance of the chord from the arc
+            if r - 0.5 * math.hypot(px + qx, py + qy) > tolerance:
+                return None
+            sweep += math.atan2(abs(cross), px * qx + py * qy)
+            px, py = qx, qy
+        if sweep >= 2.0 * math.pi - 1e-6:
+            return None
+        return xc, yc, ccw
 
     # ----------------------------------------------------------------------
-    def pathMargins(self, xyz):
-        self.xmin = min(self.xmin, min(i[0] for i in xyz))
-        self.ymin = min(self.ymin, min(i[1] for i in xyz))
-        self.zmin = min(self.zmin, min(i[2] for i in xyz))
-        self.xmax = max(self.xmax, max(i[0] for i in xyz))
-        self.ymax = max(self.ymax, max(i[1] for i in xyz))
-        self.zmax = max(self.zmax, max(i[2] for i in xyz))
+    def report(self):
+        return (
+            f"Arc fit: {self.lines} lines replaced by {self.arcs} arcs"
+        )
 
 
 # =============================================================================
@@ -2291,7 +3955,13 @@ class GCode:
         self.undoredo = undo.UndoRedo()
         self.probe = Probe()
         self.orient = Orient()
+        self.reducer = None  # stream reducer of the last compile
+        self.fitter = None  # arc fitter of the last compile
         self.vars = {}  # local variables
+        self.motionTable = MotionTable()
+        self.checkpoints = Checkpoints()
+        self.stats = None  # per block statistics from the motion table
+        self.streamCnc = CNC()  # motion state of iterCompile
         self.init()
 
     # ----------------------------------------------------------------------
@@ -2300,22 +3970,164 @@ class GCode:
         self.blocks = []  # list of blocks
         self.vars.clear()
         self.undoredo.reset()
+        self.motionTable.clear()
+        self.checkpoints.clear()
+        self.stats = None
+        self.progress = 0  # bytes or items loaded so far
+        self.progressMax = 0  # total to load, 0 if unknown
+        self._cancel = False
         self._lastModified = 0
         self._modified = False
 
+    # ----------------------------------------------------------------------
+    # Request to stop a load running in another thread
+    # ----------------------------------------------------------------------
+    def cancelLoad(self):
+        self._cancel = True
+
+    # ----------------------------------------------------------------------
+    def isCancelled(self):
+        return self._cancel
+
+    # ----------------------------------------------------------------------
+    # Take over the program of another GCode, loaded in the background
+    # ----------------------------------------------------------------------
+    def assign(self, gcode):
+        self.filename = gcode.filename
+        self.blocks = gcode.blocks
+        self.vars.clear()
+        self.vars.update(gcode.vars)
+        self.undoredo.reset()
+        self.motionTable = gcode.motionTable
+        self.checkpoints = gcode.checkpoints
+        self.stats = gcode.stats
+        self._lastModified = gcode._lastModified
+        self._modified = False
+        self.calculateMargins()
+
+    # ----------------------------------------------------------------------
+    # Update the motion table and recalculate from it the statistics of
+    # the blocks, the total length and time and the path margins.
+    # A lazily loaded program is never parsed as a whole, it has no motion
+    # table and its margins are those of the blocks drawn so far
+    # ----------------------------------------------------------------------
+    def calculateMargins(self):
+        CNC.lineCache.fit(sum(len(block) for block in self.blocks))
+        if self.isLazy():
+            self.motionTable.clear()
+            self.stats = None
+            self.cnc.totalLength = sum(block.length for block in self.blocks)
+            self.cnc.totalTime = sum(block.time for block in self.blocks)
+            self.cnc.resetAllMargins()
+            for block in self.blocks:
+                self.cnc.pathMargins(block)
+            return
+
+        self.motionTable.update(self)
+        self.stats = stats = self.motionTable.blockStatistics()
+        for i, block in enumerate(self.blocks):
+            block.xmin = stats["xmin"][i]
+            block.ymin = stats["ymin"][i]
+            block.zmin = stats["zmin"][i]
+            block.xmax = stats["xmax"][i]
+            block.ymax = stats["ymax"][i]
+            block.zmax = stats["zmax"][i]
+            block.length = stats["length"][i]
+            block.rapid = stats["rapid"][i]
+            block.time = stats["time"][i]
+        self.cnc.totalLength = stats["totalLength"]
+        self.cnc.totalTime = stats["totalTime"]
+
+        self.cnc.resetAllMargins()
+        if self.blocks:
+            for c in "xyz":
+                CNC.vars[f"a{c}min"] = float(stats[f"{c}min"].min())
+                CNC.vars[f"a{c}max"] = float(stats[f"{c}max"].max())
+        self.calculateEnableMargins()
+
+    # ----------------------------------------------------------------------
+    # @return mask of the enabled blocks
+    # ----------------------------------------------------------------------
+    def enabledBlocks(self):
+        return numpy.fromiter(
+            (block.enable for block in self.blocks), bool, len(self.blocks))
+
+    # ----------------------------------------------------------------------
+    # @return number, cutting length, rapid length and time of the
+    #       enabled blocks
+    # ----------------------------------------------------------------------
+    def enabledStatistics(self):
+        if self.stats is None or len(self.stats["time"]) != len(self.blocks):
+            self.calculateMargins()
+        if self.stats is None:
+            blocks = [block for block in self.blocks if block.enable]
+            return (
+                len(blocks),
+                sum(block.length for block in blocks),
+                sum(block.rapid for block in blocks),
+                sum(block.time for block in blocks),
+            )
+        enable = self.enabledBlocks()
+        return (
+            int(enable.sum()),
+            float(self.stats["length"][enable].sum()),
+            float(self.stats["rapid"][enable].sum()),
+            float(self.stats["time"][enable].sum()),
+        )
+
+    # ----------------------------------------------------------------------
+    # Estimated time to run the enabled blocks
+    # @return sorted keys (block << 32 | line) of the motion lines and the
+    #         cumulative time in seconds at the end of each one, both empty
+    #         for a lazily loaded program
+    # ----------------------------------------------------------------------
+    def timeline(self):
+        if self.isLazy():
+            return numpy.empty(0, numpy.int64), numpy.empty(0)
+        table = self.motionTable
+        table.update(self)
+        keys = (table.bid.astype(numpy.int64) << 32) | table.lid
+        times = table.times() * 60.0
+        times[~self.enabledBlocks()[table.bid]] = 0.0
+        return keys, numpy.cumsum(times)
+
+    # ----------------------------------------------------------------------
+    # @param path (block, line) executed last, None for the whole time
+    # @return estimated time in seconds left after path
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def timeLeft(timeline, path=None):
+        keys, cumulative = timeline
+        if not len(keys):
+            return 0.0
+        if path is not None:
+            k = numpy.searchsorted(keys, (path[0] << 32) | path[1], "right")
+            if k > 0:
+                return float(cumulative[-1] - cumulative[k - 1])
+        return float(cumulative[-1])
+
     # ----------------------------------------------------------------------
     # Recalculate enabled path margins
     # ----------------------------------------------------------------------
     def calculateEnableMargins(self):
         self.cnc.resetEnableMargins()
-        for block in self.blocks:
-            if block.enable:
-                CNC.vars["xmin"] = min(CNC.vars["xmin"], block.xmin)
-                CNC.vars["ymin"] = min(CNC.vars["ymin"], block.ymin)
-                CNC.vars["zmin"] = min(CNC.vars["zmin"], block.zmin)
-                CNC.vars["xmax"] = max(CNC.vars["xmax"], block.xmax)
-                CNC.vars["ymax"] = max(CNC.vars["ymax"], block.ymax)
-                CNC.vars["zmax"] = max(CNC.vars["zmax"], block.zmax)
+        stats = self.stats
+        if stats is None or len(stats["xmin"]) != len(self.blocks):
+            for block in self.blocks:
+                if block.enable:
+                    CNC.vars["xmin"] = min(CNC.vars["xmin"], block.xmin)
+                    CNC.vars["ymin"] = min(CNC.vars["ymin"], block.ymin)
+                    CNC.vars["zmin"] = min(CNC.vars["zmin"], block.zmin)
+                    CNC.vars["xmax"] = max(CNC.vars["xmax"], block.xmax)
+                    CNC.vars["ymax"] = max(CNC.vars["ymax"], block.ymax)
+                    CNC.vars["zmax"] = max(CNC.vars["zmax"], block.zmax)
+            return
+
+        enable = self.enabledBlocks()
+        if enable.any():
+            for c in "xyz":
+                CNC.vars[f"{c}min"] = float(stats[f"{c}min"][enable].min())
+                CNC.vars[f"{c}max"] = float(stats[f"{c}max"][enable].max())
 
     # ----------------------------------------------------------------------
     def isModified(self):
@@ -2343,7 +4155,7 @@ class GCode:
         elif isinstance(line, list):
             for i, expr in enumerate(line):
                 if isinstance(expr, types.CodeType):
-                    result = eval(expr, CNC.vars, self.vars)
+                    result = eval(expr, CNC.vars.dict(), self.vars)
                     if isinstance(result, float):
                         line[i] = str(round(result, CNC.digits))
                     else:
@@ -2356,7 +4168,7 @@ class GCode:
             v = self.vars
             v["os"] = os
             v["app"] = app
-            return eval(line, CNC.vars, self.vars)
+            return eval(line, CNC.vars.dict(), self.vars)
 
         else:
             return line
@@ -2395,7 +4207,7 @@ class GCode:
         if not self.blocks:
             self.blocks.append(Block("Header"))
 
-        cmds = CNC.parseLine(line)
+        cmds = CNC.tokenizeLine(line)
         if cmds is None:
             self.blocks[-1].append(line)
             return
@@ -2431,19 +4243,128 @@ class GCode:
         self._lastModified = os.stat(self.filename).st_mtime
         self.cnc.initPath()
         self.cnc.resetAllMargins()
+        self.progressMax = os.fstat(f.fileno()).st_size
+        if 0 < CNC.lazyload * 1048576 <= self.progressMax:
+            f.close()
+            return self.loadLazy()
         self._blocksExist = False
-        for line in f:
+        for i, line in enumerate(f):
+            if not i & 0x3FF and self._cancel:
+                f.close()
+                return False
+            self.progress += len(line)  # characters, close to bytes
             self._addLine(line[:-1].replace("\x0d", ""))
         self._trim()
+        if CNC.compactblocks:
+            self.compact()
+        self.progress = self.progressMax
         f.close()
+        self.calculateMargins()
+        return True
+
+    # ----------------------------------------------------------------------
+    # Load a big file in lazy mode. The file is memory mapped and only the
+    # byte offsets of the blocks are indexed, split at the (Block-name:
+    # headers or every LAZYBLOCK_SIZE bytes when the file has none.
+    # The lines are decoded only when a block is used
+    # ----------------------------------------------------------------------
+    def loadLazy(self):
+        try:
+            with open(self.filename, "rb") as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            return False
+        size = len(buffer)
+
+        # offsets of the block headers
+        headers = [0] if buffer[:12] == b"(Block-name:" else []
+        pos = buffer.find(b"\n(Block-name:")
+        while pos >= 0:
+            headers.append(pos + 1)
+            pos = buffer.find(b"\n(Block-name:", pos + 1)
+        headers.append(size)
+
+        # lines before the first header, split in chunks
+        pos = 0
+        while pos < headers[0]:
+            end = min(pos + LAZYBLOCK_SIZE, headers[0])
+            if end < headers[0]:
+                eol = buffer.find(b"\n", end, headers[0])
+                end = headers[0] if eol < 0 else eol + 1
+            self._addLazyBlock(
+                self.blocks and None or "Header", buffer, pos, end)
+            pos = end
+
+        # named blocks, parsing their header lines
+        for start, end in zip(headers, headers[1:]):
+            if self._cancel:
+                return False
+            self.progress = start
+            block = Block()
+            pos = start
+            while pos < end:
+                eol = buffer.find(b"\n", pos, end)
+                if eol < 0:
+                    eol = end
+                line = buffer[pos:eol].decode(errors="replace")
+                line = line.replace("\x0d", "")
+                pat = BLOCKPAT.match(line)
+                if pat is None or pat.group(1) not in (
+                        "name", "expand", "enable", "color"):
+                    break
+                block.append(line)
+                pos = eol + 1
+            lazy = self._addLazyBlock(block._name, buffer, pos, end)
+            lazy.expand = block.expand
+            lazy.enable = block.enable
+            lazy.color = block.color
+        self.progress = size
         return True
 
+    # ----------------------------------------------------------------------
+    def _addLazyBlock(self, name, buffer, start, end):
+        block = LazyBlock(
+            name, buffer, start, end, self._countLines(buffer, start, end))
+        self.blocks.append(block)
+        return block
+
+    # ----------------------------------------------------------------------
+    # @return number of lines between the start and end offsets
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def _countLines(buffer, start, end):
+        if start >= end:
+            return 0
+        count = 0
+        for pos in range(start, end, LAZYREAD_SIZE):
+            count += buffer[pos:min(pos + LAZYREAD_SIZE, end)].count(b"\n")
+        if buffer[end - 1] != 10:
+            count += 1  # last line without newline
+        return count
+
+    # ----------------------------------------------------------------------
+    # Convert the normal blocks to compact ones, they are turned back into
+    # lists of lines on their first modification
+    # ----------------------------------------------------------------------
+    def compact(self):
+        for i, block in enumerate(self.blocks):
+            if not isinstance(block, FrozenBlock):
+                self.blocks[i] = CompactBlock.fromBlock(block)
+
+    # ----------------------------------------------------------------------
+    # @return True if any block is still read from a memory mapped file
+    # ----------------------------------------------------------------------
+    def isLazy(self):
+        return any(isinstance(block, LazyBlock) for block in self.blocks)
+
     # ----------------------------------------------------------------------
     # Save to a file
     # ----------------------------------------------------------------------
     def save(self, filename=None):
         if filename is not None:
             self.filename = filename
+        if self.isLazy():
+            return self._saveLazy()
         try:
             f = open(self.filename, "w")
         except Exception:
@@ -2456,6 +4377,35 @@ class GCode:
         self._modified = False
         return True
 
+    # ----------------------------------------------------------------------
+    # The lazy blocks may be read from the file that is overwritten.
+    # Write to a temporary file and replace the original, so that the
+    # mapping keeps reading the old contents
+    # ----------------------------------------------------------------------
+    def _saveLazy(self):
+        tmpname = f"{self.filename}.tmp"
+        try:
+            f = open(tmpname, "w")
+        except Exception:
+            return False
+        for block in self.blocks:
+            block.write(f)
+        f.close()
+        try:
+            os.replace(tmpname, self.filename)
+        except OSError:
+            # mapped files cannot be replaced on windows
+            for block in self.blocks:
+                if isinstance(block, LazyBlock):
+                    block.materialize()
+            try:
+                os.replace(tmpname, self.filename)
+            except OSError:
+                return False
+        self._lastModified = os.stat(self.filename).st_mtime
+        self._modified = False
+        return True
+
     # ----------------------------------------------------------------------
     # Save in TXT format
     # -Enabled Blocks only
@@ -2467,7 +4417,7 @@ class GCode:
         for block in self.blocks:
             if block.enable:
                 for line in block:
-                    cmds = CNC.parseLine(line)
+                    cmds = CNC.tokenizeLine(line)
                     if cmds is None:
                         continue
                     txt.write(f"{line.upper()}\n")
@@ -2520,7 +4470,11 @@ class GCode:
             units = DXF.MILLIMETERS
 
         undoinfo = []
+        self.progressMax = len(dxf.layers)
         for name, layer in dxf.layers.items():
+            if self._cancel:
+                return False
+            self.progress += 1
             enable = not bool(layer.isFrozen())
             entities = dxf.entities(name)
             if not entities:
@@ -2580,7 +4534,7 @@ class GCode:
             if ":" in name:
                 name = name.split(":")[0]
             for line in block:
-                cmds = CNC.parseLine(line)
+                cmds = CNC.tokenizeLine(line)
                 if cmds is None:
                     continue
                 self.cnc.motionStart(cmds)
@@ -2647,6 +4601,9 @@ class GCode:
                                       samples_per_unit,
                                       CNC.digits,
                                       ppi=ppi):
+            if self._cancel:
+                return False
+            self.progress += 1
             self.addBlockFromString(path["id"], path["path"])
 
         if empty:
@@ -2746,7 +4703,7 @@ class GCode:
 
             # Write paths
             for line in block:
-                cmds = CNC.parseLine(line)
+                cmds = CNC.tokenizeLine(line)
                 if cmds is None:
                     continue
                 self.cnc.motionStart(cmds)
@@ -2872,7 +4829,7 @@ class GCode:
             if passno > 1:
                 continue
 
-            cmds = CNC.parseLine(line)
+            cmds = CNC.tokenizeLine(line)
             if cmds is None:
                 continue
             self.cnc.motionStart(cmds)
@@ -3241,7 +5198,8 @@ class GCode:
     # Change a single line in a block
     # ----------------------------------------------------------------------
     def setLineUndo(self, bid, lid, line):
-        undoinfo = (self.setLineUndo, bid, lid, self.blocks[bid][lid])
+        old = self.blocks[bid][lid]
+        undoinfo = (self.setLineUndo, bid, lid, old)
         self.blocks[bid][lid] = line
         return undoinfo
 
@@ -3457,7 +5415,11 @@ class GCode:
     # ----------------------------------------------------------------------
     def setBlockLinesUndo(self, bid, lines):
         block = self.blocks[bid]
-        undoinfo = (self.setBlockLinesUndo, bid, block[:])
+        if isinstance(block, CompactBlock):
+            old = copy.copy(block)  # shares the text buffer
+        else:
+            old = block[:]
+        undoinfo = (self.setBlockLinesUndo, bid, old)
         del block[:]
         block.extend(lines)
         return undoinfo
@@ -3496,7 +5458,7 @@ class GCode:
                 new.append(line)
                 continue
             elif isinstance(cmds, str):
-                cmds = CNC.breakLine(cmds)
+                cmds = CNC.compiledWords(line, cmds)
             else:
                 new.append(line)
                 continue
@@ -3511,10 +5473,9 @@ class GCode:
                     new.append(line)
                 else:
                     extra = ""
-                    for c in cmds:
-                        if (c[0].upper() not in
-                                ("G", "X", "Y", "Z", "I", "J", "K", "R")):
-                            extra += c
+                    for c, value in cmds:
+                        if c not in ("G", "X", "Y", "Z", "I", "J", "K", "R"):
+                            extra += self.cnc.word(c, value)
                     x1, y1, z1 = xyz[0]
                     if self.cnc.gcode == 0:
                         g = 0
@@ -3724,7 +5685,7 @@ class GCode:
             elif distance is None and number == 0:
                 # Drill on path beginning only
                 for i, line in enumerate(block):
-                    cmds = CNC.parseLine(line)
+                    cmds = CNC.tokenizeLine(line)
                     if cmds is None:
                         lines.append(line)
                         continue
@@ -4750,7 +6711,7 @@ class GCode:
         # Find starting location
         self.initPath(bid)
         for i, line in enumerate(block):
-            cmds = CNC.parseLine(line)
+            cmds = CNC.tokenizeLine(line)
             if cmds is None:
                 continue
             self.cnc.motionStart(cmds)
@@ -4779,41 +6740,43 @@ class GCode:
             block = self.blocks[bid]
 
             if isinstance(lid, int):
-                cmds = CNC.parseLine(block[lid])
+                line = block[lid]
+                cmds = CNC.tokenizeLine(line)
                 if cmds is None:
                     continue
                 self.cnc.motionStart(cmds)
 
+                # Lines with [expressions] cannot be transformed
+                if "[" in line:
+                    self.cnc.motionEnd()
+                    continue
+
                 # Collect all values
                 new.clear()
-                for cmd in cmds:
-                    if cmd.upper() == "G91":
-                        relative = True
-                    if cmd.upper() == "G90":
-                        relative = False
-                    c = cmd[0].upper()
+                for c, value in cmds:
+                    if c == "G":
+                        if value == 91:
+                            relative = True
+                        elif value == 90:
+                            relative = False
                     # record only coordinates commands
                     if c not in "XYZIJKR":
                         continue
-                    try:
-                        new[c] = old[c] = float(cmd[1:]) * self.cnc.unit
-                    except Exception:
-                        new[c] = old[c] = 0.0
+                    new[c] = old[c] = value * self.cnc.unit
 
                 # Modify values with func
                 if func(new, old, relative, *args):
                     # Reconstruct new line
                     newcmd = []
                     present = ""
-                    for cmd in cmds:
-                        c = cmd[0].upper()
+                    for c, value in cmds:
                         if c in "XYZIJKR":  # Coordinates
                             newcmd.append(self.fmt(c, new[c] / self.cnc.unit))
                         # Motion
-                        elif c == "G" and int(cmd[1:]) in (0, 1, 2, 3):
+                        elif c == "G" and value in (0, 1, 2, 3):
                             newcmd.append(f"G{int(self.cnc.gcode)}")
                         else:  # the rest leave unchanged
-                            newcmd.append(cmd)
+                            newcmd.append(self.cnc.word(c, value))
                         present += c
                     # Append motion commands if not exist and changed
                     check = "XYZ"
@@ -5015,7 +6978,7 @@ class GCode:
             # 0 - normal cutting z<0
             # 1 - z>0 raised  with dx=dy=0.0
             # 2 - z<0 plunged with dx=dy=0.0
-            cmd = CNC.parseLine(line)
+            cmd = CNC.tokenizeLine(line)
             if cmd is None:
                 newlines.append(line)
                 continue
@@ -5097,41 +7060,203 @@ class GCode:
         self.addUndo(undoinfo, "Optimize")
 
     # ----------------------------------------------------------------------
-    # Use probe information to modify the g-code to autolevel
+    # Lines bringing the machine to the modal state entering line lid of
+    # block bid: units, plane, distance mode, work coordinates, tool length
+    # offset, spindle, coolant, feed mode and rate. The entry moves up to
+    # the safe height, rapids above the starting point and plunges at the
+    # feed rate of the program. Inside a run of arcs or canned cycles the
+    # resumed lines lack their motion word, it is returned apart to be put
+    # in front of the first resumed move
+    # @return list of lines, CNC modal state entering the line,
+    #         motion words of the first move or ""
+    # ----------------------------------------------------------------------
+    def resumePreamble(self, bid, lid):
+        state, machine = self.checkpoints.state(self, bid, lid)
+        cnc = dict(zip(MODAL_STATE, state))
+        modal = MachineModal(machine)
+        unit = cnc["unit"]
+        if CNC.inch:
+            inch = unit == 1.0
+        else:
+            inch = unit != 1.0
+
+        lines = [
+            "G20" if inch else "G21",
+            ("G17", "G18", "G19")[cnc["plane"]],
+            "G90",
+            f"G{modal.wcs:g}",
+        ]
+        if modal.tlo is None:
+            lines.append("G49")
+        else:
+            lines.append("G43.1" + CNC.fmt("Z", modal.tlo / unit))
+
+        x = cnc["x"] / unit
+        y = cnc["y"] / unit
+        z = cnc["z"] / unit
+        safe = max(CNC.vars["safe"] / unit, z)
+        if not CNC.lasercutter:
+            lines.append(CNC.grapid(z=safe))
+        lines.append(CNC.grapid(x, y))
+        if modal.speed:
+            lines.append(f"S{modal.speed:g}")
+        if modal.spindle != 5:
+            lines.append(f"M{modal.spindle}")
+        if modal.mist:
+            lines.append("M7")
+        if modal.flood:
+            lines.append("M8")
+
+        feed = cnc["feed"] / unit
+        if not CNC.lasercutter and z < safe:
+            # the feed of the program is meaningless in G93/G95
+            if modal.feedmode == 94 and feed > 0.0:
+                plunge = feed
+            else:
+                plunge = CNC.vars["cutfeedz"] / unit
+            lines.append("G94")
+            lines.append(CNC.gline(z=z, f=plunge))
+        if modal.feedmode != 94:
+            lines.append(f"G{modal.feedmode}")
+        if modal.feedmode != 93 and feed > 0.0:
+            lines.append(CNC.fmt("F", feed))
+        if not cnc["absolute"]:
+            lines.append("G91")
+        if cnc["arcabsolute"]:
+            lines.append("G90.1")
+        motion = ""
+        if modal.motion in (0, 1):
+            lines.append(f"G{modal.motion}")
+        elif modal.motion in (2, 3):
+            # the arc words I/J/K/R are not modal, the lines have them
+            motion = f"G{modal.motion}"
+        elif modal.motion is not None and modal.motion != 80:
+            lines.append("G98" if cnc["retractz"] else "G99")
+            motion = f"G{modal.motion}" + CNC.fmt("R", cnc["rval"] / unit)
+            if modal.motion in (73, 83):
+                motion += CNC.fmt("Q", cnc["qval"] / unit)
+            elif modal.motion in (82, 86, 88, 89):
+                motion += CNC.fmt("P", cnc["pval"])
+        return lines, state, motion
+
+    # ----------------------------------------------------------------------
+    # @return (index, lines) of the enabled blocks as they are now, to
+    #         compile them in the background while the program may change
+    # ----------------------------------------------------------------------
+    def snapshot(self):
+        return [(i, block.snapshot())
+                for i, block in enumerate(self.blocks) if block.enable]
+
+    # ----------------------------------------------------------------------
+    # Compile the enabled blocks in the queue
+    # @return list of the (block, line) of every queued item, None if stopped
     # ----------------------------------------------------------------------
     def compile(self, queue, stopFunc=None):
         paths = []
-
-        def add(line, path):
+        every = 1
+        for line, path in self.iterCompile():
+            every -= 1
+            if every <= 0:
+                if stopFunc is not None and stopFunc():
+                    return None
+                every = 50
             if line is not None:
-                if isinstance(line, str):
-                    queue.put(line + "\n")
-                else:
-                    queue.put(line)
+                queue.put(line)
             paths.append(path)
+        return paths
 
+    # ----------------------------------------------------------------------
+    # Lazily compile the enabled blocks for sending.
+    # Use probe information to modify the g-code to autolevel.
+    # The state of the motion is kept in self.streamCnc and not in self.cnc,
+    # used by the canvas which may redraw during the run
+    # @param start (block, line) to resume from, after its preamble
+    # @param blocks snapshot() of the blocks, taken now if None
+    # @return generator of (item to send, (block, line) or None)
+    # ----------------------------------------------------------------------
+    def iterCompile(self, start=None, blocks=None):
+        if blocks is None:
+            blocks = self.snapshot()
+        cnc = self.streamCnc
+        out = []  # items compiled from the current line
+        if CNC.reducestream:
+            self.reducer = reducer = StreamReducer()
+        else:
+            self.reducer = reducer = None
         autolevel = not self.probe.isEmpty()
-        self.initPath()
-        for line in CNC.compile(self.cnc.startup.splitlines()):
+        if CNC.arcfit > 0.0 and not autolevel:
+            self.fitter = fitter = ArcFitter(CNC.arcfit)
+        else:
+            self.fitter = fitter = None
+
+        def emit(cmds, path):
+            if reducer is not None:
+                cmds = reducer.reduceWords(cmds)
+                if cmds is None:
+                    return
+            newcmd = []
+            for c, value in cmds:
+                cmd = cnc.word(c, value)
+                if ERROR_HANDLING.get(cmd, 0) != SKIP:
+                    newcmd.append(cmd)
+            line = "".join(newcmd)
+            if reducer is not None:
+                reducer.sent += len(line) + 1
+            out.append((line + "\n", path))
+
+        def flush():
+            if fitter is not None:
+                for cmds, path in fitter.flush():
+                    emit(cmds, path)
+
+        def add(line, path):
+            flush()
+            if isinstance(line, str):
+                if reducer is not None:
+                    line = reducer.reduceLine(line)
+                    if not line:
+                        return
+                    reducer.sent += len(line) + 1
+                line += "\n"
+            elif line is not None and reducer is not None:
+                reducer.reset()
+            out.append((line, path))
+
+        resume = None  # motion words missing from the first resumed move
+        cnc.initPath()
+        for line in CNC.compile(cnc.startup.splitlines()):
             add(line, None)
 
-        every = 1
-        for i, block in enumerate(self.blocks):
-            if not block.enable:
+        if start is None:
+            start = (0, 0)
+        else:
+            preamble, state, motion = self.resumePreamble(*start)
+            for line in preamble:
+                add(line, None)
+                if fitter is not None:
+                    fitter.track(CNC.tokenizeLine(line))
+            cnc.setModalState(state)
+            if motion:
+                resume = CNC.tokenizeLine(motion)
+
+        for i, block in blocks:
+            if i < start[0]:
                 continue
-            for j, line in enumerate(block):
-                every -= 1
-                if every <= 0:
-                    if stopFunc is not None and stopFunc():
-                        return None
-                    every = 50
-
-                newcmd = []
+            if i == start[0] and start[1] > 0:
+                lines = enumerate(
+                    itertools.islice(block, start[1], None), start[1])
+            else:
+                lines = enumerate(block)
+            for j, line in lines:
+                if out:
+                    yield from out
+                    out.clear()
+
                 cmds = CNC.compileLine(line)
                 if cmds is None:
                     continue
-                elif isinstance(cmds, str):
-                    cmds = CNC.breakLine(cmds)
+                elif isinstance(cmds, str) and cmds[0] != "$":
+                    cmds = CNC.compiledWords(line, cmds)
                 else:
                     # either CodeType or tuple, list[] append at it as is
                     if (isinstance(cmds, types.CodeType)
@@ -5141,32 +7266,47 @@ class GCode:
                         add(cmds, (i, j))
                     continue
 
+                if resume is not None:
+                    if any(c == "G" and (value in (0, 1, 2, 3)
+                                         or 80 <= value <= 89)
+                           for c, value in cmds):
+                        resume = None  # the line has its own motion
+                    elif any(c in "XYZABC" for c, value in cmds):
+                        cmds = resume + cmds
+                        resume = None
+
                 skip = False
                 expand = None
-                self.cnc.motionStart(cmds)
+                cnc.motionStart(cmds)
 
                 # FIXME append feed on cut commands. It will be obsolete
                 # in grbl v1.0
-                if CNC.appendFeed and self.cnc.gcode in (1, 2, 3):
+                if CNC.appendFeed and cnc.gcode in (1, 2, 3):
                     # Check is not existing in cmds
-                    for c in cmds:
-                        if c[0] in ("f", "F"):
+                    for c, value in cmds:
+                        if c == "F":
                             break
                     else:
-                        cmds.append(
-                            self.fmt("F", self.cnc.feed / self.cnc.unit))
+                        cmds.append(("F", cnc.feed / cnc.unit))
+
+                if fitter is not None and fitter.accepts(cnc, cmds):
+                    fitted = fitter.push(cnc, cmds, (i, j))
+                    cnc.motionEnd()
+                    for cmds, path in fitted:
+                        emit(cmds, path)
+                    continue
 
-                if (autolevel and self.cnc.gcode in (0, 1, 2, 3)
-                        and self.cnc.mval == 0):
-                    xyz = self.cnc.motionPath()
+                if (autolevel and cnc.gcode in (0, 1, 2, 3)
+                        and cnc.mval == 0):
+                    xyz = cnc.motionPath()
                     if not xyz:
                         # while auto-levelling, do not ignore non-movement
                         # commands, just append the line as-is
                         add(line, None)
                     else:
                         extra = ""
-                        for c in cmds:
-                            if c[0].upper() not in (
+                        for c, value in cmds:
+                            if c not in (
                                 "G",
                                 "X",
                                 "Y",
@@ -5176,9 +7316,9 @@ class GCode:
                                 "K",
                                 "R",
                             ):
-                                extra += c
+                                extra += cnc.word(c, value)
                         x1, y1, z1 = xyz[0]
-                        if self.cnc.gcode == 0:
+                        if cnc.gcode == 0:
                             g = 0
                         else:
                             g = 1
@@ -5188,21 +7328,21 @@ class GCode:
                                 add(
                                     "".join([
                                         f"G{int(g)}",
-                                        f"{self.fmt('X', x / self.cnc.unit)}",
-                                        f"{self.fmt('Y', y / self.cnc.unit)}",
-                                        f"{self.fmt('Z', z / self.cnc.unit)}",
+                                        f"{self.fmt('X', x / cnc.unit)}",
+                                        f"{self.fmt('Y', y / cnc.unit)}",
+                                        f"{self.fmt('Z', z / cnc.unit)}",
                                         f"{extra}",
                                     ]),
                                     (i, j),
                                 )
                                 extra = ""
                             x1, y1, z1 = x2, y2, z2
-                    self.cnc.motionEnd()
+                    cnc.motionEnd()
                     continue
                 else:
                     # FIXME expansion policy here variable needed
                     # Canned cycles
-                    if CNC.drillPolicy == 1 and self.cnc.gcode in (
+                    if CNC.drillPolicy == 1 and cnc.gcode in (
                         81,
                         82,
                         83,
@@ -5210,16 +7350,16 @@ class GCode:
                         86,
                         89,
                     ):
-                        expand = self.cnc.macroGroupG8X()
+                        expand = cnc.macroGroupG8X()
                     # Tool change
-                    elif self.cnc.mval == 6:
+                    elif cnc.mval == 6:
                         if CNC.toolPolicy == 0:
                             pass  # send to grbl
                         elif CNC.toolPolicy == 1:
                             skip = True  # skip whole line
                         elif CNC.toolPolicy >= 2:
-                            expand = CNC.compile(self.cnc.toolChange())
-                    self.cnc.motionEnd()
+                            expand = CNC.compile(cnc.toolChange())
+                    cnc.motionEnd()
 
                 if expand is not None:
                     for line in expand:
@@ -5230,22 +7370,10 @@ class GCode:
                     skip = False
                     continue
 
-                for cmd in cmds:
-                    c = cmd[0]
-                    try:
-                        value = float(cmd[1:])
-                    except Exception:
-                        value = 0.0
-                    if c.upper() in ("F", "X", "Y", "Z",
-                                     "I", "J", "K", "R", "P"):
-                        cmd = self.fmt(c, value)
-                    else:
-                        opt = ERROR_HANDLING.get(cmd.upper(), 0)
-                        if opt == SKIP:
-                            cmd = None
-                    if cmd is not None:
-                        newcmd.append(cmd)
-
-                add("".join(newcmd), (i, j))
+                flush()
+                if fitter is not None:
+                    cmds = fitter.restore(cnc, cmds)
+                emit(cmds, (i, j))
 
-        return paths
+        flush()
+        yield from out
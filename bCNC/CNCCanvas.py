@@ -48,7 +48,7 @@ import bmath
 import Camera
 import tkExtra
 import Utils
-from CNC import CNC
+from CNC import CNC, LazyBlock
 
 # Probe mapping we need PIL and numpy
 try:
@@ -152,6 +152,13 @@ def mouseCursor(action):
     return MOUSE_CURSOR.get(action, DEF_CURSOR)
 
 
+# -----------------------------------------------------------------------------
+# Canvas tag of all the paths of a block, to recolor them in a single call
+# -----------------------------------------------------------------------------
+def blockTag(block):
+    return f"B{id(block):x}"
+
+
 # =============================================================================
 # Raise an alarm exception
 # =============================================================================
@@ -212,6 +219,8 @@ class CNCCanvas(Canvas):
         self.zoom = 1.0
         self.__tzoom = 1.0  # delayed zoom (temporary)
         self._items = {}
+        self._drawn = {}  # id(block): state of the block when last drawn
+        self._drawnView = None  # drawing settings of the block paths
 
         self._x = self._y = 0
         self._xp = self._yp = 0
@@ -1095,20 +1104,8 @@ class CNCCanvas(Canvas):
             self.itemconfig(self._lastActive, arrow=NONE)
             self._lastActive = None
 
-        for i in self.find_withtag("sel"):
-            bid, lid = self._items[i]
-            if bid:
-                try:
-                    block = self.gcode[bid]
-                    if block.color:
-                        fill = block.color
-                    else:
-                        fill = ENABLE_COLOR
-                except IndexError:
-                    fill = ENABLE_COLOR
-            else:
-                fill = ENABLE_COLOR
-            self.itemconfig(i, width=1, fill=fill)
+        self.itemconfig("sel", width=1, fill=ENABLE_COLOR)
+        self._blockColors("sel")
 
         self.itemconfig("sel2", width=1, fill=DISABLE_COLOR)
         self.itemconfig("sel3", width=1, fill=TAB_COLOR)
@@ -1125,9 +1122,7 @@ class CNCCanvas(Canvas):
             block = self.gcode[b]
             if i is None:
                 sel = block.enable and "sel" or "sel2"
-                for path in block._path:
-                    if path is not None:
-                        self.addtag_withtag(sel, path)
+                self.addtag_withtag(sel, blockTag(block))
                 sel = block.enable and "sel3" or "sel4"
 
             elif isinstance(i, int):
@@ -1144,6 +1139,38 @@ class CNCCanvas(Canvas):
             self.tag_raise(i)
         self.drawMargin()
 
+    # ----------------------------------------------------------------------
+    # Restore the color of the enabled blocks drawn with their own color
+    # on the items having tag
+    # ----------------------------------------------------------------------
+    def _blockColors(self, tag):
+        for block in self.gcode.blocks:
+            if block.color and block.enable:
+                self.itemconfig(f"{tag}&&{blockTag(block)}", fill=block.color)
+
+    # ----------------------------------------------------------------------
+    # Mark as processed the paths executed, the whole blocks and the path
+    # items given. Takes a fixed number of Tk calls, the items are tagged
+    # by a single Tcl loop and recolored at once
+    # ----------------------------------------------------------------------
+    def markProcessed(self, paths=(), blocks=()):
+        for block in blocks:
+            self.addtag_withtag("processing", blockTag(block))
+        if paths:
+            self.tk.call("foreach", "i", tuple(paths),
+                         f"{self._w} addtag processing withtag $i")
+        self.itemconfig("processing", width=2, fill=PROCESS_COLOR)
+        self.addtag_withtag("processed", "processing")
+        self.dtag("processing")
+
+    # ----------------------------------------------------------------------
+    # Restore the color of all the processed paths
+    # ----------------------------------------------------------------------
+    def clearProcessed(self):
+        self.itemconfig("processed", width=1, fill=ENABLE_COLOR)
+        self._blockColors("processed")
+        self.dtag("processed")
+
     # ----------------------------------------------------------------------
     # Select orientation marker
     # ----------------------------------------------------------------------
@@ -1386,10 +1413,18 @@ class CNCCanvas(Canvas):
         if view is not None:
             self.view = view
 
+        # Redraw only the modified blocks if the view didn't change
+        drawnView = (
+            self.view, self.zoom, self.draw_paths, self.draw_rapid,
+            self.draw_margin, ENABLE_COLOR, DISABLE_COLOR,
+        )
+        incremental = drawnView == self._drawnView
+        self._drawnView = drawnView
+
         self._last = (0.0, 0.0, 0.0)
-        self.initPosition()
+        self.initPosition(incremental)
 
-        self.drawPaths()
+        self.drawPaths(incremental)
         self.drawGrid()
         self.drawMargin()
         self.drawWorkarea()
@@ -1413,9 +1448,19 @@ class CNCCanvas(Canvas):
     # ----------------------------------------------------------------------
     # Initialize gantry position
     # ----------------------------------------------------------------------
-    def initPosition(self):
+    def initPosition(self, keepPaths=False):
         self.configure(background=CANVAS_COLOR)
-        self.delete(ALL)
+        if keepPaths:
+            # delete everything except the gcode paths
+            if self._lastActive is not None:
+                self.itemconfig(self._lastActive, arrow=NONE)
+            self.addtag_all("old")
+            self.dtag("gcode", "old")
+            self.delete("old")
+        else:
+            self.delete(ALL)
+            self._items.clear()
+            self._drawn.clear()
         self._cameraImage = None
         gr = max(3, int(CNC.vars["diameter"] / 2.0 * self.zoom))
         if self.view == VIEW_XY:
@@ -1446,7 +1491,6 @@ class CNCCanvas(Canvas):
         self._lastActive = None
         self._select = None
         self._vector = None
-        self._items.clear()
         self.cnc.initPath()
         self.cnc.resetAllMargins()
 
@@ -1896,11 +1940,16 @@ class CNCCanvas(Canvas):
 
     # ----------------------------------------------------------------------
     # Draw the paths for the whole gcode file
+    # In incremental mode only the blocks modified, or entered with a
+    # different modal state, are drawn again
     # ----------------------------------------------------------------------
-    def drawPaths(self):
+    def drawPaths(self, incremental=False):
+        drawn = self._drawn
+        self._drawn = {}
         if not self.draw_paths:
             for block in self.gcode.blocks:
                 block.resetPath()
+            self.gcode.calculateMargins()
             return
 
         try:
@@ -1909,10 +1958,29 @@ class CNCCanvas(Canvas):
             self.cnc.resetAllMargins()
             drawG = self.draw_rapid or self.draw_paths or self.draw_margin
             for i, block in enumerate(self.gcode.blocks):
+                entry = (self.cnc.modalState(), self._last,
+                         block.enable, block.color)
+                old = drawn.pop(id(block), None)
+                if (old is not None and old[0] is block
+                        and old[1] == block._version and old[2] == entry):
+                    # unchanged, keep the paths
+                    self.cnc.setModalState(old[3])
+                    self._last = old[4]
+                    if old[5] != i:
+                        for j, path in enumerate(block._path):
+                            if path:
+                                self._items[path] = i, j
+                    self._drawn[id(block)] = old[:5] + (i,)
+                    continue
+
+                if incremental:
+                    self._deletePaths(block)
                 start = True  # start location found
                 block.resetPath()
 
-                # Draw block
+                # Parse block, the arcs are linearized all together later
+                motions = []  # line, gcode and path of every line
+                arcs = []
                 for j, line in enumerate(block):
                     n -= 1
                     if n == 0:
@@ -1929,7 +1997,7 @@ class CNCCanvas(Canvas):
                         if isinstance(cmd, tuple):
                             cmd = None
                         else:
-                            cmd = CNC.breakLine(cmd)
+                            cmd = CNC.tokenizeLine(cmd)
                     except AlarmException:
                         raise
                     except Exception:
@@ -1939,19 +2007,66 @@ class CNCCanvas(Canvas):
                         sys.stderr.write(_("     line: {}\n").format(line))
                         cmd = None
                     if cmd is None or not drawG:
-                        block.addPath(None)
+                        motions.append((j, None, None))
+                        continue
+                    self.cnc.motionStart(cmd)
+                    gcode = self.cnc.gcode
+                    if gcode in (2, 3):
+                        xyz = (
+                            (self.cnc.x, self.cnc.y, self.cnc.z),
+                            len(arcs),
+                            (self.cnc.xval, self.cnc.yval, self.cnc.zval),
+                        )
+                        arcs.append(self.cnc.motionArc())
                     else:
-                        path = self.drawPath(block, cmd)
-                        self._items[path] = i, j
-                        block.addPath(path)
-                        if start and self.cnc.gcode in (1, 2, 3):
-                            # Mark as start the first non-rapid motion
-                            block.startPath(self.cnc.x, self.cnc.y, self.cnc.z)
-                            start = False
+                        xyz = self.cnc.motionPath()
+                    self.cnc.motionEnd()
+                    motions.append((j, gcode, xyz))
+                    if start and gcode in (1, 2, 3):
+                        # Mark as start the first non-rapid motion
+                        block.startPath(self.cnc.x, self.cnc.y, self.cnc.z)
+                        start = False
                 block.endPath(self.cnc.x, self.cnc.y, self.cnc.z)
+
+                # Draw block, the margins of a lazy one are not in the
+                # motion table
+                lazy = isinstance(block, LazyBlock)
+                points = CNC.arcPoints(arcs)
+                for j, gcode, xyz in motions:
+                    if gcode is None:
+                        block.addPath(None)
+                        continue
+                    if gcode in (2, 3):
+                        first, k, last = xyz
+                        xyz = [first] + points[k] + [last]
+                    if lazy and xyz and gcode in (1, 2, 3):
+                        block.pathMargins(xyz)
+                    path = self.drawMotion(block, gcode, xyz)
+                    self._items[path] = i, j
+                    block.addPath(path)
+                self._drawn[id(block)] = (
+                    block, block._version, entry,
+                    self.cnc.modalState(), self._last, i,
+                )
         except AlarmException:
             self.status("Rendering takes TOO Long. Interrupted...")
 
+        # remove the paths of the deleted or not reached blocks
+        if incremental:
+            for old in drawn.values():
+                self._deletePaths(old[0])
+
+        # statistics and margins from the motion table
+        self.gcode.calculateMargins()
+
+    # ----------------------------------------------------------------------
+    def _deletePaths(self, block):
+        self.delete(blockTag(block))
+        for path in block._path:
+            if path:
+                self._items.pop(path, None)
+        del block._path[:]
+
     # ----------------------------------------------------------------------
     # Create path for one g command
     # ----------------------------------------------------------------------
@@ -1959,17 +2074,19 @@ class CNCCanvas(Canvas):
         self.cnc.motionStart(cmds)
         xyz = self.cnc.motionPath()
         self.cnc.motionEnd()
+        return self.drawMotion(block, self.cnc.gcode, xyz)
+
+    # ----------------------------------------------------------------------
+    # Create path for the xyz points of a motion
+    # ----------------------------------------------------------------------
+    def drawMotion(self, block, gcode, xyz):
         if xyz:
-            self.cnc.pathLength(block, xyz)
-            if self.cnc.gcode in (1, 2, 3):
-                block.pathMargins(xyz)
-                self.cnc.pathMargins(block)
             if block.enable:
-                if self.cnc.gcode == 0 and self.draw_rapid:
+                if gcode == 0 and self.draw_rapid:
                     xyz[0] = self._last
                 self._last = xyz[-1]
             else:
-                if self.cnc.gcode == 0:
+                if gcode == 0:
                     return None
             coords = self.plotCoords(xyz)
             if coords:
@@ -1980,13 +2097,16 @@ class CNCCanvas(Canvas):
                         fill = ENABLE_COLOR
                 else:
                     fill = DISABLE_COLOR
-                if self.cnc.gcode == 0:
+                tags = ("gcode", blockTag(block))
+                if gcode == 0:
                     if self.draw_rapid:
                         return self.create_line(coords, fill=fill,
-                                                width=0, dash=(4, 3))
+                                                width=0, dash=(4, 3),
+                                                tags=tags)
                 elif self.draw_paths:
                     return self.create_line(
-                        coords, fill=fill, width=0, cap="projecting"
+                        coords, fill=fill, width=0, cap="projecting",
+                        tags=tags
                     )
         return None
 
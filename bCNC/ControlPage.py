@@ -271,6 +271,7 @@ class DROFrame(CNCRibbon.PageFrame):
         self.xwork.grid(row=row, column=col, padx=1, sticky=EW)
         tkExtra.Balloon.set(self.xwork, _("X work position (click to set)"))
         self.xwork.bind("<FocusIn>", self.workFocus)
+        self.xwork.bind("<FocusOut>", self.workFocusOut)
         self.xwork.bind("<Return>", self.setX)
         self.xwork.bind("<KP_Enter>", self.setX)
 
@@ -287,6 +288,7 @@ class DROFrame(CNCRibbon.PageFrame):
         self.ywork.grid(row=row, column=col, padx=1, sticky=EW)
         tkExtra.Balloon.set(self.ywork, _("Y work position (click to set)"))
         self.ywork.bind("<FocusIn>", self.workFocus)
+        self.ywork.bind("<FocusOut>", self.workFocusOut)
         self.ywork.bind("<Return>", self.setY)
         self.ywork.bind("<KP_Enter>", self.setY)
 
@@ -303,6 +305,7 @@ class DROFrame(CNCRibbon.PageFrame):
         self.zwork.grid(row=row, column=col, padx=1, sticky=EW)
         tkExtra.Balloon.set(self.zwork, _("Z work position (click to set)"))
         self.zwork.bind("<FocusIn>", self.workFocus)
+        self.zwork.bind("<FocusOut>", self.workFocusOut)
         self.zwork.bind("<Return>", self.setZ)
         self.zwork.bind("<KP_Enter>", self.setZ)
 
@@ -536,6 +539,13 @@ class DROFrame(CNCRibbon.PageFrame):
         if self.app.running:
             self.app.focus_set()
 
+    # ----------------------------------------------------------------------
+    # The coordinates are refreshed only when they change, restore the
+    # value of a field left without setting it
+    # ----------------------------------------------------------------------
+    def workFocusOut(self, event=None):
+        self.after_idle(self.updateCoords)
+
     # ----------------------------------------------------------------------
     def setX0(self, event=None):
         self.app.mcontrol._wcsSet("0", None, None, None, None, None)
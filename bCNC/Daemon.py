@@ -0,0 +1,572 @@
+# $Id$
+#
+# Author: Vasilis Vlachoudis
+#  Email: vvlachoudis@gmail.com
+#   Date: 16-Oct-2026
+#
+# Host several machines in a single process without the user interface.
+# Every machine has its own Sender, controller, serial threads, variables
+# (CNC.vars), job queue and log. They are controlled with a local HTTP/JSON
+# API built on the pendant server:
+#
+#     python -m bCNC --daemon -m router1=/dev/ttyUSB0 -m router2=/dev/ttyUSB1
+#
+#     GET /machines                      state of all the machines
+#     GET /machines/<name>               state of a machine
+#     GET /machines/<name>/log?since=#   messages after the sequence number
+#     GET /machines/<name>/jobs          files running and waiting to run
+#     GET /machines/<name>/jobs?add=file queue a file to run
+#     GET /machines/<name>/jobs?clear=1  remove the files waiting to run
+#     GET /machines/<name>/send?cmd=#    as the pendant, e.g. RUN, STOP, HOME
+#     GET /machines/<name>/send?gcode=#
+#     GET /machines/<name>/state         as the pendant
+
+import getopt
+import http.server as httpserver
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+import urllib.parse as urlparse
+from collections import deque
+from queue import Empty
+
+import Headless
+import Pendant
+import Utils
+from CNC import CNC
+from Headless import EXIT_FAILED, EXIT_INTERRUPT, EXIT_OK, EXIT_USAGE
+from Sender import NOT_CONNECTED, STATECOLOR, Sender
+
+__author__ = "Vasilis Vlachoudis"
+__email__ = "vvlachoudis@gmail.com"
+
+LOG_LINES = 1000  # messages kept for every machine
+POLL = 0.05  # s, monitoring of the machines
+
+# Messages of the log
+LOG_TYPE = {
+    Sender.MSG_BUFFER: "send",
+    Sender.MSG_SEND: "send",
+    Sender.MSG_RECEIVE: "receive",
+    Sender.MSG_OK: "ok",
+    Sender.MSG_ERROR: "error",
+    Sender.MSG_RUNEND: "info",
+}
+
+
+# =============================================================================
+# A machine of the daemon, with its own CNC.vars
+# =============================================================================
+class Machine(Headless.Headless):
+    def __init__(self, name, device, baud):
+        with CNC.vars.bound(CNC.vars.new()):
+            Headless.Headless.__init__(self)
+            CNC.vars["state"] = NOT_CONNECTED
+            CNC.vars["color"] = STATECOLOR[NOT_CONNECTED]
+        self.name = name
+        self.device = device
+        self.baud = baud
+        self.journalFile = f"{Utils.jouFile}.{name}"
+        self.jobs = deque()  # files waiting to run
+        self.job = None  # file loading or running
+        self.hold = False  # don't start the next job
+        self._interrupted = False  # job stopped with STOP
+        self.last = None  # file and result of the last job
+        self._pendantFileUploaded = None
+        self._logs = deque(maxlen=LOG_LINES)
+        self._logSeq = 0
+        self._logLock = threading.Lock()
+
+    # ----------------------------------------------------------------------
+    # Log of the machine
+    # ----------------------------------------------------------------------
+    def record(self, kind, text):
+        with self._logLock:
+            self._logSeq += 1
+            self._logs.append({
+                "seq": self._logSeq,
+                "time": time.time(),
+                "type": kind,
+                "text": text,
+            })
+
+    # ----------------------------------------------------------------------
+    # @return the messages after the sequence number since
+    # ----------------------------------------------------------------------
+    def logSince(self, since=0):
+        with self._logLock:
+            return [x for x in self._logs if x["seq"] > since]
+
+    # ----------------------------------------------------------------------
+    def message(self, text, error=False):
+        self.record("error" if error else "info", text)
+        Headless.Headless.message(self, f"{self.name}: {text}", error)
+
+    # ----------------------------------------------------------------------
+    def logMessage(self, msg, line):
+        if msg in (Sender.MSG_ERROR, Sender.MSG_RUNEND):
+            Headless.Headless.logMessage(self, msg, line)
+        elif msg == Sender.MSG_RECEIVE or (
+                not self.running and msg in LOG_TYPE):
+            # while running only what is not the stream itself
+            self.record(LOG_TYPE[msg], str(line).strip())
+
+    # ----------------------------------------------------------------------
+    def summary(self):
+        values = self.vars
+        if self._runLines == sys.maxsize:
+            total = self._total
+        else:
+            total = self._runLines
+        return {
+            "name": self.name,
+            "device": self.device,
+            "controller": self.controller,
+            "connected": self.serial is not None,
+            "state": values.get("state"),
+            "color": values.get("color"),
+            "running": self.running,
+            "pause": self._pause,
+            "hold": self.hold,
+            "job": self.job,
+            "jobs": list(self.jobs),
+            "last": self.last,
+            "done": self._gcount if self.running else 0,
+            "total": total if self.running else 0,
+            "remaining": self.remaining if self.running else None,
+            "buffer": self.getBufferFill(),
+            "work": [values.get(f"w{c}") for c in "xyzabc"],
+            "machine": [values.get(f"m{c}") for c in "xyzabc"],
+            "G": values.get("G"),
+            "log": self._logSeq,
+        }
+
+    # ----------------------------------------------------------------------
+    # Commands of Sender.executeCommand expected from the user interface
+    # ----------------------------------------------------------------------
+    def openClose(self):
+        if self.serial is not None:
+            if self.running:
+                self.runAbort()
+                self.last = {"file": self.job, "rc": EXIT_FAILED}
+                self.job = None
+            self.close()
+            self.message("Closed")
+            return
+        try:
+            self.open(self.device, self.baud)
+        except Exception:
+            self.serial = None
+            self.thread = None
+            self.message(
+                f"Cannot open {self.device}: {sys.exc_info()[1]}", True)
+            return
+        self.message(f"Opened {self.device}")
+
+    # ----------------------------------------------------------------------
+    # Run the loaded gcode, resume from a pause or release the job queue
+    # ----------------------------------------------------------------------
+    def run(self, lines=None, start=None):
+        if self.running:
+            if self._pause:
+                self.resume()
+            return
+        self.hold = False
+        if (self.job is None and self.gcode.filename
+                and (start is not None or not self.jobs)):
+            self.job = self.gcode.filename
+            self.runJob(start)
+
+    # ----------------------------------------------------------------------
+    def runFrom(self, args=()):
+        if self.running or self.job is not None:
+            self.message("Please stop before", True)
+            return
+        if args:
+            try:
+                start = (int(args[0]) - 1,
+                         int(args[1]) - 1 if len(args) > 1 else 0)
+            except ValueError:
+                self.message("Invalid block or line number", True)
+                return
+        else:
+            start = self.journalStart()
+            if start is None:
+                return
+        start = self.checkStart(start)
+        if start is not None:
+            self.run(start=start)
+
+    # ----------------------------------------------------------------------
+    # Stopping holds the job queue, until RUN
+    # ----------------------------------------------------------------------
+    def stopRun(self, event=None):
+        self.hold = True
+        self._interrupted = self.job is not None
+        self.loadCancel()
+        Headless.Headless.stopRun(self)
+
+    # ----------------------------------------------------------------------
+    # Execute a command or gcode, as Application.execute
+    # ----------------------------------------------------------------------
+    def execute(self, line):
+        try:
+            line = self.evaluate(line)
+            if line is None or self.executeGcode(line):
+                return
+            rc = self.executeCommand(line)
+        except Exception:
+            self.message(f"{line}: {sys.exc_info()[1]}", True)
+            return
+        if isinstance(rc, tuple):
+            self.message(rc[1], True)
+
+    # ----------------------------------------------------------------------
+    # Start the job loaded
+    # ----------------------------------------------------------------------
+    def runJob(self, start=None):
+        if self.serial is None:
+            self.message(f"Cannot run {self.job}, not connected", True)
+            self.last = {"file": self.job, "rc": EXIT_USAGE}
+            self.job = None
+            return
+        self.message(f"Run {self.job}")
+        self._interrupted = False
+        if not self.runStart(start):
+            self.last = {"file": self.job, "rc": EXIT_USAGE}
+            self.job = None
+
+    # ----------------------------------------------------------------------
+    # Advance the machine, called periodically by the event loop
+    # ----------------------------------------------------------------------
+    def poll(self):
+        # Commands from the API
+        while True:
+            try:
+                cmd = self.pendant.get_nowait()
+            except Empty:
+                break
+            self.execute(cmd)
+
+        # Load file from pendant
+        if (self._pendantFileUploaded is not None
+                and self.job is None and not self.running):
+            self.load(self._pendantFileUploaded)
+            self._pendantFileUploaded = None
+
+        if self.loader is not None:
+            self.drainLog()
+            if self.loadRunning():
+                return
+            if self.loadFinish() is None:
+                if self._interrupted:
+                    rc = EXIT_INTERRUPT
+                else:
+                    self.message(f"Cannot load {self.job}", True)
+                    rc = EXIT_USAGE
+                self.last = {"file": self.job, "rc": rc}
+                self.job = None
+                self.hold = True
+            else:
+                self.runJob()
+            return
+
+        if self.job is not None:
+            rc = self.runPoll()
+            if rc is None:
+                return
+            if self._interrupted:
+                rc = EXIT_INTERRUPT
+            self.last = {"file": self.job, "rc": rc}
+            self.job = None
+            if rc != EXIT_OK:
+                self.hold = True
+        else:
+            self.drainLog()
+
+        # Next job once the machine is idle
+        if (self.jobs and self.job is None and not self.hold
+                and self.serial is not None
+                and self.vars.get("state") == "Idle"):
+            self.job = self.jobs.popleft()
+            self._interrupted = False
+            self.message(f"Load {self.job}")
+            self.loadStart(self.job)
+
+
+# =============================================================================
+# Request handler of the API, the pendant of the machine addressed
+# =============================================================================
+class DaemonHandler(Pendant.Pendant):
+    machine = None
+
+    # ----------------------------------------------------------------------
+    @property
+    def app(self):
+        return self.machine
+
+    # ----------------------------------------------------------------------
+    def sendJSON(self, data, rc=200):
+        content = json.dumps(data).encode()
+        self.do_HEAD(rc, content="application/json", cl=len(content))
+        self.wfile.write(content)
+
+    # ----------------------------------------------------------------------
+    # Find the machine of the request
+    # @return page requested to the machine, None if not found
+    # ----------------------------------------------------------------------
+    def route(self):
+        path, _, query = self.path.partition("?")
+        parts = [x for x in path.split("/") if x]
+        if len(parts) < 2 or parts[0] != "machines":
+            return None
+        self.machine = self.server.machines.get(urlparse.unquote(parts[1]))
+        if self.machine is None:
+            return None
+        page = "/" + "/".join(parts[2:])
+        self.path = page + (f"?{query}" if query else "")
+        return page
+
+    # ----------------------------------------------------------------------
+    def do_GET(self):
+        machines = self.server.machines
+        if self.path.split("?")[0].strip("/") in ("", "machines"):
+            self.sendJSON([m.summary() for m in machines.values()])
+            return
+
+        page = self.route()
+        if page is None:
+            self.sendJSON({"error": "no such machine"}, 404)
+            return
+        machine = self.machine
+        if "?" in self.path:
+            arg = dict(urlparse.parse_qsl(self.path.split("?", 1)[1]))
+        else:
+            arg = {}
+
+        with CNC.vars.bound(machine.vars):
+            if page == "/":
+                self.sendJSON(machine.summary())
+
+            elif page == "/log":
+                try:
+                    since = int(arg.get("since", 0))
+                except ValueError:
+                    since = 0
+                self.sendJSON(machine.logSince(since))
+
+            elif page == "/jobs":
+                if "add" in arg:
+                    filename = os.path.abspath(arg["add"])
+                    if not os.path.isfile(filename):
+                        self.sendJSON({"error": f"{filename} not found"}, 404)
+                        return
+                    machine.jobs.append(filename)
+                    machine.record("info", f"Queued {filename}")
+                elif "clear" in arg:
+                    machine.jobs.clear()
+                self.sendJSON({
+                    "job": machine.job,
+                    "jobs": list(machine.jobs),
+                    "hold": machine.hold,
+                    "last": machine.last,
+                })
+
+            else:
+                Pendant.Pendant.do_GET(self)
+
+    # ----------------------------------------------------------------------
+    def do_POST(self):
+        if self.route() is None:
+            self.sendJSON({"error": "no such machine"}, 404)
+            return
+        Pendant.Pendant.do_POST(self)
+
+
+# =============================================================================
+# Machines served in one process
+# =============================================================================
+class Daemon:
+    def __init__(self):
+        self.machines = {}
+        self.httpd = None
+        self._quit = False
+
+    # ----------------------------------------------------------------------
+    def add(self, name, device, baud, controller=None):
+        machine = Machine(name, device, baud)
+        with CNC.vars.bound(machine.vars):
+            machine.loadConfig()
+            if controller is not None:
+                machine.controllerSet(controller)
+        self.machines[name] = machine
+        return machine
+
+    # ----------------------------------------------------------------------
+    def open(self):
+        for machine in self.machines.values():
+            with CNC.vars.bound(machine.vars):
+                machine.openClose()
+
+    # ----------------------------------------------------------------------
+    def close(self):
+        for machine in self.machines.values():
+            with CNC.vars.bound(machine.vars):
+                if machine.running:
+                    machine.runAbort()
+                machine.close()
+
+    # ----------------------------------------------------------------------
+    # Start the API server in a background thread
+    # ----------------------------------------------------------------------
+    def serve(self, host, port):
+        self.httpd = httpserver.ThreadingHTTPServer(
+            (host, port), DaemonHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.machines = self.machines
+        self.httpd.app = None
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    # ----------------------------------------------------------------------
+    def quit(self):
+        self._quit = True
+
+    # ----------------------------------------------------------------------
+    # Event loop advancing all the machines
+    # ----------------------------------------------------------------------
+    def loop(self):
+        while not self._quit:
+            time.sleep(POLL)
+            for machine in self.machines.values():
+                with CNC.vars.bound(machine.vars):
+                    try:
+                        machine.poll()
+                    except Exception:
+                        typ, val, tb = sys.exc_info()
+                        traceback.print_exception(typ, val, tb)
+
+    # ----------------------------------------------------------------------
+    def shutdown(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd = None
+        self.close()
+
+
+# -----------------------------------------------------------------------------
+def usage(rc):
+    wrt = sys.stdout.write
+    wrt(f"{Utils.__prg__} V{Utils.__version__} [{Utils.__date__}] daemon\n")
+    wrt(f"{Utils.__author__} <{Utils.__email__}>\n\n")
+    wrt("Usage: --daemon [options] -m name=device [-m name=device...]\n\n")
+    wrt("Options:\n")
+    wrt("\t-b # | --baud #\t\tSet the baud rate\n")
+    wrt("\t-c # | --controller #\tSet the controller\n")
+    wrt("\t-h | -? | --help\tThis help page\n")
+    wrt("\t-i # | --ini #\t\tAlternative ini file\n")
+    wrt("\t-m # | --machine #\tAdd the machine name=device\n")
+    wrt("\t-p # | --port #\t\tPort of the API\n")
+    wrt("\t--host #\t\tAddress of the API\n")
+    wrt("\n")
+    return rc
+
+
+# -----------------------------------------------------------------------------
+def main(argv):
+    try:
+        optlist, args = getopt.gnu_getopt(
+            argv,
+            "?b:c:hi:m:p:",
+            [
+                "daemon",
+                "help",
+                "ini=",
+                "baud=",
+                "controller=",
+                "machine=",
+                "port=",
+                "host=",
+            ],
+        )
+    except getopt.GetoptError:
+        return usage(EXIT_USAGE)
+
+    machines = []
+    baud = None
+    controller = None
+    host = Pendant.HOSTNAME
+    port = None
+    for opt, val in optlist:
+        if opt in ("-h", "-?", "--help"):
+            return usage(EXIT_OK)
+        elif opt in ("-i", "--ini"):
+            Utils.iniUser = val
+        elif opt in ("-b", "--baud"):
+            baud = val
+        elif opt in ("-c", "--controller"):
+            controller = val
+        elif opt in ("-m", "--machine"):
+            name, sep, device = val.partition("=")
+            if not sep or not name or not device:
+                sys.stderr.write(f"Invalid machine {val}, use name=device\n")
+                return EXIT_USAGE
+            machines.append((name, device))
+        elif opt in ("-p", "--port"):
+            try:
+                port = int(val)
+            except ValueError:
+                return usage(EXIT_USAGE)
+        elif opt == "--host":
+            host = val
+
+    if not machines or args:
+        return usage(EXIT_USAGE)
+    if len({name for name, device in machines}) != len(machines):
+        sys.stderr.write("The names of the machines must be unique\n")
+        return EXIT_USAGE
+    Utils.loadConfiguration()
+    if baud is None:
+        baud = Utils.getStr("Connection", "baud", "115200")
+    if port is None:
+        port = Utils.getInt("Connection", "pendantport", Pendant.port)
+
+    daemon = Daemon()
+    for name, device in machines:
+        machine = daemon.add(name, device, baud, controller)
+        if controller is not None and machine.controller != controller:
+            sys.stderr.write(
+                f"Unknown controller {controller}, "
+                f"one of: {', '.join(machine.controllerList())}\n")
+            return EXIT_USAGE
+
+    try:
+        daemon.serve(host, port)
+    except OSError:
+        sys.stderr.write(f"Cannot serve on {host}:{port}: "
+                         f"{sys.exc_info()[1]}\n")
+        return EXIT_USAGE
+    sys.stdout.write(f"Serving {len(machines)} machines on "
+                     f"http://{host}:{port}/machines\n")
+    sys.stdout.flush()
+
+    # stop cleanly as a service too
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.quit())
+
+    rc = EXIT_OK
+    try:
+        daemon.open()
+        daemon.loop()
+    except KeyboardInterrupt:
+        sys.stdout.write("Interrupted, stopping the machines\n")
+    except Exception:
+        typ, val, tb = sys.exc_info()
+        traceback.print_exception(typ, val, tb)
+        rc = EXIT_FAILED
+    daemon.shutdown()
+    return rc
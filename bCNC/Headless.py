@@ -0,0 +1,461 @@
+# $Id$
+#
+# Author: Vasilis Vlachoudis
+#  Email: vvlachoudis@gmail.com
+#   Date: 16-Oct-2026
+#
+# Stream a gcode file to the controller from the command line, without the
+# user interface. Neither tkinter nor any of the pages is imported, so that it
+# starts fast and small on a single board computer next to the machine:
+#
+#     python -m bCNC --headless -s /dev/ttyUSB0 --run job.nc
+
+import getopt
+import gettext
+import os
+import sys
+import time
+
+import Utils
+from CNC import CNC, GCode
+from Sender import Sender
+
+# _() of the Sender messages, as Helpers installs it for the user interface
+gettext.install(Utils.__prg__)
+
+__author__ = "Vasilis Vlachoudis"
+__email__ = "vvlachoudis@gmail.com"
+
+REPORT_EVERY = 5.0  # s, interval between the progress reports
+POLL = 0.05  # s, monitoring of the run
+
+# Exit codes
+EXIT_OK = 0
+EXIT_FAILED = 1  # the job was stopped by an error or an alarm
+EXIT_USAGE = 2  # bad arguments, the port or the file could not be opened
+EXIT_INTERRUPT = 130  # interrupted with Ctrl-C
+
+
+# =============================================================================
+# Sender without the user interface of Application
+# =============================================================================
+class Headless(Sender):
+    def __init__(self):
+        Sender.__init__(self)
+        self.errors = 0  # errors and alarms reported while running
+        self.remaining = None  # estimated time in seconds left to run
+        self._t0 = 0.0  # start time of the run
+        self._tlast = 0.0  # time of the last report
+        self._total = 0  # estimated items to run, while compiling
+        self._timeline = None
+        self._runPath = None  # last (block, line) executed
+        self._stopped = False  # stopped after an error
+
+    # ----------------------------------------------------------------------
+    # Methods expected from the user interface
+    # ----------------------------------------------------------------------
+    def disable(self):
+        pass
+
+    def enable(self):
+        pass
+
+    def busy(self):
+        pass
+
+    def notBusy(self):
+        pass
+
+    def event_generate(self, *args, **kwargs):
+        pass
+
+    def acceptKey(self, skipRun=False):
+        return True
+
+    def get(self, section, item):
+        return Utils.config.get(section, item)
+
+    # ----------------------------------------------------------------------
+    def loadConfig(self):
+        Sender.loadConfig(self)
+        self._onStart = Utils.getStr("Events", "onstart", "")
+        self._onStop = Utils.getStr("Events", "onstop", "")
+        self.gcode.header = CNC.header
+        self.gcode.footer = CNC.footer
+
+    # ----------------------------------------------------------------------
+    def message(self, text, error=False):
+        if error:
+            sys.stderr.write(f"{text}\n")
+        else:
+            sys.stdout.write(f"{text}\n")
+            sys.stdout.flush()
+
+    # ----------------------------------------------------------------------
+    # Show the messages of the controller the user has to know about
+    # ----------------------------------------------------------------------
+    def drainLog(self):
+        while not self.log.empty():
+            msg, line = self.log.get_nowait()
+            self.logMessage(msg, line)
+
+    # ----------------------------------------------------------------------
+    def logMessage(self, msg, line):
+        if msg == Sender.MSG_ERROR:
+            self.errors += 1
+            errline = CNC.vars["errline"]
+            if errline:
+                line = f"{line} [{errline.strip()}]"
+            self.message(f"ERROR: {line}", True)
+        elif msg == Sender.MSG_RUNEND:
+            if line:
+                self.message(line)
+
+    # ----------------------------------------------------------------------
+    # Show the progress of the run
+    # @param done items executed
+    # @param remaining estimated time in seconds left, None if unknown
+    # ----------------------------------------------------------------------
+    def report(self, done, remaining=None):
+        elapsed = time.time() - self._t0
+        if self._runLines == sys.maxsize:
+            total = self._total  # estimate, while still compiling
+        else:
+            total = self._runLines
+        total = max(total, done, 1)
+        rate = done / elapsed if elapsed > 0.0 else 0.0
+        if remaining is None:
+            eta = "-"
+        else:
+            eta = hms(remaining)
+        self.message(
+            f"{done}/{total} lines {100.0 * done / total:5.1f}%  "
+            f"{rate:.0f} lines/s  "
+            f"buffer {self.getBufferFill():3.0f}%  "
+            f"elapsed {hms(elapsed)}  "
+            f"ETA {eta}  "
+            f"[{CNC.vars['state']}]"
+        )
+
+    # ----------------------------------------------------------------------
+    # @return (block, line) of the journal to resume the loaded gcode from,
+    #         None if there is no run of it to resume
+    # ----------------------------------------------------------------------
+    def journalStart(self):
+        journal = self.journalRead()
+        if journal is None:
+            self.message("No run to resume", True)
+            return None
+        filename = self.gcode.filename
+        if filename:
+            filename = os.path.abspath(filename)
+        if journal["file"] != filename:
+            self.message(
+                f"The run to resume was of file {journal['file']}", True)
+            return None
+        return journal["block"], journal["line"]
+
+    # ----------------------------------------------------------------------
+    # Check the (block, line) to run from and show the commands restoring
+    # the modal state before it
+    # @return (block, line) within the gcode, None if invalid
+    # ----------------------------------------------------------------------
+    def checkStart(self, start):
+        bid, lid = start
+        if not 0 <= bid < len(self.gcode.blocks):
+            self.message(f"Block {bid + 1} doesn't exist", True)
+            return None
+        lid = max(0, min(lid, len(self.gcode.blocks[bid]) - 1))
+        try:
+            preamble, state, motion = self.gcode.resumePreamble(bid, lid)
+        except Exception:
+            self.message(f"Cannot run from: {sys.exc_info()[1]}", True)
+            return None
+        self.message(f"Run from block {bid + 1} line {lid + 1} after:")
+        for line in preamble:
+            self.message(f"\t{line}")
+        if motion:
+            self.message(f"\t{motion} with the first move")
+        return bid, lid
+
+    # ----------------------------------------------------------------------
+    # Start to run the loaded gcode like Application.run, then call
+    # runPoll() until it returns the exit code
+    # @param start (block, line) to run from, None from the beginning
+    # @return False if there is nothing to run
+    # ----------------------------------------------------------------------
+    def runStart(self, start=None):
+        if not any(block.enable and len(block) for block in self.gcode.blocks):
+            self.message("Nothing to run, the gcode is empty", True)
+            return False
+
+        self.initRun()
+        self._runLines = sys.maxsize
+        self._gcount = 0
+        self._selectI = 0
+        CNC.vars["running"] = True
+        CNC.vars["_OvChanged"] = True
+        if self._onStart:
+            try:
+                os.system(self._onStart)
+            except Exception:
+                pass
+
+        # lines are sent while being compiled, the progress is estimated
+        # on the enabled lines until the compilation ends
+        self._total = len(self.cnc.startup.splitlines()) + 1
+        for block in self.gcode.blocks:
+            if block.enable:
+                self._total += len(block)
+        if start is not None:
+            self._total -= start[1]
+            for block in self.gcode.blocks[:start[0]]:
+                if block.enable:
+                    self._total -= len(block)
+        self._timeline = self.gcode.timeline()
+        self.remaining = GCode.timeLeft(self._timeline, start)
+        self._runPath = None
+        self._stopped = False
+        self.errors = 0
+        self._t0 = self._tlast = time.time()
+        self.compileStart(start)
+        return True
+
+    # ----------------------------------------------------------------------
+    # Monitor the run as Application._monitorSerial does
+    # @return None while running, else the exit code
+    # ----------------------------------------------------------------------
+    def runPoll(self):
+        self.drainLog()
+        if self.running:
+            self._runStep()
+        if self.running:
+            return None
+        self.drainLog()
+        if self.errors:
+            self.message("Run failed", True)
+            return EXIT_FAILED
+        return EXIT_OK
+
+    # ----------------------------------------------------------------------
+    def _runStep(self):
+        if self.serial is None:
+            self.message("Connection lost", True)
+            self.errors += 1
+            self.runEnded()
+            return
+
+        # an error or an alarm stops the job
+        if self.errors and not self._stopped:
+            self._stopped = True
+            self.stopRun()
+
+        # Background compilation of the run ended
+        if self._compileThread is not None and not self.compileRunning():
+            result = self.compileFinish()
+            if result is None:
+                self.errors += 1
+                self.emptyQueue()
+                self.purgeController()
+            elif not result:
+                self.runEnded()
+
+        done = self.runIndex()
+        while self._selectI <= done and self._paths:
+            ij = self._paths.popleft()
+            self._selectI += 1
+            if ij:
+                self._runPath = ij
+        if self._runPath is not None:
+            self.journalWrite(self._runPath)
+            self.remaining = GCode.timeLeft(self._timeline, self._runPath)
+
+        now = time.time()
+        if self._gcount >= self._runLines:
+            if self._paths is not None and not self.errors:
+                self.journalClear()  # the job completed
+            self.remaining = 0.0
+            self.report(self._gcount, self.remaining)
+            self.runEnded()
+        elif now - self._tlast >= REPORT_EVERY:
+            self._tlast = now
+            self.report(done, self.remaining)
+
+    # ----------------------------------------------------------------------
+    # Stop the run and wait for the compilation to end
+    # ----------------------------------------------------------------------
+    def runAbort(self):
+        self.stopRun()
+        if self.compileRunning():
+            self.compileFinish()
+        self.runEnded()
+
+    # ----------------------------------------------------------------------
+    # Run the loaded gcode until it ends
+    # @param start (block, line) to run from, None from the beginning
+    # @return exit code
+    # ----------------------------------------------------------------------
+    def stream(self, start=None):
+        if not self.runStart(start):
+            return EXIT_USAGE
+        try:
+            while True:
+                time.sleep(POLL)
+                rc = self.runPoll()
+                if rc is not None:
+                    return rc
+        except KeyboardInterrupt:
+            self.message("Interrupted, stopping the run", True)
+            self.runAbort()
+            return EXIT_INTERRUPT
+
+
+# -----------------------------------------------------------------------------
+# @return seconds formatted as the status bar of the user interface
+# -----------------------------------------------------------------------------
+def hms(t):
+    h, s = divmod(t, 3600)
+    m, s = divmod(s, 60)
+    if h > 0:
+        return f"{int(h)}h{int(m):02d}m"
+    elif m > 0:
+        return f"{int(m)}m{int(s):02d}s"
+    return f"{int(s)}s"
+
+
+# -----------------------------------------------------------------------------
+def usage(rc):
+    wrt = sys.stdout.write
+    wrt(f"{Utils.__prg__} V{Utils.__version__} [{Utils.__date__}] headless\n")
+    wrt(f"{Utils.__author__} <{Utils.__email__}>\n\n")
+    wrt("Usage: --headless [options] filename\n\n")
+    wrt("Options:\n")
+    wrt("\t-b # | --baud #\t\tSet the baud rate\n")
+    wrt("\t-c # | --controller #\tSet the controller\n")
+    wrt("\t-h | -? | --help\tThis help page\n")
+    wrt("\t-i # | --ini #\t\tAlternative ini file\n")
+    wrt("\t-s # | --serial #\tOpen serial port specified\n")
+    wrt("\t--run\t\t\tRun the file once loaded\n")
+    wrt("\t--from #[,#]\t\tRun from block[,line] restoring the modal state\n")
+    wrt("\t--resume\t\tRun from where the last run was interrupted\n")
+    wrt("\n")
+    wrt("Exit codes:\n")
+    wrt(f"\t{EXIT_OK}\tjob completed\n")
+    wrt(f"\t{EXIT_FAILED}\tjob stopped by an error or an alarm\n")
+    wrt(f"\t{EXIT_USAGE}\tbad arguments, port or file not opened\n")
+    wrt(f"\t{EXIT_INTERRUPT}\tinterrupted\n")
+    return rc
+
+
+# -----------------------------------------------------------------------------
+def main(argv):
+    try:
+        optlist, args = getopt.gnu_getopt(
+            argv,
+            "?b:c:hi:s:",
+            [
+                "headless",
+                "help",
+                "ini=",
+                "serial=",
+                "baud=",
+                "controller=",
+                "run",
+                "from=",
+                "resume",
+            ],
+        )
+    except getopt.GetoptError:
+        return usage(EXIT_USAGE)
+
+    device = None
+    baud = None
+    controller = None
+    run = False
+    start = None
+    resume = False
+    for opt, val in optlist:
+        if opt in ("-h", "-?", "--help"):
+            return usage(EXIT_OK)
+        elif opt in ("-i", "--ini"):
+            Utils.iniUser = val
+        elif opt in ("-s", "--serial"):
+            device = val
+        elif opt in ("-b", "--baud"):
+            baud = val
+        elif opt in ("-c", "--controller"):
+            controller = val
+        elif opt == "--run":
+            run = True
+        elif opt == "--from":
+            try:
+                ids = [int(x) - 1 for x in val.split(",")]
+                start = (ids[0], ids[1] if len(ids) > 1 else 0)
+            except (ValueError, IndexError):
+                sys.stderr.write(f"Invalid block or line number: {val}\n")
+                return EXIT_USAGE
+            run = True
+        elif opt == "--resume":
+            resume = run = True
+
+    if len(args) != 1:
+        return usage(EXIT_USAGE)
+    Utils.loadConfiguration()
+
+    sender = Headless()
+    sender.loadConfig()
+    if controller is not None:
+        if controller not in sender.controllers:
+            sys.stderr.write(
+                f"Unknown controller {controller}, "
+                f"one of: {', '.join(sender.controllerList())}\n")
+            return EXIT_USAGE
+        sender.controllerSet(controller)
+
+    filename = args[0]
+    if not os.path.isfile(filename):
+        sys.stderr.write(f"Cannot load {filename}: file not found\n")
+        return EXIT_USAGE
+    try:
+        sender.load(filename)
+    except Exception:
+        sys.stderr.write(f"Cannot load {filename}: {sys.exc_info()[1]}\n")
+        return EXIT_USAGE
+    sys.stdout.write(
+        f"{filename}: {len(sender.gcode.blocks)} blocks, "
+        f"{sum(len(b) for b in sender.gcode.blocks)} lines\n")
+
+    if resume:
+        start = sender.journalStart()
+        if start is None:
+            return EXIT_USAGE
+
+    if start is not None:
+        start = sender.checkStart(start)
+        if start is None:
+            return EXIT_USAGE
+
+    if not run:
+        return EXIT_OK
+
+    if device is None:
+        device = Utils.getStr("Connection", "port")
+    if baud is None:
+        baud = Utils.getStr("Connection", "baud", "115200")
+    if not device:
+        sys.stderr.write("No serial port, use -s device\n")
+        return EXIT_USAGE
+    try:
+        sender.open(device, baud)
+    except Exception:
+        sender.serial = None
+        sender.thread = None
+        sys.stderr.write(f"Cannot open {device}: {sys.exc_info()[1]}\n")
+        return EXIT_USAGE
+    sys.stdout.write(f"{device} {CNC.vars['state']}\n")
+
+    try:
+        rc = sender.stream(start)
+    finally:
+        sender.close()
+    return rc
@@ -9,7 +9,6 @@ import re
 import tempfile
 import threading
 
-import Camera
 from CNC import CNC
 from Utils import prgpath
 
@@ -38,6 +37,13 @@ iconpath = f"{prgpath}/icons/"
 class Pendant(httpserver.BaseHTTPRequestHandler):
     camera = None
 
+    # ----------------------------------------------------------------------
+    # Application (Sender) controlled
+    # ----------------------------------------------------------------------
+    @property
+    def app(self):
+        return self.server.app
+
     # ----------------------------------------------------------------------
     def log_message(self, fmt, *args):
         # Only requests to the main page log them, all other ignore
@@ -70,9 +76,9 @@ class Pendant(httpserver.BaseHTTPRequestHandler):
             for key, value in arg.items():
                 if key == "gcode":
                     for line in value.split("\n"):
-                        httpd.app.queue.put(line + "\n")
+                        self.app.queue.put(line + "\n")
                 elif key == "cmd":
-                    httpd.app.pendant.put(urlparse.unquote(value))
+                    self.app.pendant.put(urlparse.unquote(value))
             # send empty response so browser does not generate errors
             self.do_HEAD(200, "text/text", cl=len(""))
             self.wfile.write(b"")
@@ -109,7 +115,7 @@ class Pendant(httpserver.BaseHTTPRequestHandler):
 
         elif page == "/config":
             snd = {}
-            snd["rpmmax"] = httpd.app.get("CNC", "spindlemax")
+            snd["rpmmax"] = self.app.get("CNC", "spindlemax")
             contentToSend = json.dumps(snd)
             self.do_HEAD(200, content="text/text", cl=len(contentToSend))
             self.wfile.write(contentToSend.encode())
@@ -128,10 +134,10 @@ class Pendant(httpserver.BaseHTTPRequestHandler):
                 pass
 
         elif page == "/canvas":
-            if not Image:
+            if not Image or getattr(self.app, "canvas", None) is None:
                 return
             with tempfile.NamedTemporaryFile(suffix=".ps") as tmp:
-                httpd.app.canvas.postscript(
+                self.app.canvas.postscript(
                     file=tmp.name,
                     colormode="color",
                 )
@@ -159,6 +165,8 @@ class Pendant(httpserver.BaseHTTPRequestHandler):
                         pass
 
         elif page == "/camera":
+            import Camera  # loads Pillow's ImageTk, only when asked
+
             if not Camera.hasOpenCV():
                 return
             if Pendant.camera is None:
@@ -231,7 +239,7 @@ class Pendant(httpserver.BaseHTTPRequestHandler):
     def do_POST(self):
         result, fMsg = self.deal_post_data()
         if result:
-            httpd.app._pendantFileUploaded = fMsg
+            self.app._pendantFileUploaded = fMsg
         # send empty response so browser does not generate errors
         self.do_HEAD(200, "text/text")
 
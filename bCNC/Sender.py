@@ -5,6 +5,7 @@
 #   Date: 17-Jun-2015
 
 import glob
+import json
 import os
 import re
 import sys
@@ -12,8 +13,9 @@ import threading
 import time
 import traceback
 import webbrowser
+from array import array
+from collections import deque
 from datetime import datetime
-from tkinter import messagebox
 from queue import (
     Empty,
     Queue,
@@ -23,23 +25,28 @@ import Pendant
 import rexx
 import Utils
 from CNC import CNC, MSG, UPDATE, WAIT, GCode
+from Transport import openTransport
 
 __author__ = "Vasilis Vlachoudis"
 __email__ = "vvlachoudis@gmail.com"
 
-try:
-    import serial
-except ImportError:
-    serial = None
-
 WIKI = "https://github.com/vlachoudis/bCNC/wiki"
 
-SERIAL_POLL = 0.125  # s
+SERIAL_POLL = 0.125  # s, status polling while running
+POLL_FAST = 0.05  # s, while jogging, homing, probing or waiting for Idle
+POLL_IDLE = 0.5  # s, when nothing is going on
+POLL_BUSY = 1.0  # s, poll at least at SERIAL_POLL so long after a command
+POLL_HELD = ("Hold", "Hold:0", "Door:0", "Door:1")  # stopped, polled slowly
 SERIAL_TIMEOUT = 0.10  # s
 G_POLL = 10  # s
-RX_BUFFER_SIZE = 128
+RX_BUFFER_SIZE = 128  # default, until the controller reports its own
+COMPILE_QUEUE = 1000  # max items queued ahead of the serial thread
+COMPILE_WAIT = 0.005  # s, polling of the queue when full
+JOURNAL_EVERY = 1.0  # s, minimum interval between the journal writes
+LINENUMBER_WRAP = 9999999  # largest line number N accepted by grbl
 
 GPAT = re.compile(r"[A-Za-z]\s*[-+]?\d+.*")
+NPAT = re.compile(r"^\s*[Nn]\s*\d+\s*")
 FEEDPAT = re.compile(r"^(.*)[fF](\d+\.?\d+)(.*)$")
 
 CONNECTED = "Connected"
@@ -68,6 +75,111 @@ STATECOLOR = {
 }
 
 
+# -----------------------------------------------------------------------------
+# Cost of a command in line mode flow control: one slot whatever its length
+# -----------------------------------------------------------------------------
+def _oneLine(line):
+    return 1
+
+
+# =============================================================================
+# Lengths of the commands sitting in the controller buffer, shared between
+# the reader and the writer thread. Behaves as the list the controllers
+# expect (append, del [0], del [:], pop(0), len, truth) while keeping a
+# running byte count so that the writer never has to sum() the pipeline
+# =============================================================================
+class BufferCount:
+    def __init__(self):
+        self._items = deque()
+        self._lock = threading.Lock()
+        self.total = 0
+
+    # ----------------------------------------------------------------------
+    def append(self, n):
+        with self._lock:
+            self._items.append(n)
+            self.total += n
+
+    # ----------------------------------------------------------------------
+    def pop(self, i=-1):
+        with self._lock:
+            n = self._items.popleft() if i == 0 else self._items.pop()
+            self.total -= n
+            return n
+
+    # ----------------------------------------------------------------------
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.total = 0
+
+    # ----------------------------------------------------------------------
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            if i != slice(None):
+                raise IndexError("BufferCount supports only del [:]")
+            self.clear()
+        elif i == 0:
+            self.pop(0)
+        else:
+            raise IndexError("BufferCount supports only del [0]")
+
+    # ----------------------------------------------------------------------
+    def __getitem__(self, i):
+        return self._items[i]
+
+    def __len__(self):
+        return len(self._items)
+
+    def __bool__(self):
+        return bool(self._items)
+
+
+# =============================================================================
+# Publish the entries of a dictionary (CNC.vars) that changed since the
+# last publish to the subscribers interested in them
+# =============================================================================
+class StateStore:
+    _UNSET = object()
+
+    def __init__(self, values):
+        self.values = values
+        self._last = {}  # value of every watched key at the last publish
+        self._subscribers = []  # (keys, callback)
+
+    # ----------------------------------------------------------------------
+    # callback(changed) is called with the set of the keys changed
+    # ----------------------------------------------------------------------
+    def subscribe(self, keys, callback):
+        keys = frozenset(keys)
+        self._subscribers.append((keys, callback))
+        for key in keys:
+            self._last.setdefault(key, StateStore._UNSET)
+
+    # ----------------------------------------------------------------------
+    # Force the next publish to report all the keys
+    # ----------------------------------------------------------------------
+    def invalidate(self):
+        for key in self._last:
+            self._last[key] = StateStore._UNSET
+
+    # ----------------------------------------------------------------------
+    def publish(self):
+        changed = set()
+        values = self.values
+        last = self._last
+        for key, old in last.items():
+            value = values.get(key)
+            if value != old:
+                last[key] = value
+                changed.add(key)
+        if changed:
+            for keys, callback in self._subscribers:
+                if not keys.isdisjoint(changed):
+                    callback(changed)
+        return changed
+
+
 # =============================================================================
 # bCNC Sender class
 # =============================================================================
@@ -83,6 +195,9 @@ class Sender:
     MSG_CLEAR = 6  # clear buffer
 
     def __init__(self):
+        # Variables of the machine, the ones bound to the creating thread
+        self.vars = CNC.vars.dict()
+
         # Global variables
         self.history = []
         self._historyPos = None
@@ -99,7 +214,22 @@ class Sender:
         self.queue = Queue()  # Command queue to be send to GRBL
         self.pendant = Queue()  # Command queue to be executed from Pendant
         self.serial = None
-        self.thread = None
+        self.thread = None  # writer thread, None when closed
+        self._reader = None  # reader thread
+        self._sioEvent = threading.Event()  # wakes the writer
+        self._cline = BufferCount()  # length of pipeline commands
+        self._unsent = 0  # counted in _cline, waiting for room to be sent
+        self._sline = []  # pipeline commands
+        self.rxBufferSize = RX_BUFFER_SIZE  # learned from the controller
+        self.loader = None  # GCode being loaded in the background
+        self._loadThread = None
+        self._loadFilename = None
+        self._loadResult = False
+        self._compileThread = None  # compiling gcode in the background
+        self._compiled = 0  # items compiled
+        self._compileResult = None
+        self._lineMap = None  # item of every line numbered while running
+        self._lineIndex = 0  # in _lineMap of the last line number reported
 
         self._posUpdate = False  # Update position
         self._probeUpdate = False  # Update probe
@@ -110,12 +240,15 @@ class Sender:
         self.runningPrev = None
         self.cleanAfter = False
         self._runLines = 0
+        self.journalFile = Utils.jouFile
+        self._journalPath = None  # (block, line) last written in the journal
+        self._journalTime = 0.0
         self._quit = 0  # Quit counter to exit program
         self._stop = False  # Raise to stop current run
         self._pause = False  # machine is on Hold
+        self._probing = 0.0  # time the last probing command was sent
         self._alarm = True  # Display alarm message if true
         self._msg = None
-        self._sumcline = 0
         self._lastFeed = 0
         self._newFeed = 0
 
@@ -136,6 +269,16 @@ class Sender:
                 typ, val, tb = sys.exc_info()
                 traceback.print_exception(typ, val, tb)
 
+    # ----------------------------------------------------------------------
+    # @return a thread running target(*args) with the variables of this
+    #         machine as CNC.vars
+    # ----------------------------------------------------------------------
+    def machineThread(self, target, *args):
+        def run():
+            with CNC.vars.bound(self.vars):
+                target(*args)
+        return threading.Thread(target=run)
+
     # ----------------------------------------------------------------------
     def controllerList(self):
         return sorted(self.controllers.keys())
@@ -149,6 +292,9 @@ class Sender:
 
     # ----------------------------------------------------------------------
     def quit(self, event=None):
+        self.loadCancel()
+        if self.compileRunning():
+            self._stop = True
         self.saveConfig()
         Pendant.stop()
 
@@ -264,6 +410,11 @@ class Sender:
         elif cmd == "RUN":
             self.run()
 
+        # RUNFROM [block [line]]: run g-code from the block and line,
+        # or from the line of the run to resume recorded in the journal
+        elif cmd == "RUNFROM":
+            self.runFrom(line[1:])
+
         # SAFE [z]: safe z to move
         elif cmd == "SAFE":
             try:
@@ -413,6 +564,8 @@ class Sender:
             # save orientation file
             self.gcode.orient.load(filename)
         elif ext == ".stl" or ext == ".ply":
+            from tkinter import messagebox
+
             messagebox.showinfo(
                 "Open 3D Mesh",
                 "Importing of 3D mesh files in .STL and .PLY format is "
@@ -433,6 +586,153 @@ class Sender:
             self._saveConfigFile()
         Utils.addRecent(filename)
 
+    # ----------------------------------------------------------------------
+    # Load or import a gcode, dxf or svg file in a background thread into a
+    # new GCode (self.loader). Its progress and progressMax can be polled
+    # until loadRunning() returns False, then call loadFinish()
+    # ----------------------------------------------------------------------
+    def loadStart(self, filename):
+        self.loader = GCode()
+        self.loader.header = self.gcode.header
+        self.loader.footer = self.gcode.footer
+        self._loadFilename = filename
+        self._loadResult = False
+        self._loadThread = self.machineThread(
+            self._loadIO, self.loader, filename)
+        self._loadThread.daemon = True
+        self._loadThread.start()
+
+    # ----------------------------------------------------------------------
+    def _loadIO(self, gcode, filename):
+        ext = os.path.splitext(filename)[1].lower()
+        try:
+            if ext == ".dxf":
+                result = gcode.importDXF(filename)
+            elif ext == ".svg":
+                result = gcode.importSVG(filename)
+            else:
+                result = gcode.load(filename)
+                if result and not gcode.isCancelled():
+                    # build the motion table here and not in the gui thread
+                    gcode.calculateMargins()
+        except Exception:
+            typ, val, tb = sys.exc_info()
+            traceback.print_exception(typ, val, tb)
+            result = False
+        self._loadResult = bool(result) and not gcode.isCancelled()
+
+    # ----------------------------------------------------------------------
+    def loadRunning(self):
+        return self._loadThread is not None and self._loadThread.is_alive()
+
+    # ----------------------------------------------------------------------
+    def loadCancel(self):
+        if self.loader is not None:
+            self.loader.cancelLoad()
+
+    # ----------------------------------------------------------------------
+    # Wait for the background load to end
+    # @param replace swap the loaded program into self.gcode
+    # @return the loaded GCode or None if it failed or was cancelled
+    # ----------------------------------------------------------------------
+    def loadFinish(self, replace=True):
+        if self._loadThread is None:
+            return None
+        self._loadThread.join()
+        self._loadThread = None
+        loader = self.loader
+        self.loader = None
+        if not self._loadResult:
+            return None
+        if replace:
+            self.gcode.assign(loader)
+            self._saveConfigFile(self._loadFilename)
+            Utils.addRecent(self._loadFilename)
+        return loader
+
+    # ----------------------------------------------------------------------
+    # Compile the enabled gcode in a background thread, while it is being
+    # sent. The lines are taken as they are now, editing the program
+    # during the run doesn't change what is sent. The queue is kept to at
+    # most COMPILE_QUEUE items so that the compilation advances only as
+    # fast as the serial thread sends.
+    # The (block, line) of every item is appended to self._paths.
+    # With CNC.linenumbers the lines of the program are numbered with N
+    # and the index of their item appended to self._lineMap, to follow the
+    # Ln: of the status reports.
+    # Poll compileRunning() until False, then call compileFinish()
+    # ----------------------------------------------------------------------
+    def compileStart(self, start=None):
+        self._paths = deque()
+        if CNC.linenumbers:
+            self._lineMap = array("q")
+        else:
+            self._lineMap = None
+        self._lineIndex = 0
+        self._compiled = 0
+        self._compileResult = None
+        self._compileThread = self.machineThread(
+            self._compileIO, start, self.gcode.snapshot())
+        self._compileThread.daemon = True
+        self._compileThread.start()
+
+    # ----------------------------------------------------------------------
+    def _compileIO(self, start=None, blocks=None):
+        paths = self._paths
+        lineMap = self._lineMap
+        # Lines are queued already case folded and encoded, so that the
+        # serial thread can coalesce them into a single write. Controllers
+        # without feed override need the text to rewrite the feed on the fly
+        encode = self.mcontrol.has_override
+        case = self.mcontrol.gcode_case
+        try:
+            for line, path in self.gcode.iterCompile(start, blocks):
+                while self.queue.qsize() >= COMPILE_QUEUE and not self._stop:
+                    time.sleep(COMPILE_WAIT)
+                if self._stop:
+                    return
+                if line is not None:
+                    if (lineMap is not None and path is not None
+                            and isinstance(line, str)
+                            and line[:1] not in "$%(;"):
+                        n = len(lineMap) % LINENUMBER_WRAP + 1
+                        line = f"N{n}{NPAT.sub('', line)}"
+                        lineMap.append(self._compiled)
+                    if encode and isinstance(line, str):
+                        if case > 0:
+                            line = line.upper()
+                        elif case < 0:
+                            line = line.lower()
+                        line = line.encode()
+                    self.queue.put(line)
+                paths.append(path)
+                self._compiled += 1
+        except Exception:
+            for s in str(sys.exc_info()[1]).splitlines():
+                self.log.put((Sender.MSG_ERROR, s))
+            return
+        if self._compiled:
+            # the buffer of the machine should be empty?
+            self._runLines = self._compiled + 1  # plus the wait
+            self.queue.put((WAIT,))  # wait at the end to become idle
+        self._compileResult = self._compiled
+
+    # ----------------------------------------------------------------------
+    def compileRunning(self):
+        return (self._compileThread is not None
+                and self._compileThread.is_alive())
+
+    # ----------------------------------------------------------------------
+    # Wait for the background compilation to end
+    # @return number of items compiled, None if it was stopped or failed
+    # ----------------------------------------------------------------------
+    def compileFinish(self):
+        if self._compileThread is None:
+            return None
+        self._compileThread.join()
+        self._compileThread = None
+        return self._compileResult
+
     # ----------------------------------------------------------------------
     def save(self, filename):
         fn, ext = os.path.splitext(filename)
@@ -482,19 +782,10 @@ class Sender:
         return ret
 
     # ----------------------------------------------------------------------
-    # Open serial port
+    # Open serial port, or a tcp://, telnet:// or pty: connection
     # ----------------------------------------------------------------------
     def open(self, device, baudrate):
-        self.serial = serial.serial_for_url(
-            device.replace("\\", "\\\\"),  # Escape for windows
-            baudrate,
-            bytesize=serial.EIGHTBITS,
-            parity=serial.PARITY_NONE,
-            stopbits=serial.STOPBITS_ONE,
-            timeout=SERIAL_TIMEOUT,
-            xonxoff=False,
-            rtscts=False,
-        )
+        self.serial = openTransport(device, baudrate, SERIAL_TIMEOUT)
         # Toggle DTR to reset Arduino
         try:
             self.serial.setDTR(0)
@@ -515,8 +806,16 @@ class Sender:
         self.mcontrol.initController()
         self._gcount = 0
         self._alarm = True
-        self.thread = threading.Thread(target=self.serialIO)
+        self._cline = BufferCount()
+        self._unsent = 0
+        self._sline = []
+        self.rxBufferSize = RX_BUFFER_SIZE
+        self._sioEvent.clear()
+        self.thread = self.machineThread(self.serialIO)
         self.thread.start()
+        self._reader = self.machineThread(self.serialRead)
+        self._reader.daemon = True
+        self._reader.start()
         return True
 
     # ----------------------------------------------------------------------
@@ -531,6 +830,8 @@ class Sender:
             pass
         self._runLines = 0
         self.thread = None
+        self._reader = None
+        self._sioEvent.set()
         time.sleep(1)
         try:
             self.serial.close()
@@ -642,13 +943,19 @@ class Sender:
 
     # ----------------------------------------------------------------------
     def getBufferFill(self):
-        return self._sumcline * 100.0 / RX_BUFFER_SIZE
+        window = self.mcontrol.linesInFlight()
+        sent = max(0, self._cline.total - self._unsent)
+        return sent * 100.0 / (window or self.rxBufferSize)
 
     # ----------------------------------------------------------------------
     def initRun(self):
         self._quit = 0
         self._pause = False
         self._paths = None
+        self._lineMap = None
+        CNC.vars["Ln"] = 0
+        self._journalPath = None
+        self._journalTime = 0.0
         self.running = True
         self.disable()
         self.emptyQueue()
@@ -662,6 +969,12 @@ class Sender:
             self.log.put((Sender.MSG_RUNEND, _("Run ended")))
             self.log.put((Sender.MSG_RUNEND, str(datetime.now())))
             self.log.put((Sender.MSG_RUNEND, str(CNC.vars["msg"])))
+            # _paths is drained while running, it is only None when the
+            # run was not compiled by compileStart()
+            if self._paths is not None:
+                for stage in (self.gcode.fitter, self.gcode.reducer):
+                    if stage is not None:
+                        self.log.put((Sender.MSG_RUNEND, stage.report()))
             if self._onStop:
                 try:
                     os.system(self._onStop)
@@ -674,6 +987,78 @@ class Sender:
         self.running = False
         CNC.vars["running"] = False
 
+    # ----------------------------------------------------------------------
+    # @return index of the item in execution: the one of the line number
+    #         reported by the controller, else the last acknowledged
+    # ----------------------------------------------------------------------
+    def runIndex(self):
+        number = CNC.vars["Ln"]
+        lineMap = self._lineMap
+        if not number or not lineMap:
+            return self._gcount
+        # numbers wrap around, take the closest to the last one
+        last = self._lineIndex
+        i = last - last % LINENUMBER_WRAP + number - 1
+        if i < last - LINENUMBER_WRAP // 2:
+            i += LINENUMBER_WRAP
+        elif i > last + LINENUMBER_WRAP // 2:
+            i -= LINENUMBER_WRAP
+        if not 0 <= i < len(lineMap):
+            return self._gcount
+        self._lineIndex = i
+        return min(lineMap[i], self._gcount)
+
+    # ----------------------------------------------------------------------
+    # Record in the journal the (block, line) last acknowledged while
+    # running, to resume from it after a crash or a power loss.
+    # The file is replaced atomically, a crash leaves the old or the new one
+    # ----------------------------------------------------------------------
+    def journalWrite(self, path):
+        now = time.time()
+        if (path == self._journalPath
+                or now - self._journalTime < JOURNAL_EVERY):
+            return
+        self._journalPath = path
+        self._journalTime = now
+        filename = self.gcode.filename
+        if filename:
+            filename = os.path.abspath(filename)
+        tmp = self.journalFile + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump({
+                    "file": filename,
+                    "block": path[0],
+                    "line": path[1],
+                    "count": self._gcount,
+                    "time": now,
+                }, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.journalFile)
+        except OSError:
+            pass
+
+    # ----------------------------------------------------------------------
+    # @return the journal of the last run not ended, None if missing
+    # ----------------------------------------------------------------------
+    def journalRead(self):
+        try:
+            with open(self.journalFile) as f:
+                journal = json.load(f)
+            journal["block"] = int(journal["block"])
+            journal["line"] = int(journal["line"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return journal
+
+    # ----------------------------------------------------------------------
+    def journalClear(self):
+        try:
+            os.remove(self.journalFile)
+        except OSError:
+            pass
+
     # ----------------------------------------------------------------------
     # Stop the current run
     # ----------------------------------------------------------------------
@@ -712,74 +1097,138 @@ class Sender:
             self.jobDone()
 
     # ----------------------------------------------------------------------
-    # thread performing I/O on serial line
+    # Interval of the status reports: fast when the position moves quickly
+    # or a WAIT depends on it, slow when nothing happens. The same holds
+    # during a job: a job in feed hold or at a closed door that stopped
+    # taking lines is polled as an idle machine, until it moves or is sent
+    # a command again
+    # ----------------------------------------------------------------------
+    def statusPoll(self, t, lastWrite):
+        state = CNC.vars["state"]
+        if state in ("Jog", "Home") or self.sio_wait:
+            return POLL_FAST
+        if self._probing:
+            if state == "Run" or t - self._probing < POLL_BUSY:
+                return POLL_FAST
+            self._probing = 0.0
+        if state == "Run" or t - lastWrite < POLL_BUSY:
+            return SERIAL_POLL
+        if self.running and state not in POLL_HELD:
+            return SERIAL_POLL  # between moves, the next one may start
+        return POLL_IDLE
+
+    # ----------------------------------------------------------------------
+    # thread reading the serial line. Blocks on readline() and wakes the
+    # writer after every reply, since any of them (ok, error, status) may
+    # free space in the controller buffer or release a WAIT
+    # ----------------------------------------------------------------------
+    def serialRead(self):
+        while self.thread:
+            try:
+                line = self.serial.readline().decode("ascii", "ignore")
+                line = line.strip()
+            except Exception:
+                if self.thread is None:
+                    break  # port closed underneath us
+                self.log.put((Sender.MSG_RECEIVE, str(sys.exc_info()[1])))
+                self.emptyQueue()
+                self.close()
+                return
+
+            if not line:
+                continue
+            if not self.mcontrol.parseLine(line, self._cline, self._sline):
+                self.log.put((Sender.MSG_RECEIVE, line))
+            self._sioEvent.set()
+
+    # ----------------------------------------------------------------------
+    # thread writing to the serial line. Sleeps on the command queue when
+    # there is nothing to send, or on the reader event while the controller
+    # buffer is full, paused or waiting to become Idle
     # ----------------------------------------------------------------------
     def serialIO(self):
         # wait for commands to complete (status change to Idle)
         self.sio_wait = False
         self.sio_status = False  # waiting for status <...> report
-        cline = []  # length of pipeline commands
-        sline = []  # pipeline commands
+        cline = self._cline  # length of pipeline commands
+        sline = self._sline  # pipeline commands
         tosend = None  # next string to send
+        pending = None  # command fetched while coalescing, still to process
         tr = tg = time.time()  # last time a ? or $G was send to grbl
+        tw = 0.0  # last time a command was written
 
         while self.thread:
+            # clear before looking at the buffers, so that a reply arriving
+            # from now on is not missed by the wait() below
+            self._sioEvent.clear()
             t = time.time()
+            # flow control: characters in the controller rx buffer, or
+            # lines waiting for their reply in line mode
+            if self.mcontrol.linesInFlight() is None:
+                cost = len
+            else:
+                cost = _oneLine
             # refresh machine position?
-            if t - tr > SERIAL_POLL:
+            poll = self.statusPoll(t, tw)
+            if t - tr > poll:
                 self.mcontrol.viewStatusReport()
                 tr = t
 
                 # If Override change, attach feed
                 if CNC.vars["_OvChanged"]:
                     self.mcontrol.overrideSet()
+            timeout = max(0.0, tr + poll - t)
 
             # Fetch new command to send if...
-            if (
-                tosend is None
-                and not self.sio_wait
-                and not self._pause
-                and self.queue.qsize() > 0
-            ):
-                try:
-                    tosend = self.queue.get_nowait()
-                    if isinstance(tosend, tuple):
-                        # wait to empty the grbl buffer and status is Idle
-                        if tosend[0] == WAIT:
-                            # Don't count WAIT until we are idle!
-                            self.sio_wait = True
-                        elif tosend[0] == MSG:
-                            # Count executed commands as well
-                            self._gcount += 1
-                            if tosend[1] is not None:
-                                # show our message on machine status
-                                self._msg = tosend[1]
-                        elif tosend[0] == UPDATE:
-                            # Count executed commands as well
-                            self._gcount += 1
-                            self._update = tosend[1]
+            if tosend is None and not self.sio_wait and not self._pause:
+                if pending is not None:
+                    tosend, pending = pending, None
+                else:
+                    try:
+                        tosend = self.queue.get(timeout=timeout)
+                    except Empty:
+                        continue
+
+                if isinstance(tosend, bytes):
+                    # pre-encoded by the compiler, only bookkeeping left
+                    sline.append(tosend)
+                    cline.append(cost(tosend))
+
+                elif isinstance(tosend, tuple):
+                    # wait to empty the grbl buffer and status is Idle
+                    if tosend[0] == WAIT:
+                        # Don't count WAIT until we are idle!
+                        self.sio_wait = True
+                    elif tosend[0] == MSG:
+                        # Count executed commands as well
+                        self._gcount += 1
+                        if tosend[1] is not None:
+                            # show our message on machine status
+                            self._msg = tosend[1]
+                    elif tosend[0] == UPDATE:
+                        # Count executed commands as well
+                        self._gcount += 1
+                        self._update = tosend[1]
+                    else:
+                        # Count executed commands as well
+                        self._gcount += 1
+                    tosend = None
+
+                elif not isinstance(tosend, str):
+                    try:
+                        tosend = self.gcode.evaluate(tosend, self)
+                        if isinstance(tosend, str):
+                            tosend += "\n"
                         else:
                             # Count executed commands as well
                             self._gcount += 1
+                    except Exception:
+                        for s in str(sys.exc_info()[1]).splitlines():
+                            self.log.put((Sender.MSG_ERROR, s))
+                        self._gcount += 1
                         tosend = None
 
-                    elif not isinstance(tosend, str):
-                        try:
-                            tosend = self.gcode.evaluate(tosend, self)
-                            if isinstance(tosend, str):
-                                tosend += "\n"
-                            else:
-                                # Count executed commands as well
-                                self._gcount += 1
-                        except Exception:
-                            for s in str(sys.exc_info()[1]).splitlines():
-                                self.log.put((Sender.MSG_ERROR, s))
-                            self._gcount += 1
-                            tosend = None
-                except Empty:
-                    break
-
-                if tosend is not None:
+                if isinstance(tosend, str):
                     # All modification in tosend should be
                     # done before adding it to cline
 
@@ -818,29 +1267,12 @@ class Sender:
 
                     # Bookkeeping of the buffers
                     sline.append(tosend)
-                    cline.append(len(tosend))
-
-            # Anything to receive?
-            if self.serial.inWaiting() or tosend is None:
-                try:
-                    line = str(self.serial.readline().decode("ascii", "ignore")).strip()
-                except Exception:
-                    self.log.put((Sender.MSG_RECEIVE, str(sys.exc_info()[1])))
-                    self.emptyQueue()
-                    self.close()
-                    return
-
-                if not line:
-                    pass
-                elif self.mcontrol.parseLine(line, cline, sline):
-                    pass
-                else:
-                    self.log.put((Sender.MSG_RECEIVE, line))
+                    cline.append(cost(tosend))
 
             # Received external message to stop
             if self._stop:
                 self.emptyQueue()
-                tosend = None
+                tosend = pending = None
                 self.log.put((Sender.MSG_CLEAR, ""))
                 # WARNING if runLines==maxint then it means we are
                 # still preparing/sending lines from from bCNC.run(),
@@ -848,18 +1280,59 @@ class Sender:
                 if self._runLines != sys.maxsize:
                     self._stop = False
 
-            if tosend is not None and sum(cline) < RX_BUFFER_SIZE:
-                self._sumcline = sum(cline)
-                if self.mcontrol.gcode_case > 0:
-                    tosend = tosend.upper()
-                if self.mcontrol.gcode_case < 0:
-                    tosend = tosend.lower()
-
-                self.serial_write(tosend)
+            # room is the most that may be in flight once the next command
+            # is written, as it is counted in cline before being sent. The
+            # rx ring of the controller holds one byte less than its size.
+            # Asked after fetching, the window may shrink meanwhile
+            window = self.mcontrol.linesInFlight()
+            room = self.rxBufferSize - 1 if window is None else window
+            self._unsent = 0 if tosend is None else cost(tosend)
+            if tosend is not None and cline.total <= room:
+                if isinstance(tosend, str):
+                    if self.mcontrol.gcode_case > 0:
+                        tosend = tosend.upper()
+                    if self.mcontrol.gcode_case < 0:
+                        tosend = tosend.lower()
+                    if "G38" in tosend.upper():
+                        self._probing = t
+                    self.log.put((Sender.MSG_BUFFER, tosend))
+                    tosend = tosend.encode()
+                else:
+                    self.log.put((Sender.MSG_BUFFER, tosend))
+                batch = [tosend]
+                tosend = None
 
-                self.log.put((Sender.MSG_BUFFER, tosend))
+                # Coalesce the following pre-encoded lines that fit in the
+                # free space of the controller buffer into the same write
+                while pending is None and not self._stop:
+                    try:
+                        item = self.queue.get_nowait()
+                    except Empty:
+                        break
+                    if not isinstance(item, bytes):
+                        pending = item
+                        break
+                    sline.append(item)
+                    cline.append(cost(item))
+                    if cline.total > room:
+                        tosend = item  # counted, sent when space is freed
+                        break
+                    self.log.put((Sender.MSG_BUFFER, item))
+                    batch.append(item)
+
+                # log before writing, the reader may get the ok right away
+                self._unsent = 0 if tosend is None else cost(tosend)
+                self.serial_write(b"".join(batch))
+                tw = t
 
-                tosend = None
                 if not self.running and t - tg > G_POLL:
                     self.mcontrol.viewState()
                     tg = t
+                continue
+
+            if tosend is None and not self.sio_wait and not self._pause:
+                continue  # command consumed, fetch the next one
+
+            # Buffer full, paused or waiting for Idle: sleep until the
+            # reader hears from the controller or the next status poll
+            self._sioEvent.wait(timeout)
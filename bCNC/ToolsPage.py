@@ -642,6 +642,8 @@ class Config(_Base):
             ("feedmax_x", "mm", 3000.0, _("Feed max x")),
             ("feedmax_y", "mm", 3000.0, _("Feed max y")),
             ("feedmax_z", "mm", 2000.0, _("Feed max z")),
+            ("junction_deviation", "mm", 0.01, _("Junction deviation")),
+            ("arc_tolerance", "mm", 0.002, _("Arc tolerance")),
             ("travel_x", "mm", 200, _("Travel x")),
             ("travel_y", "mm", 200, _("Travel y")),
             ("travel_z", "mm", 100, _("Travel z")),
@@ -651,6 +653,10 @@ class Config(_Base):
             ("spindlemin", "int", 0, _("Spindle min (RPM)")),
             ("spindlemax", "int", 12000, _("Spindle max (RPM)")),
             ("drozeropad", "int", 0, _("DRO Zero padding")),
+            ("linecache", "int", 100000, _("Parsed lines cache size")),
+            ("reducestream", "bool", 0, _("Reduce streamed gcode")),
+            ("arcfit", "mm", 0.0, _("Arc fit tolerance when streaming")),
+            ("linenumbers", "bool", 0, _("Number streamed lines")),
             ("header", "text", "", _("Header gcode")),
             ("footer", "text", "", _("Footer gcode")),
             ("init", "text", "", _("Connection init string")),
@@ -0,0 +1,453 @@
+# Transports to talk with the motion controller
+#
+# Everything the Sender and the controllers need from "self.serial":
+# write(), readline(), flush(), flushInput(), inWaiting(), setDTR() and
+# close(), following the pyserial names. Besides pyserial the network and
+# pty transports run an asyncio event loop in a background thread, so the
+# writes never block the caller and the reads are waited with a timeout.
+#
+# Device names understood by openTransport():
+#       tcp://host:port         raw TCP socket (grblHAL, ESP32 boards)
+#       telnet://host:port      TCP with the telnet negotiation refused
+#       pty:command [args]      run command on a local pseudo terminal
+#       anything else           pyserial serial_for_url()
+
+import asyncio
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+from queue import Empty, Queue
+
+try:
+    import pty
+    import tty
+except ImportError:
+    pty = None
+
+try:
+    import serial
+except ImportError:
+    serial = None
+
+__author__ = "Vasilis Vlachoudis"
+__email__ = "vvlachoudis@gmail.com"
+
+READ_SIZE = 4096
+
+# Telnet commands
+IAC = 255
+DONT = 254
+DO = 253
+WONT = 252
+WILL = 251
+SB = 250
+SE = 240
+
+
+# -----------------------------------------------------------------------------
+# Open the transport matching the device name
+# -----------------------------------------------------------------------------
+def openTransport(device, baudrate, timeout):
+    if device.startswith("tcp://"):
+        host, port = _hostPort(device[6:])
+        return TcpTransport(host, port, timeout)
+    if device.startswith("telnet://"):
+        host, port = _hostPort(device[9:], 23)
+        return TelnetTransport(host, port, timeout)
+    if device.startswith("pty:"):
+        return PtyTransport(device[4:], timeout)
+    if serial is None:
+        raise OSError("pyserial is not installed")
+    return SerialTransport(device, baudrate, timeout)
+
+
+# -----------------------------------------------------------------------------
+def _hostPort(address, port=None):
+    host, _, p = address.rstrip("/").rpartition(":")
+    if not host:
+        if port is None:
+            raise ValueError(f"Port missing from address {address}")
+        return address.rstrip("/"), port
+    return host.strip("[]"), int(p)
+
+
+# =============================================================================
+# Serial port through pyserial
+# =============================================================================
+class SerialTransport:
+    def __init__(self, device, baudrate, timeout):
+        self.port = serial.serial_for_url(
+            device.replace("\\", "\\\\"),  # Escape for windows
+            baudrate,
+            bytesize=serial.EIGHTBITS,
+            parity=serial.PARITY_NONE,
+            stopbits=serial.STOPBITS_ONE,
+            timeout=timeout,
+            xonxoff=False,
+            rtscts=False,
+        )
+
+    def write(self, data):
+        return self.port.write(data)
+
+    def readline(self):
+        return self.port.readline()
+
+    def flush(self):
+        self.port.flush()
+
+    def flushInput(self):
+        self.port.flushInput()
+
+    def inWaiting(self):
+        return self.port.inWaiting()
+
+    def setDTR(self, value):
+        self.port.setDTR(value)
+
+    def close(self):
+        self.port.close()
+
+
+# =============================================================================
+# Base of the transports served by an asyncio loop in a background thread.
+# The loop splits the incoming bytes into lines, which the caller picks up
+# from a thread safe queue. Writes are handed to the loop without waiting.
+# =============================================================================
+class AsyncTransport:
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._lines = Queue()  # received lines or the exception to raise
+        self._partial = b""
+        self._error = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        try:
+            self._call(self.connect())
+        except Exception:
+            self._stopLoop()
+            raise
+
+    # ----------------------------------------------------------------------
+    # Run a coroutine in the loop and wait for its result
+    # ----------------------------------------------------------------------
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    # ----------------------------------------------------------------------
+    def _stopLoop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    # ----------------------------------------------------------------------
+    # Called in the loop with the data as it arrives
+    # ----------------------------------------------------------------------
+    def received(self, data):
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self._lines.put(line + b"\n")
+
+    # ----------------------------------------------------------------------
+    # Called in the loop when the connection is lost
+    # ----------------------------------------------------------------------
+    def lost(self, error=None):
+        if self._error is None:
+            self._error = error or ConnectionError("Connection closed")
+            self._lines.put(self._error)
+
+    # ----------------------------------------------------------------------
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        if isinstance(data, str):
+            data = data.encode()
+        self._loop.call_soon_threadsafe(self.send, bytes(data))
+        return len(data)
+
+    # ----------------------------------------------------------------------
+    # Wait for one line, return b"" on timeout like pyserial
+    # ----------------------------------------------------------------------
+    def readline(self):
+        try:
+            line = self._lines.get(timeout=self.timeout)
+        except Empty:
+            return b""
+        if isinstance(line, Exception):
+            self._lines.put(line)  # keep failing
+            raise line
+        return line
+
+    # ----------------------------------------------------------------------
+    def flush(self):
+        if self._error is None:
+            self._call(self.drain())
+
+    # ----------------------------------------------------------------------
+    def flushInput(self):
+        while True:
+            try:
+                line = self._lines.get_nowait()
+            except Empty:
+                break
+            if isinstance(line, Exception):
+                self._lines.put(line)
+                break
+        self._partial = b""
+
+    # ----------------------------------------------------------------------
+    def inWaiting(self):
+        return self._lines.qsize()
+
+    # ----------------------------------------------------------------------
+    # Nothing to reset on a network or pty connection
+    # ----------------------------------------------------------------------
+    def setDTR(self, value):
+        pass
+
+    # ----------------------------------------------------------------------
+    def close(self):
+        if self._loop.is_closed():
+            return
+        try:
+            self._call(self.disconnect())
+        finally:
+            self.lost()
+            self._stopLoop()
+
+    # ----------------------------------------------------------------------
+    # To be provided by the backends, all running in the loop
+    # ----------------------------------------------------------------------
+    async def connect(self):
+        raise NotImplementedError
+
+    def send(self, data):
+        raise NotImplementedError
+
+    async def drain(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+
+# =============================================================================
+# Raw TCP socket
+# =============================================================================
+class TcpTransport(AsyncTransport):
+    def __init__(self, host, port, timeout):
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+        self._task = None
+        AsyncTransport.__init__(self, timeout)
+
+    # ----------------------------------------------------------------------
+    async def connect(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), 5.0)
+        sock = self._writer.get_extra_info("socket")
+        if sock is not None:
+            # every line is a packet of its own, don't wait to fill it
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._task = asyncio.ensure_future(self._readLoop())
+
+    # ----------------------------------------------------------------------
+    async def _readLoop(self):
+        try:
+            while True:
+                data = await self._reader.read(READ_SIZE)
+                if not data:
+                    break
+                self.received(data)
+        except asyncio.CancelledError:
+            return
+        except OSError as e:
+            self.lost(e)
+            return
+        self.lost()
+
+    # ----------------------------------------------------------------------
+    def send(self, data):
+        if not self._writer.is_closing():
+            self._writer.write(data)
+
+    # ----------------------------------------------------------------------
+    async def drain(self):
+        try:
+            await self._writer.drain()
+        except OSError as e:
+            self.lost(e)
+
+    # ----------------------------------------------------------------------
+    async def disconnect(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._writer.close()
+
+
+# =============================================================================
+# TCP socket to a telnet server. The options offered are refused, so the
+# connection behaves as a raw one, and the 0xFF bytes are escaped.
+# =============================================================================
+class TelnetTransport(TcpTransport):
+    def __init__(self, host, port, timeout):
+        self._iac = b""  # incomplete command at the end of the last read
+        TcpTransport.__init__(self, host, port, timeout)
+
+    # ----------------------------------------------------------------------
+    def received(self, data):
+        data = self._iac + data
+        self._iac = b""
+        out = bytearray()
+        i = 0
+        n = len(data)
+        while i < n:
+            c = data[i]
+            if c != IAC:
+                j = data.find(IAC, i)
+                if j < 0:
+                    j = n
+                out += data[i:j]
+                i = j
+                continue
+            if i + 1 >= n:
+                self._iac = data[i:]
+                break
+            cmd = data[i + 1]
+            if cmd == IAC:
+                out.append(IAC)
+                i += 2
+            elif cmd in (DO, DONT, WILL, WONT):
+                if i + 2 >= n:
+                    self._iac = data[i:]
+                    break
+                if cmd == DO:
+                    self.send(bytes((IAC, WONT, data[i + 2])))
+                elif cmd == WILL:
+                    self.send(bytes((IAC, DONT, data[i + 2])))
+                i += 3
+            elif cmd == SB:
+                j = data.find(bytes((IAC, SE)), i + 2)
+                if j < 0:
+                    self._iac = data[i:]
+                    break
+                i = j + 2
+            else:
+                i += 2
+        if out:
+            TcpTransport.received(self, bytes(out))
+
+    # ----------------------------------------------------------------------
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        TcpTransport.write(self, data.replace(b"\xff", b"\xff\xff"))
+        return len(data)
+
+
+# =============================================================================
+# Command running on a local pseudo terminal, e.g. a simulator
+# =============================================================================
+class PtyTransport(AsyncTransport):
+    def __init__(self, command, timeout):
+        if pty is None:
+            raise OSError("pty is not available on " + sys.platform)
+        self.command = command
+        self.process = None
+        self._fd = None
+        self._pending = bytearray()  # written data waiting for the pty
+        AsyncTransport.__init__(self, timeout)
+
+    # ----------------------------------------------------------------------
+    async def connect(self):
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        try:
+            self.process = subprocess.Popen(
+                shlex.split(self.command),
+                stdin=slave,
+                stdout=slave,
+                stderr=subprocess.DEVNULL,
+                close_fds=True,
+                start_new_session=True,
+            )
+        except OSError:
+            os.close(master)
+            raise
+        finally:
+            os.close(slave)
+        self._fd = master
+        os.set_blocking(master, False)
+        self._loop.add_reader(master, self._read)
+
+    # ----------------------------------------------------------------------
+    def _read(self):
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:  # EIO once the command exits
+            data = b""
+            self.lost(e)
+        if data:
+            self.received(data)
+        else:
+            self._loop.remove_reader(self._fd)
+            self.lost()
+
+    # ----------------------------------------------------------------------
+    def send(self, data):
+        if self._pending:
+            self._pending += data
+            return
+        try:
+            n = os.write(self._fd, data)
+        except BlockingIOError:
+            n = 0
+        except OSError as e:
+            self.lost(e)
+            return
+        if n < len(data):
+            self._pending += data[n:]
+            self._loop.add_writer(self._fd, self._sendPending)
+
+    # ----------------------------------------------------------------------
+    def _sendPending(self):
+        try:
+            n = os.write(self._fd, self._pending)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._pending.clear()
+            self.lost(e)
+            n = 0
+        del self._pending[:n]
+        if not self._pending:
+            self._loop.remove_writer(self._fd)
+
+    # ----------------------------------------------------------------------
+    async def drain(self):
+        while self._pending and self._error is None:
+            await asyncio.sleep(0.001)
+
+    # ----------------------------------------------------------------------
+    async def disconnect(self):
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            self._loop.remove_writer(self._fd)
+            os.close(self._fd)
+            self._fd = None
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(1.0)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
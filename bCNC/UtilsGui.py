@@ -0,0 +1,410 @@
+# Dialogs and widgets of the utilities, kept apart from Utils so that the
+# configuration can be used without tkinter. Accessed as Utils.ReportDialog,
+# Utils.UserButton and Utils.UserButtonDialog
+#
+# Author: Vasilis Vlachoudis
+#  Email: Vasilis.Vlachoudis@cern.ch
+#   Date: 16-Apr-2015
+
+import os
+import sys
+from tkinter import (
+    YES,
+    N,
+    W,
+    E,
+    EW,
+    X,
+    Y,
+    BOTH,
+    LEFT,
+    TOP,
+    RIGHT,
+    BOTTOM,
+    RAISED,
+    VERTICAL,
+    END,
+    DISABLED,
+    TkVersion,
+    TclVersion,
+    BooleanVar,
+    Toplevel,
+    Button,
+    Checkbutton,
+    Entry,
+    Frame,
+    Label,
+    Scrollbar,
+    Text,
+    LabelFrame,
+    messagebox,
+)
+
+import Ribbon
+import tkExtra
+import Utils
+
+__author__ = "Vasilis Vlachoudis"
+__email__ = "vvlachoudis@gmail.com"
+
+
+# =============================================================================
+# Error message reporting dialog
+# =============================================================================
+class ReportDialog(Toplevel):
+    _shown = False  # avoid re-entry when multiple errors are displayed
+
+    def __init__(self, master):
+        if ReportDialog._shown:
+            return
+        ReportDialog._shown = True
+
+        Toplevel.__init__(self, master)
+        if master is not None:
+            self.transient(master)
+        self.title(_("Error Reporting"))
+
+        # Label Frame
+        frame = LabelFrame(self, text=_("Report"))
+        frame.pack(side=TOP, expand=YES, fill=BOTH)
+
+        la = Label(
+            frame,
+            text=_("The following report is about to be send "
+                   + "to the author of {}").format(Utils.__prg__),
+            justify=LEFT,
+            anchor=W,
+        )
+        la.pack(side=TOP)
+
+        self.text = Text(frame, background=tkExtra.GLOBAL_CONTROL_BACKGROUND)
+        self.text.pack(side=LEFT, expand=YES, fill=BOTH)
+
+        sb = Scrollbar(frame, orient=VERTICAL, command=self.text.yview)
+        sb.pack(side=RIGHT, fill=Y)
+        self.text.config(yscrollcommand=sb.set)
+
+        # email frame
+        frame = Frame(self)
+        frame.pack(side=TOP, fill=X)
+
+        la = Label(frame, text=_("Your email"))
+        la.pack(side=LEFT)
+
+        self.email = Entry(frame, background=tkExtra.GLOBAL_CONTROL_BACKGROUND)
+        self.email.pack(side=LEFT, expand=YES, fill=X)
+
+        # Automatic error reporting
+        self.err = BooleanVar()
+        self.err.set(Utils._errorReport)
+        b = Checkbutton(
+            frame,
+            text=_("Automatic error reporting"),
+            variable=self.err,
+            anchor=E,
+            justify=RIGHT,
+        )
+        b.pack(side=RIGHT)
+
+        # Buttons
+        frame = Frame(self)
+        frame.pack(side=BOTTOM, fill=X)
+
+        b = Button(frame, text=_("Close"), compound=LEFT, command=self.cancel)
+        b.pack(side=RIGHT)
+        b = Button(
+            frame,
+            text=_("Send report"),
+            # Error reporting endpoint is currently offline (#824),
+            # disabled this to avoid timeout and confusion
+            state=DISABLED,
+            compound=LEFT,
+            command=self.send,
+        )
+        b.pack(side=RIGHT)
+
+        # Fill report
+        txt = [
+            f"Program     : {Utils.__prg__}",
+            f"Version     : {Utils.__version__}",
+            f"Last Change : {Utils.__date__}",
+            f"Platform    : {sys.platform}",
+            f"Python      : {sys.version}",
+            f"TkVersion   : {TkVersion}",
+            f"TclVersion  : {TclVersion}",
+            "\nTraceback:",
+        ]
+        for e in Utils.errors:
+            if e != "" and e[-1] == "\n":
+                txt.append(e[:-1])
+            else:
+                txt.append(e)
+
+        self.text.insert("0.0", "\n".join(txt))
+
+        # Guess email
+        user = os.getenv("USER")
+        host = os.getenv("HOSTNAME")
+        if user and host:
+            email = f"{user}@{host}"
+        else:
+            email = ""
+        self.email.insert(0, email)
+
+        self.protocol("WM_DELETE_WINDOW", self.close)
+        self.bind("<Escape>", self.close)
+
+        # Wait action
+        self.wait_visibility()
+        self.grab_set()
+        self.focus_set()
+        self.wait_window()
+
+    # ----------------------------------------------------------------------
+    def close(self, event=None):
+        ReportDialog._shown = False
+        self.destroy()
+
+    # ----------------------------------------------------------------------
+    def send(self):
+        import httplib
+        import urllib
+
+        email = self.email.get()
+        desc = self.text.get("1.0", END).strip()
+
+        # Send information
+        self.config(cursor="watch")
+        self.text.config(cursor="watch")
+        self.update_idletasks()
+        params = urllib.urlencode({"email": email, "desc": desc})
+        headers = {
+            "Content-type": "application/x-www-form-urlencoded",
+            "Accept": "text/plain",
+        }
+        conn = httplib.HTTPConnection("www.bcnc.org:80")
+        try:
+            conn.request("POST", "/flair/send_email_bcnc.php", params, headers)
+            response = conn.getresponse()
+        except Exception:
+            messagebox.showwarning(
+                _("Error sending report"),
+                _("There was a problem connecting to the web site"),
+                parent=self,
+            )
+        else:
+            if response.status == 200:
+                messagebox.showinfo(
+                    _("Report successfully send"),
+                    _("Report was successfully uploaded to web site"),
+                    parent=self,
+                )
+                del Utils.errors[:]
+            else:
+                messagebox.showwarning(
+                    _("Error sending report"),
+                    _("There was an error sending the report\n"
+                      + "Code={} {}").format(int(response.status),
+                                             response.reason),
+                    parent=self,
+                )
+        conn.close()
+        self.config(cursor="")
+        self.cancel()
+
+    # ----------------------------------------------------------------------
+    def cancel(self):
+        Utils._errorReport = self.err.get()
+        Utils.config.set(
+            "Connection", "errorreport", str(bool(self.err.get())))
+        del Utils.errors[:]
+        self.close()
+
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def sendErrorReport():
+        ReportDialog(None)
+
+
+# =============================================================================
+# User Button
+# =============================================================================
+class UserButton(Ribbon.LabelButton):
+    TOOLTIP = "User configurable button.\n<RightClick> to configure"
+
+    def __init__(self, master, cnc, button, *args, **kwargs):
+        if button == 0:
+            Button.__init__(self, master, *args, **kwargs)
+        else:
+            Ribbon.LabelButton.__init__(self, master, *args, **kwargs)
+        self.cnc = cnc
+        self.button = button
+        self.get()
+        self.bind("<Button-3>", self.edit)
+        self.bind("<Control-Button-1>", self.edit)
+        self["command"] = self.execute
+
+    # ----------------------------------------------------------------------
+    # get information from configuration
+    # ----------------------------------------------------------------------
+    def get(self):
+        if self.button == 0:
+            return
+        name = self.name()
+        self["text"] = name
+        self["image"] = Utils.icons.get(self.icon(), Utils.icons["material"])
+        self["compound"] = LEFT
+        tooltip = self.tooltip()
+        if not tooltip:
+            tooltip = UserButton.TOOLTIP
+        tkExtra.Balloon.set(self, tooltip)
+
+    # ----------------------------------------------------------------------
+    def name(self):
+        try:
+            return Utils.config.get("Buttons", f"name.{int(self.button)}")
+        except Exception:
+            return str(self.button)
+
+    # ----------------------------------------------------------------------
+    def icon(self):
+        try:
+            return Utils.config.get("Buttons", f"icon.{int(self.button)}")
+        except Exception:
+            return None
+
+    # ----------------------------------------------------------------------
+    def tooltip(self):
+        try:
+            return Utils.config.get("Buttons", f"tooltip.{int(self.button)}")
+        except Exception:
+            return ""
+
+    # ----------------------------------------------------------------------
+    def command(self):
+        try:
+            return Utils.config.get("Buttons", f"command.{int(self.button)}")
+        except Exception:
+            return ""
+
+    # ----------------------------------------------------------------------
+    # Edit button
+    # ----------------------------------------------------------------------
+    def edit(self, event=None):
+        UserButtonDialog(self, self)
+        self.get()
+
+    # ----------------------------------------------------------------------
+    # Execute command
+    # ----------------------------------------------------------------------
+    def execute(self):
+        cmd = self.command()
+        if not cmd:
+            self.edit()
+            return
+        for line in cmd.splitlines():
+            self.cnc.pendant.put(line)
+
+
+# =============================================================================
+# User Configurable Buttons
+# =============================================================================
+class UserButtonDialog(Toplevel):
+    NONE = "<none>"
+
+    def __init__(self, master, button):
+        Toplevel.__init__(self, master)
+        self.title(_("User configurable button"))
+        self.transient(master)
+        self.button = button
+
+        # Name
+        row, col = 0, 0
+        Label(self, text=_("Name:")).grid(row=row, column=col, sticky=E)
+        col += 1
+        self.name = Entry(self, background=tkExtra.GLOBAL_CONTROL_BACKGROUND)
+        self.name.grid(row=row, column=col, columnspan=2, sticky=EW)
+        tkExtra.Balloon.set(self.name, _("Name to appear on button"))
+
+        # Icon
+        row, col = row + 1, 0
+        Label(self, text=_("Icon:")).grid(row=row, column=col, sticky=E)
+        col += 1
+        self.icon = Label(self, relief=RAISED)
+        self.icon.grid(row=row, column=col, sticky=EW)
+        col += 1
+        self.iconCombo = tkExtra.Combobox(
+            self, True, width=5, command=self.iconChange)
+        lst = list(sorted(Utils.icons.keys()))
+        lst.insert(0, UserButtonDialog.NONE)
+        self.iconCombo.fill(lst)
+        self.iconCombo.grid(row=row, column=col, sticky=EW)
+        tkExtra.Balloon.set(self.iconCombo, _("Icon to appear on button"))
+
+        # Tooltip
+        row, col = row + 1, 0
+        Label(self, text=_("Tool Tip:")).grid(row=row, column=col, sticky=E)
+        col += 1
+        self.tooltip = Entry(self,
+                             background=tkExtra.GLOBAL_CONTROL_BACKGROUND)
+        self.tooltip.grid(row=row, column=col, columnspan=2, sticky=EW)
+        tkExtra.Balloon.set(self.tooltip, _("Tooltip for button"))
+
+        # Tooltip
+        row, col = row + 1, 0
+        Label(self, text=_("Command:")).grid(row=row, column=col, sticky=N + E)
+        col += 1
+        self.command = Text(
+            self, background=tkExtra.GLOBAL_CONTROL_BACKGROUND,
+            width=40, height=10
+        )
+        self.command.grid(row=row, column=col, columnspan=2, sticky=EW)
+
+        self.grid_columnconfigure(2, weight=1)
+        self.grid_rowconfigure(row, weight=1)
+
+        # Actions
+        row += 1
+        f = Frame(self)
+        f.grid(row=row, column=0, columnspan=3, sticky=EW)
+        Button(f, text=_("Cancel"), command=self.cancel).pack(side=RIGHT)
+        Button(f, text=_("Ok"), command=self.ok).pack(side=RIGHT)
+
+        # Set variables
+        self.name.insert(0, self.button.name())
+        self.tooltip.insert(0, self.button.tooltip())
+        icon = self.button.icon()
+        if icon is None:
+            self.iconCombo.set(UserButtonDialog.NONE)
+        else:
+            self.iconCombo.set(icon)
+        self.icon["image"] = Utils.icons.get(icon, "")
+        self.command.insert("1.0", self.button.command())
+
+        # Wait action
+        self.wait_visibility()
+        self.grab_set()
+        self.focus_set()
+        self.wait_window()
+
+    # ----------------------------------------------------------------------
+    def ok(self, event=None):
+        n = self.button.button
+        Utils.config.set("Buttons", f"name.{int(n)}", self.name.get().strip())
+        icon = self.iconCombo.get()
+        if icon == UserButtonDialog.NONE:
+            icon = ""
+        Utils.config.set("Buttons", f"icon.{int(n)}", icon)
+        Utils.config.set("Buttons", f"tooltip.{int(n)}",
+                         self.tooltip.get().strip())
+        Utils.config.set("Buttons", f"command.{int(n)}",
+                         self.command.get("1.0", END).strip())
+        self.destroy()
+
+    # ----------------------------------------------------------------------
+    def cancel(self):
+        self.destroy()
+
+    # ----------------------------------------------------------------------
+    def iconChange(self):
+        self.icon["image"] = Utils.icons.get(self.iconCombo.get(), "")
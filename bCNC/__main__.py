@@ -26,7 +26,10 @@ def usage(rc):
     wrt("\t-D\t\t\tDisable developer features\n")
     wrt("\t-f | --fullscreen\tEnable fullscreen mode\n")
     wrt("\t-g #\t\t\tSet the default geometry\n")
+    wrt("\t--daemon\t\tServe several machines, see --daemon -h\n")
     wrt("\t-h | -? | --help\tThis help page\n")
+    wrt("\t--headless\t\tStream without the user interface, "
+        "see --headless -h\n")
     wrt("\t-i # | --ini #\t\tAlternative ini file for testing\n")
     wrt("\t-l | --list\t\tList all recently opened files\n")
     wrt("\t-p # | --pendant #\tOpen pendant to specified port\n")
@@ -42,6 +45,15 @@ def usage(rc):
 
 # -----------------------------------------------------------------------------
 def main():
+    # Streaming or serving machines without the user interface,
+    # before importing any of it
+    if "--headless" in sys.argv[1:]:
+        import Headless
+        sys.exit(Headless.main(sys.argv[1:]))
+    if "--daemon" in sys.argv[1:]:
+        import Daemon
+        sys.exit(Daemon.main(sys.argv[1:]))
+
     import Helpers
     import bmain
     import tkExtra
@@ -10,6 +10,7 @@ import sys
 import time
 import traceback
 import webbrowser
+from collections import deque
 from datetime import datetime
 import tkinter
 from queue import Empty
@@ -68,7 +69,7 @@ import tkExtra
 # Load configuration before anything else
 # and if needed replace the  translate function _()
 # before any string is initialized
-from CNC import CNC, WAIT, GCode
+from CNC import CNC, MODAL_STATE, WAIT, GCode
 import Ribbon
 import Pendant
 from CNCRibbon import Page
@@ -76,7 +77,7 @@ from ControlPage import ControlPage
 from EditorPage import EditorPage
 from FilePage import FilePage
 from ProbePage import ProbePage
-from Sender import NOT_CONNECTED, STATECOLOR, STATECOLORDEF, Sender
+from Sender import NOT_CONNECTED, STATECOLOR, STATECOLORDEF, Sender, StateStore
 from TerminalPage import TerminalPage
 from ToolsPage import Tools, ToolsPage
 
@@ -104,8 +105,10 @@ _baud = None
 
 MONITOR_AFTER = 200  # ms
 DRAW_AFTER = 300  # ms
+LOAD_AFTER = 100  # ms
 
 RX_BUFFER_SIZE = 128
+STREAM_LINES = 100  # acknowledged lines rendered per refresh when streaming
 
 MAX_HISTORY = 500
 
@@ -536,7 +539,28 @@ class Application(Tk, Sender):
         self._inFocus = False
         # END - insertCount lines where ok was applied to for $xxx commands
         self._insertCount = (0)
+        # while streaming the buffered and acknowledged lines are kept
+        # here and rendered once per refresh instead of one by one
+        self._streaming = False
+        self._streamBuffer = deque()  # sent, waiting for the ok
+        self._streamDone = deque(maxlen=STREAM_LINES)  # to be rendered
+        self._streamOk = 0  # acknowledgements counted while streaming
         self._selectI = 0
+        self._runPath = None  # last (block, line) executed
+        self._timeline = None  # estimated time of the run
+
+        # refresh only the widgets whose values the status reports changed
+        self._msgShown = None
+        self.stateStore = StateStore(CNC.vars)
+        self.stateStore.subscribe(
+            ("state", "color", "pins"), lambda changed: self.dro.updateState())
+        self.stateStore.subscribe(
+            ("wx", "wy", "wz", "wa", "wb", "wc",
+             "mx", "my", "mz", "ma", "mb", "mc"),
+            lambda changed: self.dro.updateCoords())
+        self.stateStore.subscribe(
+            ("wx", "wy", "wz", "mx", "my", "mz"), self._updateGantry)
+        self.stateStore.subscribe(("curfeed",), self._updateFeed)
         self.monitorSerial()
         self.canvasFrame.toggleDrawFlag()
 
@@ -1112,16 +1136,8 @@ class Application(Tk, Sender):
             unit = "mm"
 
         # count enabled blocks
-        e = 0
-        le = 0
-        r = 0
-        t = 0
-        for block in self.gcode.blocks:
-            if block.enable:
-                e += 1
-                le += block.length
-                r += block.rapid
-                t += block.time
+        self.gcode.calculateMargins()
+        e, le, r, t = self.gcode.enabledStatistics()
 
         # ===========
         frame = LabelFrame(toplevel, text=_(
@@ -1282,6 +1298,17 @@ class Application(Tk, Sender):
             foreground="DarkBlue",
         ).grid(row=row, column=col, sticky=W)
 
+        # ---
+        row += 1
+        col = 0
+        Label(frame, text=_("Line cache:")).grid(row=row, column=col, sticky=E)
+        col += 1
+        Label(
+            frame,
+            text=CNC.lineCache.stats(),
+            foreground="DarkBlue",
+        ).grid(row=row, column=col, sticky=W)
+
         frame.grid_columnconfigure(1, weight=1)
 
         # ===========
@@ -1318,9 +1345,14 @@ class Application(Tk, Sender):
 
     # -----------------------------------------------------------------------
     def viewChange(self, event=None):
-        if self.running:
-            self._selectI = 0  # last selection pointer in items
         self.draw()
+        if self.running and self._runPath is not None:
+            # highlight again the executed lines
+            bid, lid = self._runPath
+            block = self.gcode[bid]
+            self.canvas.markProcessed(
+                [block.path(j) for j in range(lid + 1) if block.path(j)],
+                [b for b in self.gcode.blocks[:bid] if b.enable])
 
     # ----------------------------------------------------------------------
     def refresh(self, event=None):
@@ -1359,6 +1391,9 @@ class Application(Tk, Sender):
 
     # -----------------------------------------------------------------------
     def unselectAll(self, event=None):
+        if self.loadRunning():
+            self.loadCancel()
+            return "break"
         focus = self.focus_get()
         if focus in (self.canvas, self.editor):
             self.ribbon.changePage("Editor")
@@ -2283,7 +2318,7 @@ class Application(Tk, Sender):
     # load dialog
     # -----------------------------------------------------------------------
     def loadDialog(self, event=None):
-        if self.running:
+        if self.running or self.loadRunning():
             return
         filename = bFileDialog.askopenfilename(
             master=self,
@@ -2350,6 +2385,8 @@ class Application(Tk, Sender):
     # Load a file into editor
     # -----------------------------------------------------------------------
     def load(self, filename, autoloaded=False):
+        if self.loadRunning():
+            return
         fn, ext = os.path.splitext(filename)
         if ext == ".probe":
             pass
@@ -2367,6 +2404,10 @@ class Application(Tk, Sender):
                     self.gcode.probe.init()
 
         self.setStatus(_("Loading: {} ...").format(filename), True)
+        if ext.lower() not in (".probe", ".orient", ".stl", ".ply"):
+            self.loadBackground(filename, autoloaded)
+            return
+
         Sender.load(self, filename)
 
         if ext == ".probe":
@@ -2378,14 +2419,95 @@ class Application(Tk, Sender):
             self.event_generate("<<OrientSelect>>", data=0)
             self.event_generate("<<OrientUpdate>>")
 
-        else:
+        self.loadEnded(filename, autoloaded)
+
+    # -----------------------------------------------------------------------
+    # Load or import (insert=True) a file in a background thread
+    # The canvas is drawn with the blocks parsed so far, every time that
+    # their number doubles, and Escape cancels the load
+    # -----------------------------------------------------------------------
+    def loadBackground(self, filename, autoloaded=False, insert=False):
+        self._loadArgs = (filename, autoloaded, insert)
+        self._loadMax = 0
+        self._loadDrawn = 0
+        self._loadPrevious = None
+        if not insert:
+            self._loadPrevious = (self.gcode.filename, self.gcode.blocks)
+            self.gcode.blocks = []
             self.editor.selectClear()
             self.editor.fill()
             self.canvas.reset()
+        self.loadStart(filename)
+        self.after(LOAD_AFTER, self._loadMonitor)
+
+    # -----------------------------------------------------------------------
+    def _loadMonitor(self):
+        filename, autoloaded, insert = self._loadArgs
+        loader = self.loader
+        if self.loadRunning():
+            msg = _("Loading: {} ... (Esc to cancel)").format(filename)
+            if loader.progressMax:
+                if self._loadMax != loader.progressMax:
+                    self._loadMax = loader.progressMax
+                    self.statusbar.setLimits(0, self._loadMax)
+                self.statusbar.setProgress(
+                    loader.progress, loader.progress, msg)
+            else:
+                self.setStatus(msg)
+
+            # partial rendering of the complete blocks
+            if not insert:
+                blocks = loader.blocks[:-1]
+                if blocks and len(blocks) >= 2 * self._loadDrawn:
+                    self._loadDrawn = len(blocks)
+                    self.gcode.blocks = blocks
+                    self.draw()
+            self.after(LOAD_AFTER, self._loadMonitor)
+            return
+
+        cancelled = loader.isCancelled()
+        gcode = self.loadFinish(not insert)
+        self.statusbar.setLimits(0, 100)
+        self.statusbar.clear()
+        if gcode is None:
+            if self._loadPrevious is not None:
+                self.gcode.filename, self.gcode.blocks = self._loadPrevious
+                self.gcode.calculateMargins()
+                self.editor.fill()
+                self.canvas.reset()
+                self.draw()
+            self._loadPrevious = None
+            if cancelled:
+                self.setStatus(_("Loading of '{}' cancelled").format(filename))
+            else:
+                self.setStatus(_("Error loading '{}'").format(filename))
+            return
+        self._loadPrevious = None
+
+        if insert:
+            sel = self.editor.getSelectedBlocks()
+            if not sel:
+                pos = None
+            else:
+                pos = sel[-1]
+            self.addUndo(self.gcode.insBlocksUndo(pos, gcode.blocks))
+            del gcode
+            self.editor.fill()
             self.draw()
             self.canvas.fit2Screen()
-            Page.frames["CAM"].populate()
+            self.setStatus(_("'{}' imported").format(filename))
+            return
 
+        self.editor.selectClear()
+        self.editor.fill()
+        self.canvas.reset()
+        self.draw()
+        self.canvas.fit2Screen()
+        Page.frames["CAM"].populate()
+        self.loadEnded(filename, autoloaded)
+
+    # -----------------------------------------------------------------------
+    def loadEnded(self, filename, autoloaded=False):
         if autoloaded:
             self.setStatus(
                 _("'{}' reloaded at '{}'").format(
@@ -2421,6 +2543,8 @@ class Application(Tk, Sender):
 
     # -----------------------------------------------------------------------
     def importFile(self, filename=None):
+        if self.loadRunning():
+            return
         if filename is None:
             filename = bFileDialog.askopenfilename(
                 master=self,
@@ -2435,25 +2559,8 @@ class Application(Tk, Sender):
                 ],
             )
         if filename:
-            fn, ext = os.path.splitext(filename)
-            ext = ext.lower()
-            gcode = GCode()
-            if ext == ".dxf":
-                gcode.importDXF(filename)
-            elif ext == ".svg":
-                gcode.importSVG(filename)
-            else:
-                gcode.load(filename)
-            sel = self.editor.getSelectedBlocks()
-            if not sel:
-                pos = None
-            else:
-                pos = sel[-1]
-            self.addUndo(self.gcode.insBlocksUndo(pos, gcode.blocks))
-            del gcode
-            self.editor.fill()
-            self.draw()
-            self.canvas.fit2Screen()
+            self.setStatus(_("Importing: {} ...").format(filename), True)
+            self.loadBackground(filename, insert=True)
 
     # -----------------------------------------------------------------------
     def focusIn(self, event):
@@ -2522,22 +2629,13 @@ class Application(Tk, Sender):
         except TclError:
             pass
 
-    # -----------------------------------------------------------------------
-    # An entry function should be called periodically during compiling
-    # to check if the Pause or Stop buttons are pressed
-    # @return true if the compile has to abort
-    # -----------------------------------------------------------------------
-    def checkStop(self):
-        try:
-            self.update()  # very tricky function of Tk
-        except TclError:
-            pass
-        return self._stop
-
     # -----------------------------------------------------------------------
     # Send enabled gcode file to the CNC machine
+    # @param start (block, line) to resume the gcode from
     # -----------------------------------------------------------------------
-    def run(self, lines=None):
+    def run(self, lines=None, start=None):
+        if self.loadRunning():
+            return
         self.cleanAfter = True  # Clean when this operation stops
         print("Will clean after this operation")
 
@@ -2568,6 +2666,8 @@ class Application(Tk, Sender):
         self._gcount = 0  # count executed lines
         self._selectI = 0  # last selection pointer in items
         self._paths = None  # temporary
+        self._runPath = None  # last (block, line) executed
+        self._timeline = None
         CNC.vars["running"] = True  # enable running status
         CNC.vars["_OvChanged"] = True  # force a feed change if any
         if self._onStart:
@@ -2577,14 +2677,8 @@ class Application(Tk, Sender):
                 pass
 
         if lines is None:
-            self.statusbar.setLimits(0, 9999)
-            self.statusbar.setProgress(0, 0)
-            self._paths = self.gcode.compile(self.queue, self.checkStop)
-            if self._paths is None:
-                self.emptyQueue()
-                self.purgeController()
-                return
-            elif not self._paths:
+            if not any(block.enable and len(block)
+                       for block in self.gcode.blocks):
                 self.runEnded()
                 messagebox.showerror(
                     _("Empty gcode"),
@@ -2594,24 +2688,24 @@ class Application(Tk, Sender):
                 return
 
             # reset colors
-            before = time.time()
-            for ij in self._paths:  # Slow loop
-                if not ij:
-                    continue
-                path = self.gcode[ij[0]].path(ij[1])
-                if path:
-                    color = self.canvas.itemcget(path, "fill")
-                    if color != CNCCanvas.ENABLE_COLOR:
-                        self.canvas.itemconfig(
-                            path, width=1, fill=CNCCanvas.ENABLE_COLOR
-                        )
-                    # Force a periodic update since this loop can take time
-                    if time.time() - before > 0.25:
-                        self.update()
-                        before = time.time()
-
-            # the buffer of the machine should be empty?
-            self._runLines = len(self._paths) + 1  # plus the wait
+            self.canvas.clearProcessed()
+
+            # lines are sent while being compiled, the progress is
+            # estimated on the enabled lines until the compilation ends
+            total = len(self.cnc.startup.splitlines()) + 1
+            for block in self.gcode.blocks:
+                if block.enable:
+                    total += len(block)
+            if start is not None:
+                total -= start[1]
+                for block in self.gcode.blocks[:start[0]]:
+                    if block.enable:
+                        total -= len(block)
+            self.statusbar.setLimits(0, total)
+            self._timeline = self.gcode.timeline()
+            self.statusbar.setRemaining(
+                GCode.timeLeft(self._timeline, start))
+            self.compileStart(start)
         else:
             n = 1  # including one wait command
             for line in CNC.compile(lines):
@@ -2623,10 +2717,11 @@ class Application(Tk, Sender):
                     n += 1
             # set it at the end to be sure that all lines are queued
             self._runLines = n
-        self.queue.put((WAIT,))  # wait at the end to become idle
+            self.queue.put((WAIT,))  # wait at the end to become idle
+            self.statusbar.setLimits(0, self._runLines)
+            self.statusbar.setRemaining(None)
 
         self.setStatus(_("Running..."))
-        self.statusbar.setLimits(0, self._runLines)
         self.statusbar.configText(fill="White")
         self.statusbar.config(background="DarkGray")
 
@@ -2634,6 +2729,77 @@ class Application(Tk, Sender):
         self.bufferbar.config(background="DarkGray")
         self.bufferbar.setText("")
 
+    # -----------------------------------------------------------------------
+    # Resume the gcode from a block and line, counting from 1. By default
+    # from the line active in the editor, or else from the last line
+    # acknowledged in the journal of a run that didn't end
+    # -----------------------------------------------------------------------
+    def runFrom(self, args=()):
+        if args:
+            try:
+                bid = int(args[0]) - 1
+                lid = int(args[1]) - 1 if len(args) > 1 else 0
+            except ValueError:
+                messagebox.showerror(
+                    _("Run from"), _("Invalid block or line number"),
+                    parent=self
+                )
+                return
+        elif self.editor.curselection():
+            bid, lid = self.editor.getActive()
+            if lid is None:
+                lid = 0
+        else:
+            journal = self.journalRead()
+            if journal is None:
+                messagebox.showerror(
+                    _("Run from"),
+                    _("Select the line to run from, no run to resume"),
+                    parent=self
+                )
+                return
+            filename = self.gcode.filename
+            if filename:
+                filename = os.path.abspath(filename)
+            if journal["file"] != filename:
+                ans = messagebox.askquestion(
+                    _("Run from"),
+                    _("The run to resume was of file:\n{}\n"
+                      "Resume it on the loaded one?").format(journal["file"]),
+                    parent=self,
+                )
+                if ans != messagebox.YES and ans is not True:
+                    return
+            bid = journal["block"]
+            lid = journal["line"]
+
+        if not 0 <= bid < len(self.gcode.blocks):
+            messagebox.showerror(
+                _("Run from"), _("Block {} doesn't exist").format(bid + 1),
+                parent=self
+            )
+            return
+        lid = max(0, min(lid, len(self.gcode.blocks[bid]) - 1))
+        try:
+            preamble, state, motion = self.gcode.resumePreamble(bid, lid)
+        except Exception:
+            messagebox.showerror(
+                _("Run from"), sys.exc_info()[1], parent=self)
+            return
+        if motion:
+            preamble.append(_("{} with the first move").format(motion))
+
+        tool = dict(zip(MODAL_STATE, state))["tool"]
+        ans = messagebox.askquestion(
+            _("Run from"),
+            _("Resume from block {} line {} with tool T{} "
+              "loaded, after:\n{}").format(
+                bid + 1, lid + 1, tool, "\n".join(preamble)),
+            parent=self,
+        )
+        if ans == messagebox.YES or ans is True:
+            self.run(start=(bid, lid))
+
     # -----------------------------------------------------------------------
     # Start the web pendant
     # -----------------------------------------------------------------------
@@ -2666,6 +2832,52 @@ class Application(Tk, Sender):
             messagebox.showinfo(_("Pendant"), _(
                 "Pendant stopped"), parent=self)
 
+    # -----------------------------------------------------------------------
+    @staticmethod
+    def _logLine(line):
+        if isinstance(line, bytes):
+            line = line.decode()
+        return str(line).rstrip("\n")
+
+    # -----------------------------------------------------------------------
+    # Enter streaming mode, taking over the commands already buffered
+    # -----------------------------------------------------------------------
+    def _streamStart(self):
+        self._streaming = True
+        self._streamBuffer.extend(self.buffer.get(0, END))
+        self._streamDone.clear()
+        self._streamOk = 0
+
+    # -----------------------------------------------------------------------
+    # Move the acknowledged lines in the terminal, in a single insert
+    # -----------------------------------------------------------------------
+    def _streamFlush(self):
+        if not self._streamDone:
+            return
+        start = self.terminal.size()
+        self.terminal.insert(END, *map(self._logLine, self._streamDone))
+        for i in range(start, self.terminal.size()):
+            self.terminal.itemconfig(i, foreground="Blue")
+        self._streamDone.clear()
+        if self.terminal.size() > 1000:
+            self.terminal.delete(0, self.terminal.size() - 500)
+
+    # -----------------------------------------------------------------------
+    def _updateGantry(self, changed):
+        self.canvas.gantry(
+            CNC.vars["wx"],
+            CNC.vars["wy"],
+            CNC.vars["wz"],
+            CNC.vars["mx"],
+            CNC.vars["my"],
+            CNC.vars["mz"],
+        )
+
+    # -----------------------------------------------------------------------
+    def _updateFeed(self, changed):
+        if CNC.vars["state"] == "Run":
+            self.gstate.updateFeed()
+
     # -----------------------------------------------------------------------
     # Inner loop to catch any generic exception
     # -----------------------------------------------------------------------
@@ -2675,12 +2887,44 @@ class Application(Tk, Sender):
 
         # dump in the terminal what ever you can in less than 0.1s
         inserted = False
+        if self.running and not self._streaming:
+            self._streamStart()
         while self.log.qsize() > 0 and time.time() - t < 0.1:
             try:
                 msg, line = self.log.get_nowait()
-                line = str(line).rstrip("\n")
                 inserted = True
 
+                # Streaming: count the acks, render only the last lines
+                if self._streaming:
+                    if msg == Sender.MSG_BUFFER:
+                        self._streamBuffer.append(line)
+                        continue
+                    elif msg == Sender.MSG_OK:
+                        if self._streamBuffer:
+                            self._streamDone.append(
+                                self._streamBuffer.popleft())
+                        self._streamOk += 1
+                        self._insertCount = 0
+                        continue
+                    if msg == Sender.MSG_ERROR:
+                        if self._streamBuffer:
+                            self._streamDone.append(
+                                self._streamBuffer.popleft())
+                        self._streamFlush()
+                        self.terminal.insert(END, self._logLine(line))
+                        self.terminal.itemconfig(END, foreground="Red")
+                        continue
+                    self._streamFlush()
+                    if msg == Sender.MSG_CLEAR:
+                        self._streamBuffer.clear()
+                    elif msg == Sender.MSG_RUNEND and self._streamOk:
+                        self.terminal.insert(
+                            END, _("{} commands acknowledged").format(
+                                self._streamOk))
+                        self._streamOk = 0
+
+                line = self._logLine(line)
+
                 if msg == Sender.MSG_BUFFER:
                     self.buffer.insert(END, line)
 
@@ -2742,6 +2986,15 @@ class Application(Tk, Sender):
             except Empty:
                 break
 
+        if self._streaming:
+            self._streamFlush()
+            self.buffer.delete(0, END)
+            self.buffer.insert(END, *map(self._logLine, self._streamBuffer))
+            if not self.running:
+                # the buffer listbox holds what is left, go on from there
+                self._streaming = False
+                self._streamBuffer.clear()
+
         if inserted:
             self.terminal.see(END)
 
@@ -2768,19 +3021,11 @@ class Application(Tk, Sender):
                 else:
                     CNC.vars["color"] = STATECOLORDEF
             self._pause = "Hold" in state
-            self.dro.updateState()
-            self.dro.updateCoords()
-            self.canvas.gantry(
-                CNC.vars["wx"],
-                CNC.vars["wy"],
-                CNC.vars["wz"],
-                CNC.vars["mx"],
-                CNC.vars["my"],
-                CNC.vars["mz"],
-            )
-            if state == "Run":
-                self.gstate.updateFeed()
             self._posUpdate = False
+            self.stateStore.publish()
+            if self._msg != self._msgShown:
+                self._msgShown = self._msg
+                self.dro.updateState()
 
         # Update status string
         if self._gUpdate:
@@ -2802,28 +3047,53 @@ class Application(Tk, Sender):
                 Page.frames["ProbeCommon"].updateTlo()
             self._update = None
 
+        # Background compilation of the run ended
+        if self._compileThread is not None and not self.compileRunning():
+            result = self.compileFinish()
+            if result is None:
+                self.emptyQueue()
+                self.purgeController()
+            elif not result:
+                self.runEnded()
+            else:
+                t0 = self.statusbar.t0
+                remaining = self.statusbar.remaining
+                self.statusbar.setLimits(0, self._runLines)
+                self.statusbar.setStartTime(t0)
+                self.statusbar.setRemaining(remaining)
+
         if self.running:
-            self.statusbar.setProgress(
-                self._runLines - self.queue.qsize(), self._gcount
-            )
+            done = self.runIndex()
+            if self._paths:
+                paths = []
+                while self._selectI <= done and self._paths:
+                    ij = self._paths.popleft()
+                    self._selectI += 1
+                    if ij:
+                        self._runPath = ij
+                        path = self.gcode[ij[0]].path(ij[1])
+                        if path:
+                            paths.append(path)
+                if paths:
+                    self.canvas.markProcessed(paths)
+                if self._runPath is not None:
+                    self.journalWrite(self._runPath)
+                    if self._timeline is not None:
+                        self.statusbar.setRemaining(
+                            GCode.timeLeft(self._timeline, self._runPath))
+
+            if self._runLines == sys.maxsize:
+                sent = self._compiled
+            else:
+                sent = self._runLines
+            self.statusbar.setProgress(sent - self.queue.qsize(), done)
             CNC.vars["msg"] = self.statusbar.msg
             self.bufferbar.setProgress(Sender.getBufferFill(self))
             self.bufferbar.setText(f"{Sender.getBufferFill(self):3.0f}%")
 
-            if self._selectI >= 0 and self._paths:
-                while self._selectI <= self._gcount and self._selectI < len(
-                    self._paths
-                ):
-                    if self._paths[self._selectI]:
-                        i, j = self._paths[self._selectI]
-                        path = self.gcode[i].path(j)
-                        if path:
-                            self.canvas.itemconfig(
-                                path, width=2, fill=CNCCanvas.PROCESS_COLOR
-                            )
-                    self._selectI += 1
-
             if self._gcount >= self._runLines:
+                if self._paths is not None and not self._stop:
+                    self.journalClear()  # the job completed
                 self.runEnded()
 
     # -----------------------------------------------------------------------
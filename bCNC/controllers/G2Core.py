@@ -9,16 +9,57 @@ from CNC import CNC
 import time
 import json
 
+# Line mode protocol: lines sent ahead of their {"r":...} response
+LINES_IN_FLIGHT = 4
+# Free planner buffers (qr) below which only one line is kept in flight
+PLANNER_LOW = 4
+
+# Status report fields used by processStatusReport(), the automatic
+# reports are filtered on them
+SR_FIELDS = ("stat", "line", "vel", "feed", "unit", "coor", "plan", "dist",
+             "g92e", "tool", "frmo", "tofx", "tofy", "tofz", "posx", "posy",
+             "posz", "mpox", "mpoy", "mpoz", "spc", "sps")
+SR_FILTER = "{sr:{" + ",".join(f"{x}:t" for x in SR_FIELDS) + "}}\n"
+
 
 class Controller(_GenericController):
     def __init__(self, master):
         self.gcode_case = 1
         self.has_override = False
         self.master = master
+        self.planner = None  # free planner buffers from the queue reports
+        self._direct = 0  # responses due to commands written directly
         print("G2Core loaded")
 
+    def initController(self):
+        _GenericController.initController(self)
+        self.planner = None
+        self._direct = 0
+        # automatic status reports filtered on the fields we parse, and
+        # queue reports with the blocks added and removed
+        self._command(SR_FILTER, "{sv:1}\n", "{qv:2}\n")
+
+    # ----------------------------------------------------------------------
+    # Line mode flow control: g2core answers every line once parsed, a few
+    # lines in flight keep its serial buffer fed while the planner fills
+    # up. With the planner almost full the next lines would just wait in
+    # the serial buffer, so hold back to one
+    # ----------------------------------------------------------------------
+    def linesInFlight(self):
+        if self.planner is not None and self.planner < PLANNER_LOW:
+            return 1
+        return LINES_IN_FLIGHT
+
+    # ----------------------------------------------------------------------
+    # Write JSON commands bypassing the queue. Their responses are not
+    # counted against the lines in flight
+    # ----------------------------------------------------------------------
+    def _command(self, *cmds):
+        self._direct += len(cmds)
+        self.master.serial_write("".join(cmds))
+
     def setTLO(self, tlo):
-        self.master.serial_write('{{tofz:{0}}}\n{{gc:"G0"}}\n'.format(tlo))
+        self._command('{{tofz:{0}}}\n'.format(tlo), '{gc:"G0"}\n')
         self.viewState()
 
     def hardResetPre(self):
@@ -29,10 +70,10 @@ class Controller(_GenericController):
         self.initController()	# Required to reload values
 
     def viewBuild(self):
-        self.master.serial_write(b'{"sys":n}\n')
+        self._command('{"sys":n}\n')
 
     def grblHelp(self):
-        self.master.serial_write(b"{h:n}\n")
+        self._command("{h:n}\n")
 
     def executeCommand(self, oline, line, cmd):
         print("ec",oline,line,cmd)
@@ -122,9 +163,10 @@ class Controller(_GenericController):
                                 "tofx" : "tofx",
                                 "tofy" : "tofy",
                                 "tofz" : "TLO"  })
-        self.setCNCints(sr, { "tool" : "tool",
-                              "frmo" : "feedmode",
-                              "sps" : "rpm" })
+        self.setCNCints(sr, {"tool": "tool",
+                             "frmo": "feedmode",
+                             "sps": "rpm",
+                             "line": "Ln"})
         if "plan" in sr:
             self.setCNCgvar("plane", ["G17","G18","G19"], int(sr["plan"]))
         if "dist" in sr:
@@ -154,9 +196,22 @@ class Controller(_GenericController):
         revision, status, lines_available = f
         # self.setState(status)  NO, THIS IS A DIFFERENT STATUS.
 
+    # qr: free planner buffers, qi/qo: blocks added/removed since the last
+    # report (queue report verbosity 2)
+    def processQueueReport(self, values):
+        if "qr" in values:
+            self.planner = int(values["qr"])
+            CNC.vars["planner"] = self.planner
+        if "qi" in values:
+            CNC.vars["qi"] = int(values["qi"])
+        if "qo" in values:
+            CNC.vars["qo"] = int(values["qo"])
+
     def parseValues(self, values):
         if "sr" in values:
             self.processStatusReport(values["sr"])
+        if "qr" in values:
+            self.processQueueReport(values)
         if "err" in values: # JSON Syntax Errors
             self.processErrorReport(values["err"])
         if "er" in values:  # Lower level errors
@@ -190,7 +245,16 @@ class Controller(_GenericController):
             self.master.log.put((self.master.MSG_RECEIVE, line))
             values = json.loads(line)
             if "r" in values:
-                if not self.master.sio_status:
+                if "msg" in values["r"] and "fv" in values["r"]:
+                    # startup banner, after a reset nothing is in flight
+                    self.master._stop = True
+                    del cline[:]
+                    del sline[:]
+                    self._direct = 0
+                    self.planner = None
+                elif self._direct > 0:
+                    self._direct -= 1
+                elif not self.master.sio_status:
                     self.master.log.put((self.master.MSG_OK, line))
                     self.master._gcount += 1
                     if cline: del cline[0]
@@ -219,8 +283,14 @@ class Controller(_GenericController):
         self.master.serial_write(b"!\004\n")
         self.master.serial.flush()
         time.sleep(1)
+        # the flushed lines will never be answered
+        del self.master._cline[:]
+        del self.master._sline[:]
+        self._direct = 0
+        self.planner = None
         # remember and send all G commands
-        G = " ".join([x for x in CNC.vars["G"] if x[0] == "G"] and x != "G43.1")  # remember $G
+        G = " ".join([x for x in CNC.vars["G"]
+                      if x[0] == "G" and x != "G43.1"])  # remember $G
         TLO = CNC.vars["TLO"]
         self.softReset(False)  # reset controller
         self.purgeControllerExtra()
@@ -245,4 +315,5 @@ class Controller(_GenericController):
         self.master.sendGCode('{"sys":""}\n')
 
     def viewState(self):
-        self.master.serial_write(b'{sr:{stat:t,n:t,line:t,vel:t,feed:t,unit:t,coor:t,momo:t,plan:t,path:t,dist:t,admo:t,macs:t,cycs:t,mots:t,hold:t,tool:t,g92e:t,tofx:t,tofy:t,tofz:t,posx:t,posy:t,posz:t,mpox:t,mpoy:t,mpoz:t,spc:t,sps:t}}\n')
+        # fields as filtered by initController()
+        self._command("{sr:n}\n")
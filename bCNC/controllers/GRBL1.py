@@ -164,6 +164,25 @@ class Controller(_GenericGRBL):
                 try:
                     CNC.vars["planner"] = int(word[1])
                     CNC.vars["rxbytes"] = int(word[2])
+                    # Idle with nothing in flight: grbl reports the whole
+                    # serial buffer as free, which is the size the
+                    # character counting compares against (128 on stock
+                    # grbl, the ring itself holds one byte less)
+                    if (
+                        fields[0] == "Idle"
+                        and CNC.vars["rxbytes"] > 0
+                        and not cline
+                        and not self.master.running
+                    ):
+                        self.master.rxBufferSize = CNC.vars["rxbytes"]
+                except (ValueError, IndexError):
+                    CNC.vars["state"] = f"Garbage receive {word[0]}: {line}"
+                    self.master.log.put(
+                        (self.master.MSG_RECEIVE, CNC.vars["state"]))
+                    break
+            elif word[0] == "Ln":
+                try:
+                    CNC.vars["Ln"] = int(word[1])
                 except (ValueError, IndexError):
                     CNC.vars["state"] = f"Garbage receive {word[0]}: {line}"
                     self.master.log.put(
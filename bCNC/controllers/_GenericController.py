@@ -40,6 +40,14 @@ class _GenericController:
             # And write out the firmware config
             self.master.serial_write(text)
 
+    # ----------------------------------------------------------------------
+    # Flow control of the streaming. None: count the characters sent against
+    # the rx buffer of the controller. A number: line mode, stream at most
+    # that many lines ahead of their replies
+    # ----------------------------------------------------------------------
+    def linesInFlight(self):
+        return None
+
     def setTLO(self, tlo):
         self.master.sendGCode(f"G43.1Z{tlo}")    
 
@@ -264,7 +272,10 @@ class _GenericController:
             if cline:
                 del cline[0]
             if sline:
-                CNC.vars["errline"] = sline.pop(0)
+                errline = sline.pop(0)
+                if isinstance(errline, bytes):
+                    errline = errline.decode()
+                CNC.vars["errline"] = errline
             if not self.master._alarm:
                 self.master._posUpdate = True
             self.master._alarm = True
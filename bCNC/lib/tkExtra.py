@@ -663,6 +663,14 @@ class ProgressBar(Canvas):
         self.now = float(low)
         self.t0 = time.time()
         self.msg = ""
+        self.remaining = None
+
+    # ----------------------------------------------------------------------
+    # Estimated remaining time in seconds, used for the total and remaining
+    # time instead of extrapolating the elapsed one. None to extrapolate
+    # ----------------------------------------------------------------------
+    def setRemaining(self, remaining):
+        self.remaining = remaining
 
     # ----------------------------------------------------------------------
     def setProgress(self, now, done=None, txt=None):
@@ -685,7 +693,9 @@ class ProgressBar(Canvas):
         # calculate remaining time
         dt = time.time() - self.t0
         p = now - self.low
-        if p > 0:
+        if self.remaining is not None:
+            tot = dt + self.remaining
+        elif p > 0:
             tot = dt / p * (self.high - self.low)
         else:
             tot = 0.0
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# bCNC is not a package, make its modules importable by the tests
+BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bCNC")
+for path in ("controllers", "plugins", "lib", ""):
+    path = os.path.normpath(os.path.join(BASE, path))
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# Streaming benchmark of the Sender against the simulated controller
+#
+# Generates a synthetic job of short G1 segments around a circle, loads it
+# in the Sender, connects to grbl_sim.py through the "pty:" transport and
+# runs it through the real compile and serial threads, as the GUI does.
+# Reports the lines/s streamed, the planner starvation seen by the
+# simulator (the planner running empty in the middle of the job, i.e. the
+# host not keeping up) and the CPU used by the host process.
+#
+# Usage: bench_stream.py [-h] [--lines N] [--segment mm] [--feed mm/min]
+#                        [--controller name]
+#                        [simulator options, see grbl_sim.py -h]
+# e.g. bench_stream.py --controller G2Core --g2core
+
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+
+BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bCNC")
+SIM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "grbl_sim.py")
+sys.path[:0] = [
+    BASE,
+    os.path.join(BASE, "lib"),
+    os.path.join(BASE, "plugins"),
+    os.path.join(BASE, "controllers"),
+]
+
+import Helpers  # noqa: F401,E402 (installs _())
+import Utils  # noqa: E402
+
+Utils.loadConfiguration(systemOnly=True)
+
+from Sender import Sender  # noqa: E402
+
+
+# =============================================================================
+# Sender without the user interface of Application
+# =============================================================================
+class BenchSender(Sender):
+    def disable(self):
+        pass
+
+    def enable(self):
+        pass
+
+
+parser = argparse.ArgumentParser(description="Stream a synthetic job")
+parser.add_argument("--lines", type=int, default=5000,
+                    help="G1 segments in the job (default 5000)")
+parser.add_argument("--segment", type=float, default=0.5,
+                    help="length of every segment in mm (default 0.5)")
+parser.add_argument("--feed", type=float, default=3000.0,
+                    help="feed rate in mm/min (default 3000)")
+parser.add_argument("--controller", default="GRBL1",
+                    help="controller plugin (default GRBL1)")
+parser.add_argument("--timeout", type=float, default=600.0,
+                    help="give up after so many seconds (default 600)")
+args, simArgs = parser.parse_known_args()
+
+# synthetic job: a polygon of segments on a circle
+radius = max(1.0, args.lines * args.segment / (2.0 * math.pi))
+step = args.segment / radius
+job = [f"G90 G21 G1 F{args.feed:g}"]
+for i in range(1, args.lines + 1):
+    a = i * step
+    job.append(f"X{radius * math.cos(a) - radius:.3f}"
+               f"Y{radius * math.sin(a):.3f}")
+
+fd, statsFile = tempfile.mkstemp(suffix=".json")
+os.close(fd)
+device = (f"pty:{sys.executable} {SIM} --stats {statsFile} "
+          + " ".join(simArgs))
+
+sender = BenchSender()
+sender.controllerSet(args.controller)
+sender.gcode.addBlockFromString("bench", "\n".join(job))
+print(f"{len(job)} lines, {args.lines * args.segment:g} mm at F{args.feed:g}")
+print(f"device {device}")
+sender.open(device, 115200)
+try:
+    time.sleep(0.5)  # let the first status reports calibrate the RX buffer
+    print(f"RX buffer {sender.rxBufferSize} bytes")
+
+    # start the run like Application.run does
+    sender.initRun()
+    sender._runLines = sys.maxsize
+    sender._gcount = 0
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    sender.compileStart()
+
+    while (sender._runLines == sys.maxsize
+           or sender._gcount < sender._runLines):
+        if time.perf_counter() - t0 > args.timeout:
+            print("TIMEOUT")
+            break
+        # drain the log as the GUI would do
+        while not sender.log.empty():
+            sender.log.get_nowait()
+        time.sleep(0.01)
+
+    wall = time.perf_counter() - t0
+    cpu = time.process_time() - cpu0
+    lines = sender._gcount
+    sender.runEnded()
+finally:
+    sender.close()
+with open(statsFile) as f:
+    stats = json.load(f)
+os.unlink(statsFile)
+
+ideal = args.lines * args.segment / (args.feed / 60.0)
+print(f"streamed   {lines} lines in {wall:.2f}s, {lines / wall:.0f} lines/s")
+print(f"machine    {stats['motion_time']:.2f}s moving, "
+      f"{ideal:.2f}s at full feed")
+print(f"starvation {stats['starved']} times, "
+      f"{stats['starved_time']:.3f}s with an empty planner")
+print(f"serial     {stats['bytes']} bytes sent, "
+      f"{stats['sent']} bytes answered")
+print(f"host CPU   {cpu:.2f}s, {100.0 * cpu / wall:.0f}% of a core")
+if stats["rx_overflows"]:
+    print(f"WARNING: {stats['rx_overflows']} bytes overflowed the RX buffer")
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark of the g-code line tokenizer
+#
+# Compares the legacy regex pipeline of CNC.parseLine (PARENPAT, SEMIPAT,
+# space strip, CMDPAT) followed by the float(cmd[1:]) / cmd[0].upper()
+# conversion that motionStart did for every word, against the single pass
+# CNC.tokenizeLine returning (LETTER, value) tuples.
+# The sample file is repeated until it reaches the requested number of lines.
+# The line cache is disabled so that every line is really parsed.
+#
+# Usage: bench_tokenizer.py [lines] [gcode file]
+
+import os
+import sys
+import time
+
+BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bCNC")
+sys.path[:0] = [
+    BASE,
+    os.path.join(BASE, "lib"),
+    os.path.join(BASE, "plugins"),
+    os.path.join(BASE, "controllers"),
+]
+
+from CNC import CNC  # noqa: E402
+
+count = 1000000
+filename = os.path.join(os.path.dirname(__file__), "static", "sample.gcode")
+if len(sys.argv) > 1:
+    count = int(sys.argv[1])
+if len(sys.argv) > 2:
+    filename = sys.argv[2]
+
+with open(filename) as f:
+    sample = [x.rstrip("\n") for x in f]
+lines = (sample * (count // len(sample) + 1))[:count]
+print(f"{len(lines)} lines from {filename}")
+
+CNC.lineCache.resize(0)
+
+
+# -----------------------------------------------------------------------------
+def legacy(lines):
+    words = 0
+    for line in lines:
+        cmds = CNC._parseLine(line)
+        if cmds is None:
+            continue
+        for cmd in cmds:
+            # the conversion is timed, its result is not needed
+            cmd[0].upper()
+            try:
+                float(cmd[1:])
+            except ValueError:
+                pass
+            words += 1
+    return words
+
+
+# -----------------------------------------------------------------------------
+def tokenizer(lines):
+    words = 0
+    for line in lines:
+        cmds = CNC._tokenizeLine(line)
+        if cmds is None:
+            continue
+        for c, value in cmds:
+            words += 1
+    return words
+
+
+# -----------------------------------------------------------------------------
+def motion(lines):
+    cnc = CNC()
+    for line in lines:
+        cmds = CNC.tokenizeLine(line)
+        if cmds is None:
+            continue
+        cnc.motionStart(cmds)
+        cnc.motionEnd()
+
+
+# -----------------------------------------------------------------------------
+def bench(name, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    t = time.perf_counter() - start
+    print(f"{name:<24} {t:8.3f}s {len(lines) / t / 1000.0:10.1f} klines/s")
+    return t, result
+
+
+t0, w0 = bench("parseLine + float()", legacy, lines)
+t1, w1 = bench("tokenizeLine", tokenizer, lines)
+if w0 != w1:
+    print(f"WARNING: word count differs {w0} != {w1}")
+print(f"speedup {t0 / t1:.2f}x")
+bench("tokenizeLine + motion", motion, lines)
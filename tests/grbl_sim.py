@@ -0,0 +1,640 @@
+#!/usr/bin/env python3
+
+# Simulated GRBL 1.1 controller for streaming benchmarks
+#
+# Unlike fake-grbl.sh, which acknowledges every byte at once, the simulator
+# keeps a serial RX buffer of limited size and a planner queue. Lines are
+# parsed only when the planner has room, the motion blocks are executed in
+# real time from their length, feed and acceleration, and the ok and the
+# status reports are answered after a configurable latency. The status
+# report carries Bf:<planner free>,<rx free> as grbl does with $10=2, and
+# Ln:<number> when the block in motion came from a line numbered with N.
+#
+# The execution of each block follows a trapezoid. Its exit speed is
+# limited by the distance left in the planner (the machine must be able to
+# stop at the end of the queue), so too short segments or a host that is
+# not fast enough show up as a slower run and as planner starvation: the
+# planner running empty in the middle of a job.
+# Junctions are assumed straight and arcs are split in chords like
+# grbl does with $12.
+#
+# Usage:
+#       grbl_sim.py [options]                   serve stdin/stdout, to be
+#                                               used with bCNC "pty:" device
+#       grbl_sim.py --tcp 2323 [options]        serve a TCP port
+#       grbl_sim.py --pty /tmp/ttyFAKE [opt]    create a pseudo terminal and
+#                                               link it at the path
+#       grbl_sim.py --g2core [options]          speak the JSON protocol of
+#                                               g2core instead of grbl
+# The statistics are written as json to --stats at exit, or to stderr.
+
+import argparse
+import heapq
+import json
+import math
+import os
+import re
+import signal
+import socket
+import sys
+import threading
+import time
+from collections import deque
+
+BANNER = b"\r\nGrbl 1.1h ['$' for help]\r\n"
+REALTIME = {ord("?"), ord("!"), ord("~"), 0x18}
+
+
+# =============================================================================
+# Simulated controller. The transport calls feed() with the bytes received
+# and the simulator calls write() with the bytes to answer.
+# =============================================================================
+class Simulator:
+    BANNER = BANNER
+    REALTIME = REALTIME
+    RX_SIZE = 128
+
+    def __init__(self, write, args):
+        self.write = write
+        self.rxSize = args.rx or self.RX_SIZE
+        self.plannerSize = args.planner
+        self.accel = args.accel  # mm/s^2
+        self.rapid = args.rapid / 60.0  # mm/s
+        self.tolerance = args.tolerance
+        self.okLatency = args.ok_latency
+        self.statusLatency = args.status_latency
+
+        self._cond = threading.Condition()
+        self._rx = bytearray()
+        self._planner = deque()  # [length mm, feed mm/s, target]
+        self._queued = 0.0  # length in the planner
+        self._speed = 0.0  # exit speed of the last block, mm/s
+        self._hold = False
+        self._outgoing = []  # heap of (time, seq, data)
+        self._seq = 0
+
+        # modal state
+        self._pos = [0.0, 0.0, 0.0]  # where the parser is
+        self._mpos = [0.0, 0.0, 0.0]  # where the machine is
+        self._motion = 0
+        self._absolute = True
+        self._feed = 0.0  # mm/s
+
+        # statistics
+        self.lines = 0
+        self.bytes = 0
+        self.sent = 0  # bytes answered to the host
+        self.blocks = 0
+        self.overflows = 0
+        self.starved = 0  # planner ran empty and was refilled later
+        self.starvedTime = 0.0
+        self.busyTime = 0.0  # time spent executing blocks
+        self._emptySince = None
+        self._first = None
+        self._last = None
+
+        for target in self.threads():
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+        self.answer(self.BANNER)
+
+    # ----------------------------------------------------------------------
+    def threads(self):
+        return (self._parser, self._executor, self._writer)
+
+    # ----------------------------------------------------------------------
+    def answer(self, data, delay=0.0):
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(
+                self._outgoing, (time.perf_counter() + delay, self._seq, data)
+            )
+            self._cond.notify_all()
+
+    # ----------------------------------------------------------------------
+    def _writer(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.perf_counter()
+                    if self._outgoing and self._outgoing[0][0] <= now:
+                        data = heapq.heappop(self._outgoing)[2]
+                        break
+                    self._cond.wait(
+                        self._outgoing[0][0] - now if self._outgoing else None
+                    )
+            try:
+                self.write(data)
+            except OSError:
+                return
+            self.sent += len(data)
+
+    # ----------------------------------------------------------------------
+    # Bytes from the host. Realtime commands are served at once, the rest
+    # goes to the RX buffer, counting the bytes that do not fit
+    # ----------------------------------------------------------------------
+    def feed(self, data):
+        with self._cond:
+            for c in data:
+                if c in self.REALTIME:
+                    self._realtime(c)
+                elif len(self._rx) < self.rxSize - 1:
+                    self._rx.append(c)
+                else:
+                    self.overflows += 1
+            self._cond.notify_all()
+
+    # ----------------------------------------------------------------------
+    def _realtime(self, c):
+        if c == ord("?"):
+            self.answer(self._status(), self.statusLatency)
+        elif c == ord("!"):
+            self._hold = True
+        elif c == ord("~"):
+            self._hold = False
+        elif c == 0x18:
+            self._hold = False
+            self._flush()
+            self.answer(self.BANNER)
+
+    # ----------------------------------------------------------------------
+    def _flush(self):
+        self._rx.clear()
+        self._queueChanged(0, len(self._planner))
+        self._planner.clear()
+        self._queued = 0.0
+        self._speed = 0.0
+        self._pos = list(self._mpos)
+
+    # ----------------------------------------------------------------------
+    # Blocks added to and removed from the planner, called with the lock
+    # ----------------------------------------------------------------------
+    def _queueChanged(self, added, removed):
+        pass
+
+    # ----------------------------------------------------------------------
+    def _status(self):
+        if self._hold:
+            state = "Hold:0"
+        elif self._planner:
+            state = "Run"
+        else:
+            state = "Idle"
+        mpos = ",".join(f"{x:.3f}" for x in self._mpos)
+        feed = self._planner[0][1] * 60.0 if self._planner else 0.0
+        number = self._planner[0][3] if self._planner else 0
+        return (
+            f"<{state}|MPos:{mpos}"
+            f"|Bf:{self.plannerSize - len(self._planner)},"
+            f"{self.rxSize - len(self._rx)}"
+            + (f"|Ln:{number}" if number else "")
+            + f"|FS:{feed:.0f},0>\r\n"
+        ).encode()
+
+    # ----------------------------------------------------------------------
+    # Parse the lines of the RX buffer as long as the planner has room
+    # ----------------------------------------------------------------------
+    def _parser(self):
+        while True:
+            with self._cond:
+                while (b"\n" not in self._rx
+                       or len(self._planner) >= self.plannerSize):
+                    self._cond.wait()
+                # the line leaves the RX buffer before being planned
+                n = self._rx.index(b"\n") + 1
+                line = bytes(self._rx[:n]).decode(errors="ignore")
+                del self._rx[:n]
+                self.lines += 1
+                self.bytes += n
+            if self.okLatency > 0.0:
+                time.sleep(self.okLatency)
+            self.answer(self._execute(line.strip()))
+
+    # ----------------------------------------------------------------------
+    def _execute(self, line):
+        line = line.upper()
+        if not line:
+            return b"ok\r\n"
+        if line[0] == "$":
+            if line == "$G":
+                return (
+                    f"[GC:G{self._motion} G54 G17 G21 "
+                    f"G{90 if self._absolute else 91} G94 M5 M9 T0 "
+                    f"F{self._feed * 60.0:g} S0]\r\nok\r\n"
+                ).encode()
+            if line == "$I":
+                return b"[VER:1.1h.sim:]\r\n[OPT:V,15,128]\r\nok\r\n"
+            return b"ok\r\n"
+
+        words = {}
+        i = 0
+        n = len(line)
+        try:
+            while i < n:
+                c = line[i]
+                if c in " \t":
+                    i += 1
+                    continue
+                if c == "(":
+                    i = line.index(")", i) + 1
+                    continue
+                if c == ";":
+                    break
+                j = i + 1
+                while j < n and (line[j] in "+-.0123456789 "):
+                    j += 1
+                value = float(line[i + 1:j].replace(" ", ""))
+                if c == "G":
+                    g = int(value)
+                    if g in (0, 1, 2, 3):
+                        self._motion = g
+                    elif g == 90:
+                        self._absolute = True
+                    elif g == 91:
+                        self._absolute = False
+                else:
+                    words[c] = value
+                i = j
+        except ValueError:
+            return b"error:2\r\n"
+
+        if "F" in words:
+            self._feed = words["F"] / 60.0
+        target = list(self._pos)
+        moved = False
+        for k, axis in enumerate("XYZ"):
+            if axis in words:
+                moved = True
+                if self._absolute:
+                    target[k] = words[axis]
+                else:
+                    target[k] += words[axis]
+        if not moved:
+            return b"ok\r\n"
+        number = int(words.get("N", 0))
+        if self._motion == 0:
+            self._plan(target, self.rapid, number)
+        elif self._feed <= 0.0:
+            return b"error:22\r\n"
+        elif self._motion == 1:
+            self._plan(target, self._feed, number)
+        else:
+            self._arc(target, words.get("I", 0.0), words.get("J", 0.0),
+                      number)
+        return b"ok\r\n"
+
+    # ----------------------------------------------------------------------
+    # Split an XY arc in chords within the tolerance
+    # ----------------------------------------------------------------------
+    def _arc(self, target, i, j, number):
+        x0, y0, z0 = self._pos
+        cx, cy = x0 + i, y0 + j
+        r = math.hypot(i, j)
+        a0 = math.atan2(y0 - cy, x0 - cx)
+        a1 = math.atan2(target[1] - cy, target[0] - cx)
+        da = a1 - a0
+        if self._motion == 2 and da >= 0.0:
+            da -= 2.0 * math.pi
+        elif self._motion == 3 and da <= 0.0:
+            da += 2.0 * math.pi
+        if r > self.tolerance:
+            step = 2.0 * math.acos(1.0 - self.tolerance / r)
+        else:
+            step = abs(da)
+        segments = max(1, int(math.ceil(abs(da) / step)))
+        for k in range(1, segments):
+            a = a0 + da * k / segments
+            self._plan(
+                [cx + r * math.cos(a), cy + r * math.sin(a),
+                 z0 + (target[2] - z0) * k / segments],
+                self._feed,
+                number,
+            )
+        self._plan(target, self._feed, number)
+
+    # ----------------------------------------------------------------------
+    # Queue a block, waiting for room in the planner like grbl does.
+    # The line number N is reported as Ln: while the block is executed
+    # ----------------------------------------------------------------------
+    def _plan(self, target, feed, number=0):
+        length = math.dist(self._pos, target)
+        self._pos = target
+        if length <= 0.0:
+            return
+        with self._cond:
+            while len(self._planner) >= self.plannerSize:
+                self._cond.wait()
+            if self._emptySince is not None:
+                self.starved += 1
+                self.starvedTime += time.perf_counter() - self._emptySince
+                self._emptySince = None
+            self._planner.append([length, feed, target, number])
+            self._queued += length
+            self.blocks += 1
+            self._queueChanged(1, 0)
+            self._cond.notify_all()
+
+    # ----------------------------------------------------------------------
+    # Execute the planner blocks in real time
+    # ----------------------------------------------------------------------
+    def _executor(self):
+        while True:
+            with self._cond:
+                while not self._planner or self._hold:
+                    self._cond.wait()
+                length, feed, target, _ = self._planner[0]
+                after = max(0.0, self._queued - length)
+                nextFeed = self._planner[1][1] if len(self._planner) > 1 else 0
+            v0 = self._speed
+            a = self.accel
+            # exit speed: reachable, and able to stop within the queue
+            v1 = min(feed, nextFeed, math.sqrt(v0 * v0 + 2.0 * a * length),
+                     math.sqrt(2.0 * a * after))
+            vp = min(feed,
+                     math.sqrt((2.0 * a * length + v0 * v0 + v1 * v1) / 2))
+            vp = max(vp, v0, v1)
+            accel = max(0.0, (vp * vp - v0 * v0) / (2.0 * a))
+            decel = max(0.0, (vp * vp - v1 * v1) / (2.0 * a))
+            cruise = max(0.0, length - accel - decel)
+            dt = (vp - v0) / a + (vp - v1) / a + (cruise / vp if vp > 0 else 0)
+            start = time.perf_counter()
+            if self._first is None:
+                self._first = start
+            time.sleep(dt)
+            with self._cond:
+                if not self._planner:  # reset while moving
+                    self._speed = 0.0
+                    continue
+                self._planner.popleft()
+                self._queued -= length
+                self._queueChanged(0, 1)
+                self._mpos = list(target)
+                self._speed = v1
+                self.busyTime += time.perf_counter() - start
+                self._last = time.perf_counter()
+                if not self._planner:
+                    self._queued = 0.0
+                    self._speed = 0.0
+                    self._emptySince = self._last
+                self._cond.notify_all()
+
+    # ----------------------------------------------------------------------
+    def stats(self):
+        with self._cond:
+            return {
+                "lines": self.lines,
+                "bytes": self.bytes,
+                "sent": self.sent,
+                "blocks": self.blocks,
+                "rx_overflows": self.overflows,
+                "starved": self.starved,
+                "starved_time": round(self.starvedTime, 4),
+                "busy_time": round(self.busyTime, 4),
+                "motion_time": round((self._last or 0.0)
+                                     - (self._first or 0.0), 4),
+            }
+
+
+# =============================================================================
+# The same machine speaking the JSON protocol of g2core: every line is
+# answered with {"r":{...},"f":[1,status,length]} once parsed, the status
+# reports {"sr":{...}} are sent automatically when they change (sv:1) and
+# filtered on the fields asked with {sr:{...:t}}, and the queue reports
+# {"qr":free,"qi":added,"qo":removed} follow the planner (qv:1 or 2)
+# =============================================================================
+class G2Simulator(Simulator):
+    BANNER = (b'{"r":{"fv":0.99,"fb":101.03,"hp":3,"hv":0,"id":"sim",'
+              b'"msg":"SYSTEM READY"},"f":[1,0,0]}\n')
+    REALTIME = {ord("?"), ord("!"), ord("~"), ord("%"), 0x04, 0x18}
+    RX_SIZE = 1024
+    STAT_OK = 0
+    STAT_ERROR = 1
+    STAT_JSON_SYNTAX = 40  # simulated codes, the host only tells 0 from !0
+    INTERVAL = 0.25  # si, status report interval
+    QUEUE_INTERVAL = 0.01  # shortest interval between queue reports
+
+    def __init__(self, write, args):
+        self._filter = ["stat", "line", "posx", "posy", "posz", "vel"]
+        self._sv = 1
+        self._qv = 0
+        self._added = 0
+        self._removed = 0
+        Simulator.__init__(self, write, args)
+
+    # ----------------------------------------------------------------------
+    def threads(self):
+        return Simulator.threads(self) + (self._reporter,)
+
+    # ----------------------------------------------------------------------
+    def _realtime(self, c):
+        if c in (ord("%"), 0x04):
+            # queue flush, only in feed hold
+            if self._hold:
+                self._flush()
+        else:
+            Simulator._realtime(self, c)
+
+    # ----------------------------------------------------------------------
+    def _queueChanged(self, added, removed):
+        self._added += added
+        self._removed += removed
+
+    # ----------------------------------------------------------------------
+    def _status(self):
+        return self._json({"sr": self._report()})
+
+    # ----------------------------------------------------------------------
+    def _report(self):
+        if self._hold:
+            stat = 6
+        elif self._planner:
+            stat = 5
+        else:
+            stat = 3 if self.blocks else 1
+        block = self._planner[0] if self._planner else None
+        values = {
+            "stat": stat,
+            "line": block[3] if block else 0,
+            "vel": round(block[1] * 60.0, 3) if block else 0,
+            "feed": round(self._feed * 60.0, 3),
+            "unit": 1,
+            "coor": 1,
+            "plan": 0,
+            "dist": 0 if self._absolute else 1,
+            "frmo": 1,
+            "g92e": 0,
+            "tool": 0,
+            "spc": 0,
+            "sps": 0,
+        }
+        for k, axis in enumerate("xyz"):
+            values["pos" + axis] = round(self._mpos[k], 4)
+            values["mpo" + axis] = round(self._mpos[k], 4)
+            values["tof" + axis] = 0
+        return {k: values[k] for k in self._filter if k in values}
+
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def _json(values):
+        return json.dumps(values, separators=(",", ":")).encode() + b"\n"
+
+    # ----------------------------------------------------------------------
+    def _execute(self, line):
+        if not line:
+            return b""
+        if line[0] == "{":
+            reply, status = self._command(line)
+        else:
+            reply = {}
+            answer = Simulator._execute(self, line)
+            status = self.STAT_OK if answer.endswith(b"ok\r\n") \
+                else self.STAT_ERROR
+        return self._json({"r": reply, "f": [1, status, len(line) + 1]})
+
+    # ----------------------------------------------------------------------
+    # Relaxed JSON as g2core accepts it: {sr:n}, {qv:2}, {sr:{stat:t}}
+    # ----------------------------------------------------------------------
+    def _command(self, line):
+        text = re.sub(r"([{,]\s*)([A-Za-z_]\w*)\s*:", r'\1"\2":', line)
+        text = re.sub(r":\s*n\b", ":null", text)
+        text = re.sub(r":\s*t\b", ":true", text)
+        text = re.sub(r":\s*f\b", ":false", text)
+        try:
+            request = json.loads(text)
+        except ValueError:
+            return {}, self.STAT_JSON_SYNTAX
+        reply = {}
+        with self._cond:
+            for key, value in request.items():
+                if key == "sr":
+                    if isinstance(value, dict):
+                        self._filter = [k for k, v in value.items() if v]
+                    reply[key] = self._report()
+                elif key in ("sv", "qv"):
+                    if value is not None:
+                        setattr(self, "_" + key, int(value))
+                    reply[key] = getattr(self, "_" + key)
+                elif key == "qr":
+                    reply[key] = self.plannerSize - len(self._planner)
+                else:
+                    reply[key] = {} if value is None else value
+        return reply, self.STAT_OK
+
+    # ----------------------------------------------------------------------
+    # Automatic status and queue reports
+    # ----------------------------------------------------------------------
+    def _reporter(self):
+        last = None
+        tsr = 0.0
+        while True:
+            time.sleep(self.QUEUE_INTERVAL)
+            now = time.perf_counter()
+            with self._cond:
+                if self._qv and (self._added or self._removed):
+                    queue = {"qr": self.plannerSize - len(self._planner)}
+                    if self._qv > 1:
+                        queue["qi"] = self._added
+                        queue["qo"] = self._removed
+                    self._added = self._removed = 0
+                    self.answer(self._json(queue))
+                if self._sv and now - tsr >= self.INTERVAL:
+                    tsr = now
+                    report = self._report()
+                    if report != last:
+                        last = report
+                        self.answer(self._json({"sr": report}))
+
+
+# -----------------------------------------------------------------------------
+def serveFd(sim, fd):
+    while True:
+        try:
+            data = os.read(fd, 4096)
+        except OSError:
+            return
+        if not data:
+            return
+        sim.feed(data)
+
+
+# -----------------------------------------------------------------------------
+def argumentParser():
+    parser = argparse.ArgumentParser(description="Simulated GRBL 1.1")
+    parser.add_argument("--tcp", type=int, help="serve on this TCP port")
+    parser.add_argument("--pty", help="create a pty linked at this path")
+    parser.add_argument("--rx", type=int,
+                        help="RX buffer size (default 128, 1024 for g2core)")
+    parser.add_argument("--planner", type=int, default=15,
+                        help="planner blocks (default 15)")
+    parser.add_argument("--accel", type=float, default=500.0,
+                        help="acceleration mm/s^2 (default 500)")
+    parser.add_argument("--rapid", type=float, default=5000.0,
+                        help="rapid rate mm/min (default 5000)")
+    parser.add_argument("--tolerance", type=float, default=0.002,
+                        help="arc tolerance mm (default 0.002)")
+    parser.add_argument("--ok-latency", type=float, default=0.0005,
+                        help="parse time of a line in s (default 0.0005)")
+    parser.add_argument("--status-latency", type=float, default=0.001,
+                        help="delay of the status report in s (default 0.001)")
+    parser.add_argument("--g2core", action="store_true",
+                        help="speak the JSON protocol of g2core")
+    parser.add_argument("--stats", help="write the statistics to this file")
+    return parser
+
+
+# -----------------------------------------------------------------------------
+def main():
+    args = argumentParser().parse_args()
+
+    sim = None
+    simulator = G2Simulator if args.g2core else Simulator
+
+    def report(*_):
+        if sim is not None:
+            text = json.dumps(sim.stats())
+            if args.stats:
+                with open(args.stats, "w") as f:
+                    f.write(text + "\n")
+            else:
+                sys.stderr.write(text + "\n")
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, report)
+    signal.signal(signal.SIGINT, report)
+
+    if args.tcp is not None:
+        server = socket.socket()
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("", args.tcp))
+        server.listen(1)
+        conn, _ = server.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sim = simulator(conn.sendall, args)
+        serveFd(sim, conn.fileno())
+
+    elif args.pty is not None:
+        import pty
+        import tty
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        if os.path.lexists(args.pty):
+            os.unlink(args.pty)
+        os.symlink(os.ttyname(slave), args.pty)
+        print(f"Listening at fake serial port: {args.pty}")
+        sim = simulator(lambda data: os.write(master, data), args)
+        try:
+            serveFd(sim, master)
+        finally:
+            os.unlink(args.pty)
+
+    else:
+        out = sys.stdout.fileno()
+        sim = simulator(lambda data: os.write(out, data), args)
+        serveFd(sim, sys.stdin.fileno())
+
+    report()
+
+
+if __name__ == "__main__":
+    main()
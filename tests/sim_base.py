@@ -0,0 +1,108 @@
+import socket
+import sys
+import threading
+import time
+import unittest
+
+import Helpers  # noqa: F401 (installs _())
+import Utils
+
+Utils.loadConfiguration(systemOnly=True)
+
+from CNC import CNC  # noqa: E402
+from Sender import Sender  # noqa: E402
+
+from . import grbl_sim  # noqa: E402
+
+
+# Sender without the user interface of Application
+class SimSender(Sender):
+    def disable(self):
+        pass
+
+    def enable(self):
+        pass
+
+
+# Sender connected over a loopback socket to grbl_sim.py running in this
+# process, so that the tests can look at both sides
+class SimulatorTestCase(unittest.TestCase):
+    controller = "GRBL1"
+    simulator = grbl_sim.Simulator
+    simArgs = []
+
+    def setUp(self):
+        super().setUp()
+        self.messages = []  # drained from the log of the sender
+        args = grbl_sim.argumentParser().parse_args(self.simArgs)
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        port = server.getsockname()[1]
+        ready = threading.Event()
+
+        def serve():
+            conn, _ = server.accept()
+            server.close()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sim = self.simulator(conn.sendall, args)
+            ready.set()
+            grbl_sim.serveFd(self.sim, conn.fileno())
+            conn.close()
+
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+
+        self.sender = SimSender()
+        self.sender.controllerSet(self.controller)
+        self.sender.open(f"tcp://127.0.0.1:{port}", 115200)
+        self.addCleanup(self.sender.close)
+        self.assertTrue(ready.wait(5))
+        # let the replies to the connection come back and the controller
+        # report its state, before counting the lines in flight
+        self.assertTrue(self.waitFor(lambda: CNC.vars["state"] == "Idle"))
+        self.waitFor(lambda: False, 0.5)
+
+    # wait until condition() is true, draining the log as the GUI does
+    def waitFor(self, condition, timeout=10.0):
+        end = time.time() + timeout
+        while time.time() < end:
+            while not self.sender.log.empty():
+                self.messages.append(self.sender.log.get_nowait())
+            if condition():
+                return True
+            time.sleep(0.01)
+        return False
+
+    # freeze the motion of the simulated machine
+    def hold(self, hold=True):
+        with self.sim._cond:
+            self.sim._hold = hold
+            self.sim._cond.notify_all()
+
+    # motion lines waiting in the rx buffer of the simulator
+    def rxMoves(self):
+        with self.sim._cond:
+            return self.sim._rx.upper().count(b"G1")
+
+    # stream a job as Application.run() does, True if it completed
+    def stream(self, lines, timeout=60.0):
+        sender = self.sender
+        sender.gcode.addBlockFromString("test", "\n".join(lines))
+        sender.initRun()
+        sender._runLines = sys.maxsize
+        sender._gcount = 0
+        sender.compileStart()
+
+        def ended():
+            paths = sender._paths
+            while paths:  # consumed by the GUI while running
+                paths.popleft()
+            return (sender._runLines != sys.maxsize
+                    and sender._gcount >= sender._runLines)
+
+        finished = self.waitFor(ended, timeout)
+        sender.runEnded()
+        self.waitFor(lambda: sender.log.empty(), 1.0)
+        return finished
@@ -0,0 +1,445 @@
+import math
+import os
+import pickle
+import tempfile
+import unittest
+
+from CNC import (
+    CNC, ERROR_HANDLING, SKIP, Block, CompactBlock, GCode, LazyBlock,
+    LineCache, StreamReducer)
+
+SAMPLE = os.path.join(os.path.dirname(__file__), "static", "sample.gcode")
+
+# lines off the fast path of the tokenizer ($ commands are sent as is)
+TRICKY = [
+    "G1 X1.5 (move comment) Y-2 ; end",
+    "g1x.5y-.25f1000",
+    "G0 X[1+2] Y3",
+    "N10 G2 X1 Y1 I0.5 J0 F200",
+    "M3 S12000",
+    "G1 X1 Y",
+    "(only a comment)",
+    "%",
+    "",
+    "/",
+    "(leading comment) G1 X2",
+]
+
+
+def sample():
+    with open(SAMPLE) as f:
+        return [x.rstrip("\n") for x in f]
+
+
+# -----------------------------------------------------------------------------
+# Word conversion done by the compiler before the tokenizer
+# -----------------------------------------------------------------------------
+def legacyWords(line):
+    cmds = CNC._parseLine(line)
+    if cmds is None:
+        return None
+    words = []
+    for cmd in cmds:
+        if not cmd[0].isalpha():
+            continue  # the tokenizer returns letter words only, e.g. not /
+        try:
+            value = float(cmd[1:])
+        except ValueError:
+            value = 0.0
+        words.append((cmd[0].upper(), value))
+    return words
+
+
+# -----------------------------------------------------------------------------
+# Formatting of the lines done by the compiler before the tokenizer
+# -----------------------------------------------------------------------------
+def legacyCompile(lines):
+    out = []
+    for line in lines:
+        cmds = CNC.compileLine(line)
+        if cmds is None or not isinstance(cmds, str) or cmds[0] == "$":
+            continue
+        newcmd = []
+        for cmd in CNC.breakLine(cmds):
+            c = cmd[0]
+            try:
+                value = float(cmd[1:])
+            except ValueError:
+                value = 0.0
+            if c.upper() in ("F", "X", "Y", "Z", "I", "J", "K", "R", "P"):
+                cmd = CNC.fmt(c, value)
+            elif ERROR_HANDLING.get(cmd.upper(), 0) == SKIP:
+                cmd = None
+            if cmd is not None:
+                newcmd.append(cmd)
+        out.append("".join(newcmd))
+    return out
+
+
+class LineCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LineCache(3)
+        for line in "abc":
+            cache.put(line, LineCache.PARSE, line.upper())
+        self.assertEqual(cache.get("a", LineCache.PARSE), "A")  # most recent
+        cache.put("d", LineCache.PARSE, "D")
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get("b", LineCache.PARSE))
+        self.assertEqual([cache.get(x, LineCache.PARSE) for x in "acd"],
+                         ["A", "C", "D"])
+        self.assertEqual((cache.hits, cache.misses), (4, 1))
+
+    def test_one_entry_per_line(self):
+        cache = LineCache(2)
+        cache.put("G1X1", LineCache.PARSE, ("G1", "X1"))
+        cache.put("G1X1", LineCache.WORDS, (("G", 1.0), ("X", 1.0)))
+        cache.put("G1X1", LineCache.BREAK, ("G1", "X1"))
+        cache.put("G0", LineCache.WORDS, (("G", 0.0),))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("G1X1", LineCache.BREAK), ("G1", "X1"))
+        self.assertIsNone(cache.get("G0", LineCache.PARSE))
+
+    def test_resize(self):
+        cache = LineCache(4)
+        for line in "abcd":
+            cache.put(line, LineCache.PARSE, line)
+        cache.resize(2)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b", LineCache.PARSE))
+        self.assertEqual(cache.get("d", LineCache.PARSE), "d")
+        cache.resize(0)
+        cache.put("e", LineCache.PARSE, "e")
+        self.assertEqual(len(cache), 0)
+
+    def test_program_bigger_than_cache(self):
+        cache = LineCache(2)
+        cache.put("a", LineCache.PARSE, "a")
+        cache.fit(3)
+        self.assertFalse(cache.active)
+        self.assertEqual(len(cache), 0)
+        cache.put("b", LineCache.PARSE, "b")
+        self.assertIsNone(cache.get("b", LineCache.PARSE))
+        self.assertEqual((len(cache), cache.misses), (0, 0))
+        cache.fit(2)
+        cache.put("b", LineCache.PARSE, "b")
+        self.assertEqual(cache.get("b", LineCache.PARSE), "b")
+
+    def test_second_pass_hits(self):
+        # every consumer of a line shares its entry
+        lines = [f"G1 X{i} Y{i} (point {i})" for i in range(50)]
+        cache, CNC.lineCache = CNC.lineCache, LineCache(2 * len(lines))
+        self.addCleanup(setattr, CNC, "lineCache", cache)
+        gcode = GCode()
+        gcode.addBlockFromString("b", "\n".join(lines))
+        gcode.calculateMargins()
+        list(gcode.iterCompile())
+        misses = CNC.lineCache.misses
+        list(gcode.iterCompile())
+        self.assertEqual(CNC.lineCache.misses, misses)
+        self.assertEqual(len(CNC.lineCache), len(lines) + 1)  # + startup
+
+
+class TokenizerTest(unittest.TestCase):
+    def setUp(self):
+        self.size = CNC.lineCache.size
+        CNC.lineCache.resize(0)  # parse every line for real
+
+    def tearDown(self):
+        CNC.lineCache.resize(self.size)
+
+    def test_same_words_as_legacy(self):
+        for line in sample() + TRICKY:
+            self.assertEqual(CNC._tokenizeLine(line), legacyWords(line), line)
+
+    def test_nested_comment(self):
+        # the legacy regex stopped at the first closing parenthesis
+        self.assertEqual(CNC._tokenizeLine("G1 X1 (a (b) c) Y2"),
+                         [("G", 1.0), ("X", 1.0), ("Y", 2.0)])
+
+    def test_cached_words(self):
+        CNC.lineCache.resize(100)
+        for line in TRICKY:
+            first = CNC.tokenizeLine(line)
+            self.assertEqual(CNC.tokenizeLine(line), first, line)
+
+    def test_compile_same_as_legacy(self):
+        gcode = GCode()
+        gcode.addBlockFromString("sample", "\n".join(sample()))
+        compiled = [
+            line for line, path in gcode.iterCompile()
+            if path is not None and isinstance(line, str)
+        ]
+        legacy = legacyCompile(sample())
+        self.assertEqual(len(compiled), len(legacy))
+        for new, old in zip(compiled, legacy):
+            self.assertEqual(CNC.tokenizeLine(new), CNC.tokenizeLine(old),
+                             f"{new!r} != {old!r}")
+
+
+class IterCompileTest(unittest.TestCase):
+    PROGRAM = ["G20 G90 G0 X0 Y0", "G1 X1 Y1 F10", "X2", "G2 X4 Y1 I1 J0",
+               "X6 Y1 I1 J0", "G0 Z0.5"]
+
+    def setUp(self):
+        appendFeed = CNC.appendFeed
+        self.addCleanup(setattr, CNC, "appendFeed", appendFeed)
+        CNC.appendFeed = True  # depends on the units and the motion mode
+        self.gcode = GCode()
+        self.gcode.addBlockFromString("a", "\n".join(self.PROGRAM))
+        self.gcode.addBlockFromString("b", "\n".join(self.PROGRAM))
+
+    def test_changes_during_the_run(self):
+        expected = list(self.gcode.iterCompile())
+        compiled = self.gcode.iterCompile()
+        out = [next(compiled) for _ in range(3)]
+        # the canvas redraws from the start, and the program is edited
+        self.gcode.cnc.initPath()
+        self.gcode.cnc.motionStart(CNC.tokenizeLine("G21 G91 G0"))
+        self.gcode.setLineUndo(0, 2, "X9")
+        self.gcode.blocks[1].enable = False
+        self.gcode.blocks[1].append("M5")
+        out.extend(compiled)
+        self.assertEqual(out, expected)
+
+
+class ResumeTest(unittest.TestCase):
+    PROGRAM = ["G21 G90 G0 X0 Y0 Z5", "G1 Z-1 F300", "G2 X10 Y0 I5 J0",
+               "X0 Y0 I-5 J0", "G0 Z5", "G99 G83 X5 Y5 Z-2 R1 Q0.5 F100",
+               "X6 Y5", "G80"]
+
+    def setUp(self):
+        drillPolicy = CNC.drillPolicy
+        self.addCleanup(setattr, CNC, "drillPolicy", drillPolicy)
+        CNC.drillPolicy = 0  # send the canned cycles as they are
+        self.gcode = GCode()
+        self.gcode.addBlockFromString("a", "\n".join(self.PROGRAM))
+
+    def resume(self, lid):
+        return [(line.strip(), path)
+                for line, path in self.gcode.iterCompile((0, lid))]
+
+    def test_arc(self):
+        preamble, state, motion = self.gcode.resumePreamble(0, 3)
+        self.assertEqual(preamble[-2:], ["g1 z-1 f300", "F300"])
+        self.assertEqual(motion, "G2")
+        out = self.resume(3)
+        first = out.index(("G2X0Y0I-5J0", (0, 3)))
+        self.assertEqual(out[first - 1:first], [("F300", None)])
+        self.assertEqual(out[first + 1], ("G0Z5", (0, 4)))
+
+    def test_canned_cycle(self):
+        preamble, state, motion = self.gcode.resumePreamble(0, 6)
+        self.assertEqual(preamble[-1], "G99")
+        self.assertEqual(motion, "G83R1Q0.5")
+        self.assertEqual(self.resume(6)[-4:],
+                         [("F100", None), ("G99", None),
+                          ("G83R1Q0.5X6Y5", (0, 6)), ("G80", (0, 7))])
+
+    def test_own_motion(self):
+        # the first line sets its motion, nothing is put in front of it
+        self.assertEqual(self.resume(5)[-3:],
+                         [("G99G83X5Y5Z-2R1Q0.5F100", (0, 5)),
+                          ("X6Y5", (0, 6)), ("G80", (0, 7))])
+
+
+class StreamReducerTest(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(CNC.vars.pop, "grbl_100", None)
+        CNC.vars["grbl_100"] = "80"  # 0.0125 mm steps, two digits for X
+        self.reducer = StreamReducer()
+
+    def reduce(self, *lines):
+        return [self.reducer.reduceLine(line) for line in lines]
+
+    def test_modal_words(self):
+        lines = ["G90", "G1 X1 Y2 F100", "G1 X1 Y3 F100", "G1 X1 Y3 F100",
+                 "S1000 M3", "S1000 M5"]
+        out = self.reduce(*lines)
+        self.assertEqual(out, ["G90", "G1X1Y2F100", "Y3", "", "S1000M3", "M5"])
+        # the newline of the dropped line is saved as well
+        self.assertEqual(self.reducer.saved,
+                         sum(len(a) - len(b) for a, b in zip(lines, out)) + 1)
+
+    def test_resolution(self):
+        # linear moves are rounded to the steps, arcs keep their end point
+        self.assertEqual(
+            self.reduce("G90 G1 X1.23456 F100", "G1 X1.2301",
+                        "G2 X1.23456 Y0 I1 J0"),
+            ["G90G1X1.23F100", "", "G2X1.2346Y0I1J0"])
+
+    def test_untracked_words_reset(self):
+        for line in ("G92X0", "G53G0Z-1", "G38.2Z-10F50"):
+            self.reduce("G90 G1 X1 Y1 F100")
+            self.assertEqual(self.reduce(line, "G1 X1 Y1 F100"),
+                             [line, "G1X1Y1F100"], line)
+
+    def test_relative_moves(self):
+        # the position is unknown and a null move is redundant
+        self.assertEqual(
+            self.reduce("G91 G1 X1 F100", "G1 X1 F100", "G1 X0 Y1", "X0"),
+            ["G91G1X1F100", "X1", "Y1", ""])
+        self.assertEqual(self.reduce("G90", "G1 X1"), ["G90", "X1"])
+
+
+class ArcFitterTest(unittest.TestCase):
+    TOLERANCE = 0.01
+
+    def setUp(self):
+        arcfit, reducestream = CNC.arcfit, CNC.reducestream
+        self.addCleanup(setattr, CNC, "arcfit", arcfit)
+        self.addCleanup(setattr, CNC, "reducestream", reducestream)
+        CNC.arcfit = self.TOLERANCE
+        CNC.reducestream = False
+        self.addCleanup(CNC.vars.__setitem__, "feedmode", CNC.vars["feedmode"])
+
+    # points of a quarter of circle of 10 mm, each radius moved by noise
+    @staticmethod
+    def quarter(noise=0.0):
+        points = []
+        for k, angle in enumerate(range(0, 91, 3)):
+            r = 10.0 + (noise if k % 2 else -noise)
+            a = math.radians(angle)
+            points.append((r * math.cos(a), r * math.sin(a)))
+        return points
+
+    def compile(self, points, preamble="G90", move="G1", dz=0.0):
+        x, y = points[0]
+        lines = [f"G21 G17 G94 {preamble} G0 X{x:.4f} Y{y:.4f}"]
+        for k, (x, y) in enumerate(points[1:], 1):
+            z = f" Z{-dz * k:.4f}" if dz else ""
+            lines.append(f"{move} X{x:.4f} Y{y:.4f}{z} F100")
+        lines.append("G1 X-5 Y10")
+        self.gcode = GCode()
+        self.gcode.addBlockFromString("arc", "\n".join(lines))
+        return [line.strip() for line, path in self.gcode.iterCompile()
+                if path is not None]
+
+    def test_fitted_arc(self):
+        points = self.quarter()
+        out = self.compile(points)
+        self.assertEqual(len(out), 3, out)
+        words = dict(CNC.tokenizeLine(out[1]))
+        self.assertEqual(words["G"], 3.0)
+        # exact end point and a center at the same distance of every point
+        self.assertEqual((words["X"], words["Y"]), (0.0, 10.0))
+        x0, y0 = points[0]
+        xc, yc = x0 + words["I"], y0 + words["J"]
+        radius = math.hypot(x0 - xc, y0 - yc)
+        for x, y in points:
+            self.assertLessEqual(abs(math.hypot(x - xc, y - yc) - radius),
+                                 self.TOLERANCE)
+        # the motion mode is restored after the arc
+        self.assertEqual(out[2], "G1X-5Y10")
+        self.assertEqual((self.gcode.fitter.lines, self.gcode.fitter.arcs),
+                         (len(points) - 1, 1))
+
+    def test_radius_tolerance(self):
+        # the 3 degrees chords are 0.0034 mm inside the circle
+        self.compile(self.quarter(0.2 * self.TOLERANCE))
+        self.assertEqual(self.gcode.fitter.arcs, 1)
+        points = self.quarter(self.TOLERANCE)
+        out = self.compile(points)
+        self.assertEqual(self.gcode.fitter.arcs, 0)
+        self.assertEqual(len(out), len(points) + 1)
+
+    def test_not_fitted(self):
+        quarter = self.quarter()
+        for name, points, preamble, move, dz in (
+            ("straight", [(i, 2 * i) for i in range(10)], "G90", "G1", 0),
+            ("short", quarter[:3], "G90", "G1", 0),
+            ("relative", quarter, "G91", "G1", 0),
+            ("plane", quarter, "G90 G18", "G1", 0),
+            ("inverse time", quarter, "G90 G93", "G1", 0),
+            ("helix", quarter, "G90", "G1", 0.1),
+            ("rapid", quarter, "G90", "G0", 0),
+        ):
+            out = self.compile(points, preamble, move, dz)
+            self.assertEqual(self.gcode.fitter.lines, 0, name)
+            self.assertEqual(len(out), len(points) + 1, name)
+
+
+class CompactBlockTest(unittest.TestCase):
+    LINES = ["G0 X1", "G1 X2 Y3", "", "(comment)"]
+
+    def test_reading_keeps_it_compact(self):
+        block = CompactBlock("b", self.LINES)
+        self.assertEqual(len(block), 4)
+        self.assertEqual(block[1], "G1 X2 Y3")
+        self.assertEqual(block[-1], "(comment)")
+        self.assertEqual(block[1:3], ["G1 X2 Y3", ""])
+        self.assertEqual(list(block), self.LINES)
+        self.assertEqual(block, self.LINES)
+        self.assertIs(type(block), CompactBlock)
+        with self.assertRaises(IndexError):
+            block[4]
+
+    def test_write_materializes(self):
+        block = CompactBlock("b", self.LINES)
+        block.append("M2")
+        self.assertIs(type(block), Block)
+        self.assertEqual(list(block), self.LINES + ["M2"])
+
+        block = CompactBlock("b", self.LINES)
+        block[0] = "G0 X5"
+        self.assertIs(type(block), Block)
+        self.assertEqual(block[0], "G0 X5")
+        self.assertEqual(block[1:], self.LINES[1:])
+
+        block = CompactBlock("b", self.LINES)
+        del block[:]
+        self.assertIs(type(block), Block)
+        self.assertEqual(len(block), 0)
+
+    def test_copy_does_not_share(self):
+        original = Block("b")
+        original.extend(self.LINES)
+        original.enable = False
+        block = CompactBlock.fromBlock(original)
+        self.assertEqual(block.name(), "b")
+        self.assertFalse(block.enable)
+        block.insert(0, "G21")
+        self.assertEqual(list(original), self.LINES)
+        self.assertEqual(list(block), ["G21"] + self.LINES)
+
+    def test_pickle(self):
+        block = CompactBlock("b", self.LINES)
+        copy = pickle.loads(pickle.dumps(block))
+        self.assertIs(type(copy), CompactBlock)
+        self.assertEqual(list(copy), self.LINES)
+        copy.append("M2")
+        self.assertEqual(list(block), self.LINES)
+
+
+class LazyLoadTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix=".nc")
+        self.addCleanup(os.remove, self.filename)
+        with os.fdopen(fd, "w") as f:
+            f.write("(Block-name: a)\nG0 X0 Y0\nG1 X10 Y5 F100\n")
+            f.write("(Block-name: b)\nG0 X20 Y0\nG1 X30 Y-5 F100\n")
+        lazyload = CNC.lazyload
+        self.addCleanup(setattr, CNC, "lazyload", lazyload)
+        CNC.lazyload = 1e-6  # any file
+        self.gcode = GCode()
+        self.assertTrue(self.gcode.load(self.filename))
+        self.assertTrue(self.gcode.isLazy())
+
+    def test_not_parsed(self):
+        gcode = self.gcode
+        cache, CNC.lineCache = CNC.lineCache, LineCache()
+        self.addCleanup(setattr, CNC, "lineCache", cache)
+        gcode.calculateMargins()
+        self.assertEqual(CNC.lineCache.misses, 0)
+        self.assertEqual(len(gcode.motionTable.bid), 0)
+        self.assertEqual(len(gcode.timeline()[0]), 0)
+        self.assertEqual(gcode.enabledStatistics(), (2, 0.0, 0.0, 0.0))
+        self.assertTrue(
+            all(isinstance(block, LazyBlock) for block in gcode.blocks))
+
+    def test_margins_of_the_drawn_blocks(self):
+        block = self.gcode.blocks[1]
+        block.resetPath()
+        block.pathMargins([(20.0, 0.0, 0.0), (30.0, -5.0, 0.0)])
+        self.gcode.calculateMargins()
+        self.assertEqual((CNC.vars["xmin"], CNC.vars["xmax"]), (20.0, 30.0))
+        self.assertEqual((CNC.vars["aymin"], CNC.vars["aymax"]), (-5.0, 0.0))
@@ -0,0 +1,119 @@
+import math
+import sys
+from unittest import mock
+
+from CNC import CNC
+from Sender import Sender
+
+from . import grbl_sim
+from .sim_base import SimulatorTestCase
+
+
+# Motion lines of distinct targets, so that every one is a planner block
+def moves(count, feed=1000):
+    return [f"G1F{feed}X{i:07.3f}Y0.00" for i in range(1, count + 1)]
+
+
+class GrblStreamTest(SimulatorTestCase):
+    simArgs = ["--planner", "1"]
+
+    def test_rx_window(self):
+        # the size learned from the idle Bf report fills the 127 bytes of
+        # the ring of stock grbl without overflowing it
+        self.assertEqual(self.sender.rxBufferSize, 128)
+        self.hold()
+        for line in moves(20):  # 21 bytes each
+            self.sender.sendGCode(line)
+        self.assertTrue(self.waitFor(lambda: self.rxMoves() >= 6))
+        self.waitFor(lambda: False, 0.5)
+        self.assertEqual(self.sim.overflows, 0)
+        with self.sim._cond:
+            self.assertEqual(len(self.sim._rx), 6 * 21)
+
+        self.hold(False)
+        self.assertTrue(self.waitFor(lambda: self.sim.blocks == 20))
+        self.assertEqual(self.sim.overflows, 0)
+
+    def test_run_end_reports(self):
+        reducestream, arcfit = CNC.reducestream, CNC.arcfit
+        self.addCleanup(setattr, CNC, "reducestream", reducestream)
+        self.addCleanup(setattr, CNC, "arcfit", arcfit)
+        CNC.reducestream = True
+        CNC.arcfit = 0.01
+        # polygon of 100 points on a circle of 10 mm
+        job = ["G90 G21 G1 F6000"] + [
+            f"G1 X{10 * math.cos(i * 0.05) - 10:.4f}"
+            f" Y{10 * math.sin(i * 0.05):.4f}"
+            for i in range(1, 100)
+        ]
+        self.assertTrue(self.stream(job))
+        ended = [text for kind, text in self.messages
+                 if kind == Sender.MSG_RUNEND]
+        self.assertTrue(any(x.startswith("Arc fit:") for x in ended), ended)
+        self.assertTrue(any(x.startswith("Stream:") for x in ended), ended)
+
+    def test_buffer_fill(self):
+        # the line waiting for room is counted, but not as buffer fill
+        self.hold()
+        for line in moves(20):
+            self.sender.sendGCode(line)
+        self.assertTrue(self.waitFor(lambda: self.rxMoves() >= 5))
+        self.waitFor(lambda: False, 0.5)
+        with self.sim._cond:
+            rx = len(self.sim._rx)
+        fill = self.sender.getBufferFill()
+        self.assertLessEqual(fill, 100.0)
+        self.assertAlmostEqual(fill, rx * 100.0 / self.sender.rxBufferSize)
+
+
+class G2CoreLineModeTest(SimulatorTestCase):
+    controller = "G2Core"
+    simulator = grbl_sim.G2Simulator
+    simArgs = ["--planner", "6"]
+
+    def g2core(self):
+        return sys.modules[type(self.sender.mcontrol).__module__]
+
+    def waitQueueReports(self):
+        self.assertTrue(self.waitFor(lambda: self.sim._qv == 2))
+
+    def test_full_window(self):
+        # with plenty of free planner buffers LINES_IN_FLIGHT lines wait
+        # for their reply
+        self.waitQueueReports()
+        self.hold()
+        with mock.patch.object(self.g2core(), "PLANNER_LOW", 0):
+            for line in moves(20):
+                self.sender.sendGCode(line)
+            window = self.g2core().LINES_IN_FLIGHT
+            self.assertTrue(self.waitFor(lambda: self.rxMoves() >= window))
+            self.waitFor(lambda: False, 0.5)
+            self.assertEqual(self.rxMoves(), window)
+
+    def test_low_planner_keeps_one_line(self):
+        # fill the planner and wait for the queue report telling so
+        self.waitQueueReports()
+        self.hold()
+        for line in moves(6):
+            self.sender.sendGCode(line)
+        mcontrol = self.sender.mcontrol
+        self.assertTrue(
+            self.waitFor(lambda: mcontrol.planner == 0
+                         and not self.sender._cline))
+        self.waitFor(lambda: False, 1.5)  # a few turns of the serial thread
+
+        # with the planner full one line still waits behind it
+        for line in moves(20)[6:]:
+            self.sender.sendGCode(line)
+        self.assertTrue(self.waitFor(lambda: self.rxMoves() >= 1))
+        self.waitFor(lambda: False, 0.5)
+        self.assertEqual(self.rxMoves(), 1)
+
+        self.hold(False)
+        self.assertTrue(self.waitFor(lambda: self.sim.blocks == 20))
+        self.assertEqual(self.sim.overflows, 0)
+
+    def test_run(self):
+        self.assertTrue(self.stream(moves(200, 6000)))
+        self.assertEqual(self.sim.blocks, 200)
+        self.assertEqual(self.sim.overflows, 0)